@@ -0,0 +1,109 @@
+"""Benchmark: CPU spent queueing one broadcast for many connected recipients
+
+Opens RECIPIENTS connections on the server's outboxes (backed by sockets that
+discard what they're sent) and times queueing one lobby_joined event for all of
+them: serializing the payload once per recipient and queueing each copy (what
+the broadcast helpers used to do) against send_frame and fan_out, which encode
+one frame per protocol and share it, for each available JSON encoder. The
+writer tasks then drain the queues, untimed, before the next round.
+
+    python bench_broadcast.py [recipients] [rounds]
+"""
+import asyncio
+import dataclasses
+import json
+import sys
+import time
+
+import main
+
+RECIPIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+def sample_lobby() -> main.Lobby:
+    """A lobby mid-game, with both players' last submissions stored"""
+    code = "def two_sum(nums, target):\n" + "    # scratch work\n" * 200 + "    return []\n"
+    lobby = main.Lobby(id="lobby_123456", name="Benchmark Lobby", type="public", pin=None,
+                       elo_range="easy", status="playing")
+    for index in range(2):
+        player = main.Player(f"client_{index}")
+        player.seat(lobby.id, "player", f"player{index}")
+        player.ready = True
+        player.code = code
+        player.last_submission = time.time()
+        player.tests_passed = 3
+        lobby.players[player.id] = player
+    for index in range(50):
+        spectator = main.Player(f"client_{index + 2}")
+        spectator.seat(lobby.id, "spectator", f"spectator{index}")
+        lobby.spectators[spectator.id] = spectator
+    return lobby
+
+class NullSocket:
+    """A connection that accepts every frame instantly"""
+    
+    async def send_text(self, message):
+        pass
+    
+    async def send_bytes(self, message):
+        pass
+    
+    async def close(self, code=1000):
+        pass
+
+async def drained(client_ids: list):
+    """Wait until the writer tasks have sent everything queued for client_ids"""
+    while any(main.outboxes.queues[client_id] for client_id in client_ids):
+        await asyncio.sleep(0)
+
+async def cpu_ms(client_ids: list, fn) -> float:
+    """Average CPU milliseconds spent in fn (a sync function or a coroutine function) per round"""
+    total = 0.0
+    for _ in range(ROUNDS):
+        start = time.process_time()
+        result = fn()
+        if asyncio.iscoroutine(result):
+            await result
+        total += time.process_time() - start
+        await drained(client_ids)
+    return total / ROUNDS * 1000
+
+def per_recipient(client_ids: list, data: dict):
+    for client_id in client_ids:
+        message = json.dumps({"event": "lobby_joined", "data": data})
+        main.outboxes.send(client_id, "lobby_joined", message)
+
+async def main_bench():
+    lobby = sample_lobby()
+    full = {"lobbyId": lobby.id, "lobbyData": dataclasses.asdict(lobby)}
+    public = {"lobbyId": lobby.id, "lobbyData": main.public_lobby(lobby)}
+    
+    client_ids = [f"bench_{index}" for index in range(RECIPIENTS)]
+    for client_id in client_ids:
+        main.outboxes.open(client_id, NullSocket())
+    
+    encoders = [("json", lambda message: json.dumps(message, separators=(",", ":")))]
+    if main.orjson is not None:
+        encoders.append(("orjson", lambda message: main.orjson.dumps(message).decode()))
+    if main.msgspec is not None:
+        msgspec_encoder = main.msgspec.json.Encoder()
+        encoders.append(("msgspec", lambda message: msgspec_encoder.encode(message).decode()))
+    
+    print(f"{RECIPIENTS} recipients, {ROUNDS} rounds, "
+          f"frame {len(json.dumps(full))} bytes with code, {len(json.dumps(public))} without")
+    baseline = await cpu_ms(client_ids, lambda: per_recipient(client_ids, full))
+    print(f"{'json.dumps + send per recipient (full)':<42} {baseline:9.3f} ms")
+    for name, encode in encoders:
+        main.frame_encoder = encode
+        for label, data in (("full", full), ("public", public)):
+            for helper, fn in (("send_frame", lambda: main.send_frame(client_ids, "lobby_joined", data)),
+                               ("fan_out", lambda: main.fan_out(client_ids, "lobby_joined", data))):
+                elapsed = await cpu_ms(client_ids, fn)
+                print(f"{f'{helper}, {name} ({label})':<42} {elapsed:9.3f} ms  "
+                      f"saves {baseline - elapsed:9.3f} ms ({baseline / max(elapsed, 1e-6):.1f}x)")
+    
+    for client_id in client_ids:
+        main.outboxes.close(client_id)
+
+if __name__ == "__main__":
+    asyncio.run(main_bench())
@@ -0,0 +1,93 @@
+"""Benchmark: memory per lobby, free-form dicts vs the slotted Lobby/Player model
+
+Builds the same mid-game lobbies both ways (two seated players, a handful of
+spectators, no submitted code so only the model's own overhead is measured) and
+reports the bytes allocated per lobby, plus the cost of a membership lookup.
+
+    python bench_lobby_memory.py [lobbies] [spectators per lobby]
+"""
+import sys
+import time
+import tracemalloc
+
+import main
+
+LOBBIES = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+SPECTATORS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+def dict_lobbies() -> tuple:
+    """The lobby and player dicts the handlers used to build"""
+    lobbies, players = {}, {}
+    for index in range(LOBBIES):
+        lobby_id = f"lobby_{index:06d}"
+        members = []
+        for seat in range(2):
+            client_id = f"client_{index}_{seat}"
+            players[client_id] = {"id": client_id, "name": f"player{seat}", "lobby": lobby_id,
+                                  "connected_at": time.time()}
+            members.append({"id": client_id, "name": f"player{seat}", "ready": True,
+                            "last_submission": time.time(), "tests_passed": 3, "total_tests": 5,
+                            "completed": False})
+        spectators = {}
+        for seat in range(SPECTATORS):
+            client_id = f"client_{index}_s{seat}"
+            players[client_id] = {"id": client_id, "name": f"spectator{seat}", "lobby": lobby_id,
+                                  "connected_at": time.time(), "role": "spectator"}
+            spectators[client_id] = {"id": client_id, "name": f"spectator{seat}"}
+        lobbies[lobby_id] = {"id": lobby_id, "name": "Benchmark Lobby", "type": "public", "pin": None,
+                             "status": "playing", "elo_range": "easy", "players": members,
+                             "spectators": spectators, "maxPlayers": 2, "createdAt": time.time(),
+                             "started_at": time.time()}
+    return lobbies, players
+
+def model_lobbies() -> tuple:
+    lobbies, players = {}, {}
+    for index in range(LOBBIES):
+        lobby = main.Lobby(id=f"lobby_{index:06d}", name="Benchmark Lobby", type="public", pin=None,
+                           elo_range="easy", status="playing", started_at=time.time())
+        for seat in range(2):
+            player = players[f"client_{index}_{seat}"] = main.Player(f"client_{index}_{seat}")
+            player.seat(lobby.id, "player", f"player{seat}")
+            player.ready = True
+            player.last_submission = time.time()
+            player.tests_passed = 3
+            lobby.players[player.id] = player
+        for seat in range(SPECTATORS):
+            spectator = players[f"client_{index}_s{seat}"] = main.Player(f"client_{index}_s{seat}")
+            spectator.seat(lobby.id, "spectator", f"spectator{seat}")
+            lobby.spectators[spectator.id] = spectator
+        lobbies[lobby.id] = lobby
+    return lobbies, players
+
+def measure(build) -> tuple:
+    """Bytes allocated per lobby by build(), and the structures it built"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / LOBBIES, built
+
+def lookup_ns(find, rounds: int = 200000) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        find()
+    return (time.perf_counter() - start) / rounds * 1e9
+
+def main_bench():
+    dict_bytes, (lobbies, _) = measure(dict_lobbies)
+    members = next(iter(lobbies.values()))["players"]
+    dict_lookup = lookup_ns(lambda: next(p for p in members if p["id"] == "client_0_1"))
+    del lobbies
+
+    model_bytes, (lobbies, _) = measure(model_lobbies)
+    seated = next(iter(lobbies.values())).players
+    model_lookup = lookup_ns(lambda: seated.get("client_0_1"))
+
+    print(f"{LOBBIES} lobbies, 2 players and {SPECTATORS} spectators each")
+    print(f"{'dicts':<8} {dict_bytes:9.0f} bytes/lobby  member lookup {dict_lookup:6.0f} ns")
+    print(f"{'model':<8} {model_bytes:9.0f} bytes/lobby  member lookup {model_lookup:6.0f} ns")
+    print(f"saves {dict_bytes - model_bytes:.0f} bytes per lobby ({1 - model_bytes / dict_bytes:.0%})")
+
+if __name__ == "__main__":
+    main_bench()
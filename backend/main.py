@@ -1,13 +1,33 @@
 import json
+import math
 import random
 import time
 import os
+import sys
 import httpx
 import asyncio
+import ast
 import base64
-from typing import Dict, Set
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import bisect
+import ctypes
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import secrets
+import selectors
+import signal
+import traceback
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -21,8 +41,244 @@ JUDGE0_BASE_URL = os.getenv("JUDGE0_BASE_URL", "https://judge0-ce.p.rapidapi.com
 # Python language ID for Judge0 (71 = Python 3.8.1)
 PYTHON_LANGUAGE_ID = 71
 
+# Max test cases of one submission in flight on Judge0 at the same time
+JUDGE0_MAX_CONCURRENCY = int(os.getenv("JUDGE0_MAX_CONCURRENCY", "5"))
+
+# Send all test cases of a submission in one /submissions/batch call
+JUDGE0_BATCH_MODE = os.getenv("JUDGE0_BATCH_MODE", "false").lower() == "true"
+JUDGE0_MAX_BATCH_SIZE = 20  # Judge0 default MAX_SUBMISSION_BATCH_SIZE
+
+# Shared HTTP client pool for the judge backend
+JUDGE0_POOL_MAX_CONNECTIONS = int(os.getenv("JUDGE0_POOL_MAX_CONNECTIONS", "100"))
+JUDGE0_POOL_MAX_KEEPALIVE = int(os.getenv("JUDGE0_POOL_MAX_KEEPALIVE", "20"))
+JUDGE0_POOL_KEEPALIVE_EXPIRY = float(os.getenv("JUDGE0_POOL_KEEPALIVE_EXPIRY", "30"))
+JUDGE0_CONNECT_TIMEOUT = float(os.getenv("JUDGE0_CONNECT_TIMEOUT", "5"))
+JUDGE0_POOL_TIMEOUT = float(os.getenv("JUDGE0_POOL_TIMEOUT", "10"))
+JUDGE0_SUBMIT_TIMEOUT = httpx.Timeout(30.0, connect=JUDGE0_CONNECT_TIMEOUT, pool=JUDGE0_POOL_TIMEOUT)
+JUDGE0_POLL_TIMEOUT = httpx.Timeout(10.0, connect=JUDGE0_CONNECT_TIMEOUT, pool=JUDGE0_POOL_TIMEOUT)
+
+# Judge0 result delivery: PUT callbacks to this server when JUDGE0_CALLBACK_URL
+# (our public base URL) is set, otherwise adaptive polling with backoff and jitter
+JUDGE0_CALLBACK_URL = os.getenv("JUDGE0_CALLBACK_URL", "").rstrip("/")
+# Part of the callback path so only Judge0 can deliver verdicts; set it to share one
+# between workers, otherwise every process makes up its own
+JUDGE0_CALLBACK_SECRET = os.getenv("JUDGE0_CALLBACK_SECRET") or secrets.token_urlsafe(32)
+JUDGE0_CALLBACK_GRACE = float(os.getenv("JUDGE0_CALLBACK_GRACE", "3"))  # seconds before polling in callback mode
+JUDGE0_POLL_INITIAL_DELAY = float(os.getenv("JUDGE0_POLL_INITIAL_DELAY", "0.25"))
+JUDGE0_POLL_MAX_DELAY = float(os.getenv("JUDGE0_POLL_MAX_DELAY", "2"))
+JUDGE0_POLL_BACKOFF = 1.6
+JUDGE0_RESULT_TIMEOUT = float(os.getenv("JUDGE0_RESULT_TIMEOUT", "15"))
+
+# Judge backend: "judge0" (remote API) or "local" (sandboxed worker processes on this host).
+# JUDGE_FALLBACK picks what runs when Judge0 is not configured or fails: "fake" or "local"
+JUDGE_BACKEND = os.getenv("JUDGE_BACKEND", "judge0").lower()
+JUDGE_FALLBACK = os.getenv("JUDGE_FALLBACK", "fake").lower()
+
+# Local judge limits (per test case)
+LOCAL_JUDGE_WORKERS = int(os.getenv("LOCAL_JUDGE_WORKERS", str(os.cpu_count() or 2)))
+LOCAL_JUDGE_TIME_LIMIT = float(os.getenv("LOCAL_JUDGE_TIME_LIMIT", "2"))  # wall clock seconds
+LOCAL_JUDGE_CPU_LIMIT = int(os.getenv("LOCAL_JUDGE_CPU_LIMIT", "1"))  # CPU seconds
+LOCAL_JUDGE_MEMORY_LIMIT_MB = int(os.getenv("LOCAL_JUDGE_MEMORY_LIMIT_MB", "128"))
+LOCAL_JUDGE_OUTPUT_LIMIT = int(os.getenv("LOCAL_JUDGE_OUTPUT_LIMIT", "65536"))  # bytes per stream
+LOCAL_JUDGE_UID = int(os.getenv("LOCAL_JUDGE_UID", "65534"))  # user solutions run as when the server is root
+# "isolate" gives every solution an empty network namespace and refuses to start where that
+# isn't possible; "host" leaves the network alone, only for hosts whose firewall blocks egress
+LOCAL_JUDGE_NETWORK = os.getenv("LOCAL_JUDGE_NETWORK", "isolate").lower()
+LOCAL_JUDGE_PYTHON = os.getenv("LOCAL_JUDGE_PYTHON", sys.executable)  # must be executable by LOCAL_JUDGE_UID
+
+# Stop judging a submission at its first failed test case (clients can override per submission)
+JUDGE_FAIL_FAST = os.getenv("JUDGE_FAIL_FAST", "false").lower() == "true"
+
+# Submission scheduler: judge calls running at once across all lobbies, and how many
+# submissions may wait before new ones are rejected as busy
+SUBMISSION_MAX_CONCURRENCY = int(os.getenv("SUBMISSION_MAX_CONCURRENCY", "16"))
+SUBMISSION_MAX_BACKLOG = int(os.getenv("SUBMISSION_MAX_BACKLOG", "200"))
+
+# Local compile check before a submission goes to the judge
+PRECHECK_WORKERS = int(os.getenv("PRECHECK_WORKERS", "2"))
+PRECHECK_TIMEOUT = float(os.getenv("PRECHECK_TIMEOUT", "5"))  # seconds
+
+# Function each problem's solution has to define
+PROBLEM_ENTRY_POINTS = {
+    "two-sum": "two_sum"
+}
+
+# Harness mode: wrap the solution so one execution runs every test case
+JUDGE_HARNESS = os.getenv("JUDGE_HARNESS", "false").lower() == "true"
+HARNESS_CASE_TIME_LIMIT = float(os.getenv("HARNESS_CASE_TIME_LIMIT", "1"))  # seconds per test case
+HARNESS_MARKER = "__SHIBACODER_CASE__"
+
+# Verdict cache for resubmitted code
+VERDICT_CACHE_TTL = float(os.getenv("VERDICT_CACHE_TTL", "600"))  # seconds
+VERDICT_CACHE_MAX_ENTRIES = int(os.getenv("VERDICT_CACHE_MAX_ENTRIES", "10000"))
+VERDICT_CACHE_MAX_BYTES = int(os.getenv("VERDICT_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# Lobby browser pushes are coalesced into one diff per subscriber per window
+LOBBY_LIST_DEBOUNCE = float(os.getenv("LOBBY_LIST_DEBOUNCE", "0.25"))  # seconds
+
+# Live code streaming to spectators: diffs at most LIVE_CODE_RATE times a second per player,
+# with a full snapshot instead of a diff once LIVE_CODE_SNAPSHOT_INTERVAL has passed
+LIVE_CODE_RATE = float(os.getenv("LIVE_CODE_RATE", "5"))  # updates per second
+LIVE_CODE_SNAPSHOT_INTERVAL = float(os.getenv("LIVE_CODE_SNAPSHOT_INTERVAL", "10"))  # seconds
+
+# Spectator emoji reactions are counted per lobby and sent to players once per tick
+EMOJI_TICK = float(os.getenv("EMOJI_TICK", "0.25"))  # seconds
+EMOJI_MAX_KINDS = 16  # distinct emoji per lobby per tick; extra kinds are dropped
+
+# Spectator audiences: roster changes go out as batched deltas, big fan-outs are split into shards
+SPECTATOR_ROSTER_TICK = float(os.getenv("SPECTATOR_ROSTER_TICK", "1"))  # seconds
+SPECTATOR_ROSTER_PAGE_SIZE = 50
+FANOUT_SHARD_SIZE = int(os.getenv("FANOUT_SHARD_SIZE", "1000"))  # recipients per shard task
+
+# Spectator chat: recent history per lobby, size cap, per-sender token bucket, batched per tick
+CHAT_HISTORY_SIZE = int(os.getenv("CHAT_HISTORY_SIZE", "50"))  # messages kept per lobby
+CHAT_MAX_LENGTH = int(os.getenv("CHAT_MAX_LENGTH", "100"))  # characters
+CHAT_RATE = float(os.getenv("CHAT_RATE", "1"))  # messages per second per sender, sustained
+CHAT_BURST = int(os.getenv("CHAT_BURST", "5"))  # messages a sender can send at once
+CHAT_TICK = float(os.getenv("CHAT_TICK", "0.2"))  # seconds
+
+# Game timers (countdowns, time limits) run on one timer wheel
+GAME_TIMER_RESOLUTION = float(os.getenv("GAME_TIMER_RESOLUTION", "0.1"))  # seconds per wheel tick
+GAME_TIMER_SLOTS = 512
+GAME_COUNTDOWN = 3  # seconds
+GAME_TIME_LIMIT = int(os.getenv("GAME_TIME_LIMIT", "300"))  # seconds
+
+# Lifecycle reaper: heartbeats, state reconciliation and lobby expiry
+REAPER_INTERVAL = float(os.getenv("REAPER_INTERVAL", "15"))  # seconds between sweeps (and pings)
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "45"))  # drop clients silent this long
+FINISHED_LOBBY_TTL = float(os.getenv("FINISHED_LOBBY_TTL", "300"))  # seconds a finished lobby stays around
+
+# Shared state for running one worker per core (or per host) behind a load balancer.
+# "memory" keeps everything in this process, so it must be the only worker;
+# "redis" shares lobby ownership, the lobby listing and a pub/sub channel through REDIS_URL.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+NODE_ID = os.getenv("NODE_ID") or f"node_{os.getpid()}_{random.randint(1000, 9999)}"
+
+# Session resumption: a player whose socket drops keeps their seat for RESUME_GRACE,
+# and reconnecting with their resume token (the "resume" event) replays the lobby events they missed
+RESUME_GRACE = float(os.getenv("RESUME_GRACE", "20"))  # seconds
+LOBBY_EVENT_LOG_SIZE = int(os.getenv("LOBBY_EVENT_LOG_SIZE", "256"))  # events kept per lobby
+
+# Binary WebSocket protocol: MessagePack frames [event code, data] with short field codes.
+# Clients opt in with the WebSocket subprotocol below or a "hello" event; the rest get JSON.
+# Codes only ever get added, so a client built against this table keeps working.
+MSGPACK_SUBPROTOCOL = "shibacoder.msgpack.v1"
+WIRE_EVENTS = [
+    # client -> server
+    "hello", "get_lobby_list", "subscribe_lobby_list", "unsubscribe_lobby_list", "create_lobby",
+    "join_lobby", "leave_lobby", "player_ready", "submit_code", "send_attack", "join_as_spectator",
+    "spectator_chat", "spectator_emoji", "code_update",
+    # server -> client
+    "error", "busy", "lobby_list", "lobby_list_diff", "lobby_created", "lobby_joined", "lobby_left",
+    "player_joined", "player_left", "player_ready_update", "countdown_start", "countdown_update",
+    "game_start", "test_case_result", "test_results", "progress_update", "game_finished",
+    "attack_received", "spectator_joined", "spectator_list_update", "spectator_chat_message",
+    "spectator_emoji_reaction", "live_code_update",
+    # added later
+    "watch_live_code", "resync_live_code", "live_code_delta", "spectator_emoji_reactions",
+    "get_spectator_roster", "spectator_roster", "spectator_roster_delta", "spectator_chat_messages",
+    "ping", "pong", "session", "resumed", "resume",
+]
+WIRE_EVENT_CODES = {event: code for code, event in enumerate(WIRE_EVENTS)}
+WIRE_FIELD_CODES = {
+    "message": "m", "name": "n", "id": "i", "type": "y", "status": "s", "code": "co",
+    "players": "ps", "playerName": "pn", "playerCount": "pc", "maxPlayers": "mp", "ready": "r",
+    "spectators": "ss", "spectatorName": "sn", "lobbyId": "l", "lobbyData": "ld", "lobby": "lb",
+    "lobbies": "ls", "pin": "pk", "elo_range": "el", "eloRange": "eg", "createdAt": "ca",
+    "pagination": "pg", "currentPage": "cp", "totalPages": "tg", "totalLobbies": "tb", "perPage": "pp",
+    "page": "pa", "search": "se", "added": "a", "removed": "rm", "changed": "ch", "order": "od",
+    "player_id": "pi", "player_name": "pl", "test": "te", "total": "t", "passed": "p",
+    "runtime": "rt", "error": "er", "errors": "eo", "completed": "c", "tests_passed": "tp",
+    "total_tests": "tt", "queueDepth": "qd", "language": "lg", "failFast": "ff",
+    "countdown": "cd", "timeLimit": "tl", "problem": "pb", "title": "ti", "description": "de",
+    "examples": "es", "input": "in", "output": "o", "explanation": "ex", "template": "tm",
+    "winner": "w", "winner_id": "wi", "final_scores": "fs", "game_duration": "gd",
+    "completion_time": "ct", "attacker": "at", "attackType": "ak", "emoji": "em",
+    "timestamp": "ts", "protocols": "pr", "protocol": "pt", "events": "ev", "fields": "fd",
+    "seq": "sq", "start": "sx", "deleteCount": "dc", "insert": "ix", "playerIds": "pv", "playerId": "pj",
+    "reactions": "rx", "count": "cn", "joined": "jn", "left": "lf", "viewerCount": "vc",
+    "spectatorCount": "sc", "truncated": "tr", "messages": "ms", "chatHistory": "hs",
+    "reason": "rs", "clientId": "ci", "resumeToken": "rk", "graceSeconds": "gs", "eventSeq": "eq",
+    "replayed": "rp", "lastSeq": "lq",
+}
+WIRE_FIELD_NAMES = {code: field for field, code in WIRE_FIELD_CODES.items()}
+
+# Outbound queue per connection, drained by its own writer task
+OUTBOX_MAX_MESSAGES = int(os.getenv("OUTBOX_MAX_MESSAGES", "256"))
+OUTBOX_SEND_TIMEOUT = float(os.getenv("OUTBOX_SEND_TIMEOUT", "10"))  # seconds a single send may block
+
+# What to do when an event arrives at a full outbox:
+#   drop_oldest - evict the oldest droppable queued message (losing one is harmless)
+#   coalesce    - replace the queued message of the same kind (only the latest state matters)
+#   disconnect  - the client can't keep up with events it must not miss, so close it
+# Events not listed here use OUTBOX_DEFAULT_POLICY.
+OUTBOX_OVERFLOW_POLICIES = {
+    "spectator_chat_messages": "drop_oldest",
+    "spectator_emoji_reactions": "drop_oldest",
+    "test_case_result": "drop_oldest",
+    "countdown_update": "drop_oldest",
+    "live_code_update": "coalesce",
+    "live_code_delta": "drop_oldest",  # spectators notice the sequence gap and resync
+    "progress_update": "coalesce",
+    "player_ready_update": "coalesce",
+    "spectator_roster_delta": "drop_oldest",  # spectators notice the sequence gap and refetch
+}
+OUTBOX_DEFAULT_POLICY = "disconnect"
+# Coalesced events that carry one entity's state are only coalesced per entity
+OUTBOX_COALESCE_KEYS = {
+    "live_code_update": "player_id"
+}
+
+# resource and os.fork only exist on Unix; the local judge is unavailable elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    JUDGE0_HTTP2 = os.getenv("JUDGE0_HTTP2", "true").lower() == "true"
+except ImportError:
+    JUDGE0_HTTP2 = False
+
+# Faster JSON for outgoing frames if orjson or msgspec is installed (FRAME_ENCODER=auto picks the first found)
+FRAME_ENCODER = os.getenv("FRAME_ENCODER", "auto").lower()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Binary protocol for clients that negotiate it (pip install msgpack); without it everyone gets JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Shared state backend for several workers (pip install redis); only needed with STATE_BACKEND=redis
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+@asynccontextmanager
+async def lifespan(app):
+    """Create shared resources on startup and release them on shutdown"""
+    await start_judge_backends()
+    await cluster.start()
+    lifecycle_reaper.start()
+    yield
+    await lifecycle_reaper.stop()
+    await cluster.close()
+    await close_judge_backends()
+
 # Create FastAPI app
-app = FastAPI(title="ShibaCoder API", version="1.0.0")
+app = FastAPI(title="ShibaCoder API", version="1.0.0", lifespan=lifespan)
 
 # Configure CORS for REST endpoints
 # Allow all origins for easy deployment and testing
@@ -34,10 +290,152 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class AccessLogRedaction(logging.Filter):
+    """Keep the Judge0 callback secret out of uvicorn's access log"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        args = record.args
+        if isinstance(args, tuple) and len(args) >= 3 and isinstance(args[2], str):
+            record.args = (*args[:2], args[2].replace(JUDGE0_CALLBACK_SECRET, "<secret>"), *args[3:])
+        return True
+
+logging.getLogger("uvicorn.access").addFilter(AccessLogRedaction())
+
+@dataclass(slots=True)
+class Player:
+    """A connected client, and its seat in a lobby while lobby is set
+    
+    role is "player" or "spectator" while seated. The game fields describe the
+    current game and are reset whenever the client takes a seat. A client connected
+    to another worker is represented by a proxy with node set (see ClusterRouter).
+    """
+    id: str
+    name: Optional[str] = None
+    lobby: Optional[str] = None
+    role: Optional[str] = None
+    node: Optional[str] = None  # worker holding the socket, when it isn't this one
+    connected_at: float = field(default_factory=time.time)
+    ready: bool = False
+    code: Optional[str] = None
+    last_submission: float = 0.0
+    tests_passed: int = 0
+    total_tests: int = 5
+    completed: bool = False
+    
+    def seat(self, lobby_id: str, role: str, name: str):
+        self.name = name
+        self.lobby = lobby_id
+        self.role = role
+        self.ready = False
+        self.code = None
+        self.last_submission = 0.0
+        self.tests_passed = 0
+        self.total_tests = 5
+        self.completed = False
+    
+    def unseat(self):
+        self.lobby = None
+        self.role = None
+        self.code = None
+
+@dataclass(slots=True)
+class Lobby:
+    """A game room; players and spectators are indexed by client id, in join order"""
+    id: str
+    name: str
+    type: str
+    pin: Optional[str]
+    elo_range: str
+    status: str = "waiting"
+    max_players: int = 2
+    created_at: float = field(default_factory=time.time)
+    players: Dict[str, Player] = field(default_factory=dict)
+    spectators: Dict[str, Player] = field(default_factory=dict)
+    started_at: float = 0.0
+    ended_at: float = 0.0
+    winner: Optional[str] = None
+    problem: Optional[dict] = None
+    
+    def is_full(self) -> bool:
+        return len(self.players) >= self.max_players
+
 # In-memory storage
-lobbies: Dict[str, Dict] = {}
+lobbies: Dict[str, Lobby] = {}
 connections: Dict[str, WebSocket] = {}
-players: Dict[str, Dict] = {}
+players: Dict[str, Player] = {}
+
+class LobbyRegistry:
+    """Index of public lobbies in the waiting state for the lobby browser
+    
+    Keeps lobby ids sorted newest first and an n-gram index of lowercased names
+    (every 1-3 character substring), so a page is a slice of the sorted list and a
+    search only looks at lobbies that contain all of the query's n-grams.
+    Adding or removing a lobby is a binary search plus a list insert/delete, which
+    moves O(n) entries (one memmove, cheap at realistic lobby counts).
+    Call sync() whenever a lobby's type or status may have changed and discard()
+    when it is deleted.
+    """
+    NGRAM_SIZE = 3
+    
+    def __init__(self):
+        self.order = []  # sorted (-created_at, lobby_id)
+        self.keys: Dict[str, tuple] = {}  # lobby_id -> sort key
+        self.names: Dict[str, str] = {}  # lobby_id -> lowercased name
+        self.ngrams: Dict[str, Set[str]] = {}  # n-gram -> lobby ids
+    
+    @classmethod
+    def name_ngrams(cls, name: str) -> Set[str]:
+        return {
+            name[i:i + size]
+            for size in range(1, cls.NGRAM_SIZE + 1)
+            for i in range(len(name) - size + 1)
+        }
+    
+    def sync(self, lobby: Lobby):
+        if lobby.type == "public" and lobby.status == "waiting":
+            self.add(lobby.id, lobby.created_at, lobby.name)
+        else:
+            self.discard(lobby.id)
+    
+    def add(self, lobby_id: str, created_at: float, name: str):
+        if lobby_id in self.keys:
+            return
+        key = (-created_at, lobby_id)
+        bisect.insort(self.order, key)
+        self.keys[lobby_id] = key
+        self.names[lobby_id] = name.lower()
+        for ngram in self.name_ngrams(self.names[lobby_id]):
+            self.ngrams.setdefault(ngram, set()).add(lobby_id)
+    
+    def discard(self, lobby_id: str):
+        key = self.keys.pop(lobby_id, None)
+        if key is None:
+            return
+        del self.order[bisect.bisect_left(self.order, key)]
+        for ngram in self.name_ngrams(self.names.pop(lobby_id)):
+            ids = self.ngrams[ngram]
+            ids.discard(lobby_id)
+            if not ids:
+                del self.ngrams[ngram]
+    
+    def search(self, search: str) -> list:
+        """Sort keys of lobbies whose name contains search (case-insensitive), newest first"""
+        query = search.lower()
+        query_ngrams = self.name_ngrams(query) if len(query) <= self.NGRAM_SIZE else {
+            query[i:i + self.NGRAM_SIZE] for i in range(len(query) - self.NGRAM_SIZE + 1)
+        }
+        candidate_sets = sorted((self.ngrams.get(ngram, set()) for ngram in query_ngrams), key=len)
+        candidates = set.intersection(*candidate_sets) if candidate_sets else set()
+        return sorted(
+            self.keys[lobby_id] for lobby_id in candidates
+            if query in self.names[lobby_id]
+        )
+    
+    def listing(self, search: str = "") -> list:
+        """Sort keys of every listed lobby, or of those matching search, newest first"""
+        return self.search(search) if search else self.order
+
+lobby_registry = LobbyRegistry()
 
 def generate_lobby_id() -> str:
     """Generate a unique lobby ID"""
@@ -47,86 +445,390 @@ def validate_pin(pin: str) -> bool:
     """Validate 4-digit pin format"""
     return pin.isdigit() and len(pin) == 4
 
+def get_frame_encoder():
+    """Pick the JSON encoder for outgoing frames, returning (name, encode)"""
+    if FRAME_ENCODER in ("auto", "orjson") and orjson is not None:
+        return "orjson", lambda message: orjson.dumps(message).decode()
+    if FRAME_ENCODER in ("auto", "msgspec") and msgspec is not None:
+        msgspec_encoder = msgspec.json.Encoder()
+        return "msgspec", lambda message: msgspec_encoder.encode(message).decode()
+    return "json", lambda message: json.dumps(message, separators=(",", ":"))
+
+frame_encoder_name, frame_encoder = get_frame_encoder()
+frame_stats = {
+    "json": {"encoded": 0, "bytes": 0},
+    "msgpack": {"encoded": 0, "bytes": 0},
+    "deliveries": 0
+}
+
+def wire_compact(value):
+    """Swap field names for their short codes, recursively"""
+    if isinstance(value, dict):
+        return {WIRE_FIELD_CODES.get(key, key): wire_compact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [wire_compact(item) for item in value]
+    return value
+
+def wire_expand(value):
+    """Inverse of wire_compact"""
+    if isinstance(value, dict):
+        return {WIRE_FIELD_NAMES.get(key, key): wire_expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [wire_expand(item) for item in value]
+    return value
+
+def encode_frame(event: str, data: dict, protocol: str = "json"):
+    """Serialize an event once per protocol; the frame is shared by every recipient
+    
+    JSON frames are text, MessagePack frames are bytes.
+    """
+    if protocol == "msgpack":
+        frame = msgpack.packb([WIRE_EVENT_CODES.get(event, event), wire_compact(data)])
+    else:
+        frame = frame_encoder({"event": event, "data": data})
+    frame_stats[protocol]["encoded"] += 1
+    frame_stats[protocol]["bytes"] += len(frame)
+    return frame
+
+def decode_frame(message: dict):
+    """Turn a received WebSocket message into (event, data)"""
+    if message.get("bytes") is not None:
+        if msgpack is None:
+            raise ValueError("Binary frames are not supported by this server")
+        try:
+            event, data = msgpack.unpackb(message["bytes"])
+            if isinstance(event, int):
+                event = WIRE_EVENTS[event]
+        except Exception:
+            raise ValueError("Malformed message")
+        return event, wire_expand(data or {})
+    
+    try:
+        payload = json.loads(message["text"])
+    except ValueError:
+        raise ValueError("Malformed message")
+    if not isinstance(payload, dict):
+        raise ValueError("Malformed message")
+    return payload.get("event"), payload.get("data") or {}
+
+def get_frame_stats() -> dict:
+    return {
+        "encoder": frame_encoder_name,
+        "msgpackAvailable": msgpack is not None,
+        "json": {"framesEncoded": frame_stats["json"]["encoded"], "bytesEncoded": frame_stats["json"]["bytes"]},
+        "msgpack": {"framesEncoded": frame_stats["msgpack"]["encoded"], "bytesEncoded": frame_stats["msgpack"]["bytes"]},
+        "binaryClients": sum(1 for protocol in outboxes.protocols.values() if protocol == "msgpack"),
+        "deliveries": frame_stats["deliveries"]
+    }
+
+# Outbound views of the lobby model. Each event gets only the fields its clients use:
+# submitted code stays on the server and the pin only goes to the lobby's own players.
+
+def public_player(player: Player) -> dict:
+    return {
+        "id": player.id,
+        "name": player.name,
+        "ready": player.ready,
+        "tests_passed": player.tests_passed,
+        "total_tests": player.total_tests,
+        "completed": player.completed
+    }
+
+def public_players(lobby: Lobby) -> list:
+    return [public_player(player) for player in lobby.players.values()]
+
+def public_spectator(spectator: Player) -> dict:
+    return {"id": spectator.id, "name": spectator.name}
+
+def player_progress(player: Player) -> dict:
+    return {
+        "name": player.name,
+        "tests_passed": player.tests_passed,
+        "total_tests": player.total_tests,
+        "completed": player.completed
+    }
+
+def public_lobby(lobby: Lobby) -> dict:
+    """Lobby data for anyone watching it
+    
+    Spectators are only counted; the roster itself is paged (get_spectator_roster).
+    """
+    lobby_data = {
+        "id": lobby.id,
+        "name": lobby.name,
+        "type": lobby.type,
+        "status": lobby.status,
+        "elo_range": lobby.elo_range,
+        "maxPlayers": lobby.max_players,
+        "createdAt": lobby.created_at,
+        "players": public_players(lobby),
+        "spectatorCount": len(lobby.spectators)
+    }
+    if lobby.problem is not None:
+        lobby_data["problem"] = lobby.problem
+    return lobby_data
+
+def member_lobby(lobby: Lobby) -> dict:
+    """Lobby data for its players, who may share the pin"""
+    return {**public_lobby(lobby), "pin": lobby.pin}
+
+def lobby_list_entry(lobby: Lobby) -> dict:
+    """A lobby as shown in the lobby browser"""
+    return {
+        "id": lobby.id,
+        "name": lobby.name,
+        "playerCount": len(lobby.players),
+        "maxPlayers": lobby.max_players,
+        "status": lobby.status,
+        "createdAt": lobby.created_at,
+        "elo_range": lobby.elo_range
+    }
+
+class ConnectionOutboxes:
+    """Bounded outbound queue per connection, each drained by its own writer task
+    
+    Broadcasting only appends to queues, so a slow or stalled socket delays nobody but
+    itself. When a queue is full the event's overflow policy decides what gives.
+    """
+    
+    def __init__(self, max_messages: int, send_timeout: float):
+        self.max_messages = max_messages
+        self.send_timeout = send_timeout
+        self.queues: Dict[str, deque] = {}  # client_id -> [event, coalesce key, message]
+        self.wakeups: Dict[str, asyncio.Event] = {}
+        self.writers: Dict[str, asyncio.Task] = {}
+        self.sockets: Dict[str, WebSocket] = {}
+        self.protocols: Dict[str, str] = {}  # client_id -> "json" or "msgpack"
+        self.sending_since: Dict[str, float] = {}  # client_id -> when its current send started
+        self.watchdog: Optional[asyncio.Task] = None
+        self.max_depth = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped: Dict[str, int] = {}  # event -> messages dropped
+        self.disconnected = 0
+        self.send_failures = 0
+    
+    def open(self, client_id: str, websocket: WebSocket, protocol: str = "json"):
+        self.protocols[client_id] = protocol
+        self.queues[client_id] = deque()
+        self.wakeups[client_id] = asyncio.Event()
+        self.sockets[client_id] = websocket
+        self.writers[client_id] = asyncio.ensure_future(self.drain(client_id))
+        if self.watchdog is None or self.watchdog.done():
+            self.watchdog = asyncio.ensure_future(self.watch_sends())
+    
+    def close(self, client_id: str):
+        """Stop the writer and discard anything still queued"""
+        self.sending_since.pop(client_id, None)
+        self.queues.pop(client_id, None)
+        self.wakeups.pop(client_id, None)
+        self.sockets.pop(client_id, None)
+        self.protocols.pop(client_id, None)
+        writer = self.writers.pop(client_id, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+    
+    def send(self, client_id: str, event: str, message, key=None):
+        """Queue an encoded message for client_id without waiting for the socket
+        
+        key (see coalesce_key) narrows coalescing to messages about the same entity.
+        """
+        queue = self.queues.get(client_id)
+        if queue is None:
+            return
+        policy = OUTBOX_OVERFLOW_POLICIES.get(event, OUTBOX_DEFAULT_POLICY)
+        self.enqueued += 1
+        
+        if policy == "coalesce":
+            for entry in queue:
+                if entry[0] == event and entry[1] == key:
+                    entry[2] = message
+                    self.coalesced += 1
+                    return
+        
+        if len(queue) >= self.max_messages and not self.make_room(client_id, queue, event, policy):
+            return
+        
+        queue.append([event, key, message])
+        self.max_depth = max(self.max_depth, len(queue))
+        self.wakeups[client_id].set()
+    
+    @staticmethod
+    def coalesce_key(event: str, data: dict):
+        field = OUTBOX_COALESCE_KEYS.get(event)
+        if field is None:
+            return None
+        return data.get(field)
+    
+    def make_room(self, client_id: str, queue: deque, event: str, policy: str) -> bool:
+        """Free a slot in a full queue, returning False if the new message can't be queued"""
+        if policy != "disconnect":
+            for entry in queue:
+                if OUTBOX_OVERFLOW_POLICIES.get(entry[0], OUTBOX_DEFAULT_POLICY) != "disconnect":
+                    queue.remove(entry)
+                    self.dropped[entry[0]] = self.dropped.get(entry[0], 0) + 1
+                    return True
+            self.dropped[event] = self.dropped.get(event, 0) + 1
+            return False
+        
+        print(f"Disconnecting slow consumer {client_id}: outbox full at {event}")
+        self.disconnected += 1
+        self.disconnect(client_id)
+        return False
+    
+    def disconnect(self, client_id: str):
+        websocket = self.sockets.get(client_id)
+        self.close(client_id)
+        if websocket is not None:
+            # The receive loop sees the close and runs the normal disconnect handling
+            asyncio.ensure_future(self.close_socket(websocket))
+    
+    async def close_socket(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=1013), timeout=self.send_timeout)
+        except Exception:
+            pass
+    
+    async def drain(self, client_id: str):
+        queue = self.queues[client_id]
+        wakeup = self.wakeups[client_id]
+        websocket = self.sockets[client_id]
+        while True:
+            if not queue:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            _, _, message = queue.popleft()
+            # No per-send timer: the watchdog disconnects sends that take too long
+            self.sending_since[client_id] = time.monotonic()
+            try:
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
+            except Exception:
+                self.send_failures += 1
+                self.close(client_id)
+                return
+            finally:
+                self.sending_since.pop(client_id, None)
+            self.sent += 1
+    
+    async def watch_sends(self):
+        """Disconnect clients whose socket has been stuck on one send for send_timeout"""
+        while self.queues:
+            await asyncio.sleep(min(1.0, self.send_timeout / 2))
+            deadline = time.monotonic() - self.send_timeout
+            for client_id, since in list(self.sending_since.items()):
+                if since < deadline:
+                    print(f"Disconnecting slow consumer {client_id}: send timed out")
+                    self.disconnected += 1
+                    self.disconnect(client_id)
+    
+    def stats(self) -> dict:
+        depths = sorted(((len(queue), client_id) for client_id, queue in self.queues.items()), reverse=True)
+        return {
+            "connections": len(self.queues),
+            "queuedMessages": sum(depth for depth, _ in depths),
+            "maxMessages": self.max_messages,
+            "maxDepthSeen": self.max_depth,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": dict(self.dropped),
+            "slowConsumersDisconnected": self.disconnected,
+            "sendFailures": self.send_failures,
+            "deepestQueues": [{"clientId": client_id, "depth": depth} for depth, client_id in depths[:5] if depth]
+        }
+
+outboxes = ConnectionOutboxes(OUTBOX_MAX_MESSAGES, OUTBOX_SEND_TIMEOUT)
+
+def send_frame(client_ids, event: str, data: dict, frames: Optional[dict] = None):
+    """Encode event once per protocol and queue the same frame for every client in client_ids
+    
+    frames caches the encodings (protocol -> frame) across calls for the same event.
+    """
+    frames = {} if frames is None else frames
+    key = outboxes.coalesce_key(event, data)
+    remote = None  # worker -> proxied clients connected there
+    for client_id in client_ids:
+        protocol = outboxes.protocols.get(client_id)
+        if protocol is None:
+            node = cluster.node_of(client_id)
+            if node is not None:
+                remote = remote or {}
+                remote.setdefault(node, []).append(client_id)
+            continue
+        if protocol not in frames:
+            frames[protocol] = encode_frame(event, data, protocol)
+        outboxes.send(client_id, event, frames[protocol], key)
+        frame_stats["deliveries"] += 1
+    if remote:
+        cluster.deliver(remote, event, data)
+
+fanout_stats = {"broadcasts": 0, "sharded": 0, "shards": 0}
+
+async def fan_out(client_ids: list, event: str, data: dict):
+    """Queue event for many clients, splitting big audiences into shard tasks
+    
+    Each shard queues its slice in one go, and the shards run in order, so the event
+    loop gets to other work between slices of a 10k audience.
+    """
+    fanout_stats["broadcasts"] += 1
+    if len(client_ids) <= FANOUT_SHARD_SIZE:
+        send_frame(client_ids, event, data)
+        return
+    
+    frames = {}
+    shards = [asyncio.ensure_future(fan_out_shard(client_ids[start:start + FANOUT_SHARD_SIZE], event, data, frames))
+              for start in range(0, len(client_ids), FANOUT_SHARD_SIZE)]
+    fanout_stats["sharded"] += 1
+    fanout_stats["shards"] += len(shards)
+    await asyncio.gather(*shards)
+
+async def fan_out_shard(client_ids: list, event: str, data: dict, frames: dict):
+    send_frame(client_ids, event, data, frames)
+
 async def broadcast_to_all(event: str, data: dict):
     """Broadcast event to all connected clients"""
     if not connections:
         return
     
-    message = json.dumps({"event": event, "data": data})
-    disconnected = []
-    
-    for client_id, websocket in connections.items():
-        try:
-            await websocket.send_text(message)
-        except:
-            disconnected.append(client_id)
-    
-    # Clean up disconnected clients
-    for client_id in disconnected:
-        if client_id in connections:
-            del connections[client_id]
-        if client_id in players:
-            del players[client_id]
+    await fan_out(list(connections), event, data)
+
+def lobby_recipients(lobby: Lobby) -> list:
+    """Players and spectators of a lobby"""
+    return [*lobby.players, *lobby.spectators]
 
 async def broadcast_to_lobby(lobby_id: str, event: str, data: dict):
     """Broadcast event to all players in a specific lobby"""
     if lobby_id not in lobbies:
         return
     
-    lobby = lobbies[lobby_id]
-    message = json.dumps({"event": event, "data": data})
-    
-    # Send to players
-    for player in lobby["players"]:
-        player_id = player["id"]
-        if player_id in connections:
-            try:
-                await connections[player_id].send_text(message)
-            except:
-                pass
-    
-    # Also send to spectators (so they can watch in real-time)
-    spectators = lobby.get("spectators", [])
-    for spectator in spectators:
-        spectator_id = spectator["id"]
-        if spectator_id in connections:
-            try:
-                await connections[spectator_id].send_text(message)
-            except:
-                pass
+    # Players, and spectators too (so they can watch in real-time)
+    await fan_out(lobby_recipients(lobbies[lobby_id]), event, event_log.append(lobby_id, event, data))
+
+async def send_to_player(lobby_id: str, client_id: str, event: str, data: dict):
+    """Send one player of a lobby an event they should still get if they resume a dropped session"""
+    if lobby_id in lobbies:
+        data = event_log.append(lobby_id, event, data, client_id)
+    await send_to_client(client_id, event, data)
 
 async def send_to_client(client_id: str, event: str, data: dict):
     """Send event to a specific client"""
-    if client_id not in connections:
+    if client_id not in connections and cluster.node_of(client_id) is None:
         return
     
-    message = json.dumps({"event": event, "data": data})
-    try:
-        await connections[client_id].send_text(message)
-    except:
-        pass
+    send_frame((client_id,), event, data)
 
 def get_public_lobbies(search: str = "", page: int = 1, per_page: int = 4) -> Dict:
     """Get paginated list of public lobbies with search"""
-    # Filter public lobbies in waiting status
-    public_lobbies = [
-        lobby for lobby in lobbies.values() 
-        if lobby["type"] == "public" and lobby["status"] == "waiting"
-    ]
-    
-    # Apply search filter if provided
-    if search:
-        search_lower = search.lower()
-        public_lobbies = [
-            lobby for lobby in public_lobbies
-            if search_lower in lobby["name"].lower()
-        ]
-    
-    # Sort by creation time (newest first)
-    public_lobbies.sort(key=lambda x: x["createdAt"], reverse=True)
+    # Public waiting lobbies (filtered by search) come from the registry, newest first
+    listed = lobby_registry.listing(search)
     
     # Apply pagination
-    total_lobbies = len(public_lobbies)
+    total_lobbies = len(listed)
     total_pages = max(1, (total_lobbies + per_page - 1) // per_page)
     
     # Ensure page is valid
@@ -134,19 +836,13 @@ def get_public_lobbies(search: str = "", page: int = 1, per_page: int = 4) -> Di
     
     start_idx = (page - 1) * per_page
     end_idx = start_idx + per_page
-    page_lobbies = public_lobbies[start_idx:end_idx]
+    # Lobbies of other workers are listed from their mirrored entries
+    page_lobbies = [lobby_list_entry(lobbies[lobby_id]) if lobby_id in lobbies else cluster.listed[lobby_id]
+                    for _, lobby_id in listed[start_idx:end_idx]]
     
     # Return lobby data without sensitive info
     return {
-        "lobbies": [{
-            "id": lobby["id"],
-            "name": lobby["name"],
-            "playerCount": len(lobby["players"]),
-            "maxPlayers": lobby["maxPlayers"],
-            "status": lobby["status"],
-            "createdAt": lobby["createdAt"],
-            "elo_range": lobby.get("elo_range", "easy")
-        } for lobby in page_lobbies],
+        "lobbies": page_lobbies,
         "pagination": {
             "currentPage": page,
             "totalPages": total_pages,
@@ -156,131 +852,2908 @@ def get_public_lobbies(search: str = "", page: int = 1, per_page: int = 4) -> Di
         "search": search
     }
 
+class LobbyListFeed:
+    """Pushes lobby browser changes to subscribed clients as diffs
+    
+    Each subscriber watches one page of one search. Changes are coalesced: the first
+    change schedules a flush after the debounce window and later changes ride along,
+    so a subscriber gets at most one push per window. Subscribers looking at the same
+    page and search share one listing computation.
+    """
+    
+    def __init__(self, debounce: float):
+        self.debounce = debounce
+        self.subscribers: Dict[str, dict] = {}  # client_id -> {"page", "search", "lobbies", "order", "pagination"}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.changes = 0
+        self.flushes = 0
+        self.pushes = 0
+    
+    def subscribe(self, client_id: str, page: int, search: str) -> dict:
+        """Start (or retarget) a subscription and return the full listing to send first"""
+        lobby_data = get_public_lobbies(search=search, page=page)
+        self.subscribers[client_id] = {"page": page, "search": search}
+        self.remember(self.subscribers[client_id], lobby_data)
+        return lobby_data
+    
+    def unsubscribe(self, client_id: str):
+        self.subscribers.pop(client_id, None)
+    
+    def remember(self, subscriber: dict, lobby_data: dict):
+        subscriber["lobbies"] = {lobby["id"]: lobby for lobby in lobby_data["lobbies"]}
+        subscriber["order"] = [lobby["id"] for lobby in lobby_data["lobbies"]]
+        subscriber["pagination"] = lobby_data["pagination"]
+    
+    def mark_changed(self):
+        """Note that the listing changed and make sure a flush is scheduled"""
+        self.changes += 1
+        if self.subscribers and self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+    
+    async def flush_later(self):
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            self.flush_task = None
+        await self.flush()
+    
+    def diff(self, subscriber: dict, lobby_data: dict) -> Optional[dict]:
+        """What changed since the subscriber's last push, or None if nothing did"""
+        previous = subscriber["lobbies"]
+        current = {lobby["id"]: lobby for lobby in lobby_data["lobbies"]}
+        order = [lobby["id"] for lobby in lobby_data["lobbies"]]
+        
+        added = [lobby for lobby_id, lobby in current.items() if lobby_id not in previous]
+        removed = [lobby_id for lobby_id in previous if lobby_id not in current]
+        changed = [lobby for lobby_id, lobby in current.items()
+                   if lobby_id in previous and previous[lobby_id] != lobby]
+        
+        if (not added and not removed and not changed and order == subscriber["order"]
+                and lobby_data["pagination"] == subscriber["pagination"]):
+            return None
+        return {
+            "added": added,
+            "removed": removed,
+            "changed": changed,
+            "order": order,
+            "pagination": lobby_data["pagination"],
+            "search": lobby_data["search"]
+        }
+    
+    async def flush(self):
+        """Send every subscriber the diff between what it has and the current listing"""
+        self.flushes += 1
+        views: Dict[tuple, dict] = {}  # (search, page) -> listing
+        for client_id, subscriber in list(self.subscribers.items()):
+            key = (subscriber["search"], subscriber["page"])
+            if key not in views:
+                views[key] = get_public_lobbies(search=subscriber["search"], page=subscriber["page"])
+            lobby_data = views[key]
+            
+            update = self.diff(subscriber, lobby_data)
+            if update is None:
+                continue
+            self.remember(subscriber, lobby_data)
+            self.pushes += 1
+            await send_to_client(client_id, "lobby_list_diff", update)
+    
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "debounceMs": round(self.debounce * 1000, 3),
+            "changes": self.changes,
+            "flushes": self.flushes,
+            "pushes": self.pushes
+        }
+
+lobby_list_feed = LobbyListFeed(LOBBY_LIST_DEBOUNCE)
+
 async def broadcast_lobby_list_update():
-    """Broadcast updated lobby list to all connected clients"""
-    try:
-        lobby_data = get_public_lobbies(search="", page=1)
-        await broadcast_to_all("lobby_list_update", lobby_data)
-        print(f"Broadcasted lobby list update: {len(lobby_data['lobbies'])} lobbies")
-    except Exception as e:
-        print(f"Failed to broadcast lobby list update: {e}")
+    """Push the lobby list change to lobby browser subscribers (coalesced), and to other workers"""
+    lobby_list_feed.mark_changed()
+    cluster.listing_changed()
 
-# Judge0 functions (same as before)
-async def judge0_submit_code(code: str, test_cases: list) -> dict:
-    """Submit code to Judge0 API and return test results"""
-    print(f"DEBUG: JUDGE0_API_KEY exists: {JUDGE0_API_KEY is not None}")
-    print(f"DEBUG: JUDGE0_API_HOST: {JUDGE0_API_HOST}")
-    print(f"DEBUG: JUDGE0_BASE_URL: {JUDGE0_BASE_URL}")
-    
-    if not JUDGE0_API_KEY:
-        print("Warning: Judge0 API key not configured, using fake results")
-        return run_fake_tests(code)
+def utf16_length(text: str) -> int:
+    """Length of text in UTF-16 code units, which is how browsers index strings"""
+    return len(text.encode("utf-16-le")) // 2
+
+def text_delta(old: str, new: str) -> dict:
+    """Single splice turning old into new: replace deleteCount units at start with insert
     
-    headers = {
-        "X-RapidAPI-Key": JUDGE0_API_KEY,
-        "X-RapidAPI-Host": JUDGE0_API_HOST,
-        "Content-Type": "application/json"
+    Offsets are UTF-16 code units so the browser can apply them with slice().
+    """
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    return {
+        "start": utf16_length(old[:prefix]),
+        "deleteCount": utf16_length(old[prefix:len(old) - suffix]),
+        "insert": new[prefix:len(new) - suffix]
     }
+
+class LiveCodeStreams:
+    """Streams players' editors to spectators as throttled, sequenced diffs
+    
+    Each player's stream remembers the last version sent. Keystrokes only update the
+    latest version; a flush at most every 1/rate seconds sends a live_code_delta
+    (or a full live_code_update snapshot once snapshot_interval has passed). Every
+    message bumps seq, so a spectator that sees a gap asks for a snapshot. Spectators
+    watch every player unless they pick some with watch_live_code.
+    """
+    
+    def __init__(self, rate: float, snapshot_interval: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.snapshot_interval = snapshot_interval
+        self.streams: Dict[str, Dict[str, dict]] = {}  # lobby_id -> player_id -> stream
+        self.watching: Dict[str, Set[str]] = {}  # spectator client_id -> watched player ids
+        self.updates = 0
+        self.deltas = 0
+        self.snapshots = 0
+        self.bytes_sent = 0
+        self.bytes_full = 0  # what sending full code every time would have cost
+    
+    def update(self, lobby_id: str, player_id: str, player_name: str, code: str):
+        """Record the player's latest code and schedule a flush if none is pending"""
+        stream = self.streams.setdefault(lobby_id, {}).setdefault(player_id, {
+            "name": player_name, "code": "", "sent": None, "seq": 0,
+            "flush_task": None, "last_flush": 0.0, "last_snapshot": 0.0
+        })
+        stream["code"] = code
+        self.updates += 1
+        if stream["flush_task"] is None:
+            delay = max(0.0, stream["last_flush"] + self.interval - time.monotonic())
+            stream["flush_task"] = asyncio.ensure_future(self.flush_later(lobby_id, player_id, stream, delay))
+    
+    async def flush_later(self, lobby_id: str, player_id: str, stream: dict, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            stream["flush_task"] = None
+        self.flush(lobby_id, player_id, stream)
+    
+    def flush(self, lobby_id: str, player_id: str, stream: dict):
+        if stream["code"] == stream["sent"]:
+            return
+        now = time.monotonic()
+        stream["seq"] += 1
+        stream["last_flush"] = now
+        recipients = self.recipients(lobby_id, player_id)
+        
+        if stream["sent"] is None or now - stream["last_snapshot"] >= self.snapshot_interval:
+            stream["last_snapshot"] = now
+            update = self.snapshot(player_id, stream, stream["code"])
+            self.snapshots += 1
+            send_frame(recipients, "live_code_update", update)
+        else:
+            update = {"player_id": player_id, "seq": stream["seq"], **text_delta(stream["sent"], stream["code"])}
+            self.deltas += 1
+            send_frame(recipients, "live_code_delta", update)
+        stream["sent"] = stream["code"]
+        
+        self.bytes_sent += len(update.get("insert", update.get("code", ""))) * len(recipients)
+        self.bytes_full += len(stream["code"]) * len(recipients)
+    
+    def snapshot(self, player_id: str, stream: dict, code: str) -> dict:
+        return {"player_id": player_id, "player_name": stream["name"], "code": code, "seq": stream["seq"]}
+    
+    def recipients(self, lobby_id: str, player_id: str) -> list:
+        """Spectators of the lobby watching player_id"""
+        if lobby_id not in lobbies:
+            return []
+        return [spectator_id for spectator_id in lobbies[lobby_id].spectators
+                if player_id in self.watching.get(spectator_id, (player_id,))]
+    
+    def send_snapshots(self, client_id: str, lobby_id: str, player_ids=None):
+        """Bring one spectator up to date with the last version sent of each stream"""
+        for player_id, stream in self.streams.get(lobby_id, {}).items():
+            if stream["sent"] is None or (player_ids is not None and player_id not in player_ids):
+                continue
+            send_frame((client_id,), "live_code_update", self.snapshot(player_id, stream, stream["sent"]))
+    
+    def watch(self, client_id: str, lobby_id: str, player_ids: Optional[list]):
+        """Limit a spectator to some players' streams (None watches everyone)"""
+        if player_ids is None:
+            self.watching.pop(client_id, None)
+        else:
+            self.watching[client_id] = set(player_ids)
+        self.send_snapshots(client_id, lobby_id, player_ids)
+    
+    def forget_spectator(self, client_id: str):
+        self.watching.pop(client_id, None)
+    
+    def discard_player(self, lobby_id: str, player_id: str):
+        stream = self.streams.get(lobby_id, {}).pop(player_id, None)
+        if stream is not None and stream["flush_task"] is not None:
+            stream["flush_task"].cancel()
+    
+    def discard_lobby(self, lobby_id: str):
+        for player_id in list(self.streams.get(lobby_id, {})):
+            self.discard_player(lobby_id, player_id)
+        self.streams.pop(lobby_id, None)
+    
+    def stats(self) -> dict:
+        return {
+            "streams": sum(len(streams) for streams in self.streams.values()),
+            "rateHz": round(1 / self.interval, 3) if self.interval else None,
+            "snapshotIntervalSeconds": self.snapshot_interval,
+            "updatesReceived": self.updates,
+            "deltasSent": self.deltas,
+            "snapshotsSent": self.snapshots,
+            "codeBytesSent": self.bytes_sent,
+            "codeBytesFullText": self.bytes_full
+        }
+
+live_code = LiveCodeStreams(LIVE_CODE_RATE, LIVE_CODE_SNAPSHOT_INTERVAL)
+
+class EmojiAggregator:
+    """Collects spectator emoji per lobby and sends players one frame per tick
+    
+    A hype moment with hundreds of spectators becomes a handful of counts per tick
+    instead of one frame per reaction per player.
+    """
+    
+    def __init__(self, tick: float, max_kinds: int):
+        self.tick = tick
+        self.max_kinds = max_kinds
+        self.pending: Dict[str, Dict[str, dict]] = {}  # lobby_id -> emoji -> {"count", "spectatorName"}
+        self.flush_tasks: Dict[str, asyncio.Task] = {}
+        self.received = 0
+        self.dropped = 0
+        self.frames = 0
+    
+    def add(self, lobby_id: str, emoji: str, spectator_name: str):
+        self.received += 1
+        reactions = self.pending.setdefault(lobby_id, {})
+        if emoji not in reactions and len(reactions) >= self.max_kinds:
+            self.dropped += 1
+            return
+        reaction = reactions.setdefault(emoji, {"count": 0, "spectatorName": spectator_name})
+        reaction["count"] += 1
+        reaction["spectatorName"] = spectator_name  # most recent sender
+        if lobby_id not in self.flush_tasks:
+            self.flush_tasks[lobby_id] = asyncio.ensure_future(self.flush_later(lobby_id))
+    
+    async def flush_later(self, lobby_id: str):
+        try:
+            await asyncio.sleep(self.tick)
+        finally:
+            self.flush_tasks.pop(lobby_id, None)
+        self.flush(lobby_id)
+    
+    def flush(self, lobby_id: str):
+        reactions = self.pending.pop(lobby_id, None)
+        if not reactions or lobby_id not in lobbies:
+            return
+        self.frames += 1
+        send_frame(list(lobbies[lobby_id].players), "spectator_emoji_reactions", {
+            "reactions": [{"emoji": emoji, **reaction} for emoji, reaction in reactions.items()]
+        })
+    
+    def discard_lobby(self, lobby_id: str):
+        self.pending.pop(lobby_id, None)
+        task = self.flush_tasks.pop(lobby_id, None)
+        if task is not None:
+            task.cancel()
+    
+    def stats(self) -> dict:
+        return {
+            "tickMs": round(self.tick * 1000, 3),
+            "received": self.received,
+            "dropped": self.dropped,
+            "framesSent": self.frames,
+            "lobbiesPending": len(self.pending)
+        }
+
+emoji_reactions = EmojiAggregator(EMOJI_TICK, EMOJI_MAX_KINDS)
+
+class SpectatorRosters:
+    """Spectator joins and leaves, sent to the audience as batched deltas
+    
+    Sending every spectator the whole roster on each join is quadratic in the
+    audience. Instead the changes of one tick go out as a single delta with the
+    viewer count, and clients page through the full roster when they want it.
+    Deltas carry a per-lobby seq so a client that missed one (or got a truncated
+    one) knows to fetch the roster again; pages carry the seq they reflect.
+    """
+    
+    def __init__(self, tick: float):
+        self.tick = tick
+        self.pending: Dict[str, dict] = {}  # lobby_id -> {"joined": {id: public spectator}, "left": set of ids}
+        self.flush_tasks: Dict[str, asyncio.Task] = {}
+        self.seqs: Dict[str, int] = {}  # lobby_id -> seq of the last delta sent
+        self.deltas = 0
+    
+    def add(self, lobby: Lobby, spectator: Player):
+        lobby.spectators[spectator.id] = spectator
+        changes = self.changes(lobby.id)
+        changes["left"].discard(spectator.id)
+        changes["joined"][spectator.id] = public_spectator(spectator)
+    
+    def remove(self, lobby: Lobby, client_id: str) -> bool:
+        if lobby.spectators.pop(client_id, None) is None:
+            return False
+        changes = self.changes(lobby.id)
+        if changes["joined"].pop(client_id, None) is None:
+            changes["left"].add(client_id)
+        return True
+    
+    def changes(self, lobby_id: str) -> dict:
+        if lobby_id not in self.flush_tasks:
+            self.flush_tasks[lobby_id] = asyncio.ensure_future(self.flush_later(lobby_id))
+        return self.pending.setdefault(lobby_id, {"joined": {}, "left": set()})
+    
+    async def flush_later(self, lobby_id: str):
+        try:
+            await asyncio.sleep(self.tick)
+        finally:
+            self.flush_tasks.pop(lobby_id, None)
+        await self.flush(lobby_id)
+    
+    async def flush(self, lobby_id: str):
+        changes = self.pending.pop(lobby_id, None)
+        if not changes or lobby_id not in lobbies:
+            return
+        if not changes["joined"] and not changes["left"]:
+            return
+        spectators = lobbies[lobby_id].spectators
+        joined = list(changes["joined"].values())
+        left = list(changes["left"])
+        self.deltas += 1
+        seq = self.seqs[lobby_id] = self.seqs.get(lobby_id, 0) + 1
+        # A rush of joins would make every copy of the delta huge; past a page, clients
+        # that keep a roster are told to fetch it again
+        await fan_out(list(spectators), "spectator_roster_delta", {
+            "joined": joined[:SPECTATOR_ROSTER_PAGE_SIZE],
+            "left": left[:SPECTATOR_ROSTER_PAGE_SIZE],
+            "truncated": max(len(joined), len(left)) > SPECTATOR_ROSTER_PAGE_SIZE,
+            "viewerCount": len(spectators),
+            "seq": seq
+        })
+    
+    def page(self, lobby: Lobby, page: int) -> dict:
+        """One page of the roster, in join order"""
+        spectators = lobby.spectators
+        total_pages = max(1, (len(spectators) + SPECTATOR_ROSTER_PAGE_SIZE - 1) // SPECTATOR_ROSTER_PAGE_SIZE)
+        page = max(1, min(page, total_pages))
+        start = (page - 1) * SPECTATOR_ROSTER_PAGE_SIZE
+        return {
+            "spectators": [public_spectator(spectator) for spectator in
+                           itertools.islice(spectators.values(), start, start + SPECTATOR_ROSTER_PAGE_SIZE)],
+            "pagination": {
+                "currentPage": page,
+                "totalPages": total_pages,
+                "perPage": SPECTATOR_ROSTER_PAGE_SIZE
+            },
+            "viewerCount": len(spectators),
+            "seq": self.seqs.get(lobby.id, 0)
+        }
+    
+    def discard_lobby(self, lobby_id: str):
+        self.pending.pop(lobby_id, None)
+        self.seqs.pop(lobby_id, None)
+        task = self.flush_tasks.pop(lobby_id, None)
+        if task is not None:
+            task.cancel()
+    
+    def stats(self) -> dict:
+        audiences = [len(lobby.spectators) for lobby in lobbies.values()]
+        return {
+            "spectators": sum(audiences),
+            "largestAudience": max(audiences, default=0),
+            "rosterDeltasSent": self.deltas,
+            "fanOut": dict(fanout_stats, shardSize=FANOUT_SHARD_SIZE)
+        }
+
+spectator_rosters = SpectatorRosters(SPECTATOR_ROSTER_TICK)
+
+class SpectatorChat:
+    """Spectator chat with bounded memory and fan-out
+    
+    Each lobby keeps its last history_size messages for late joiners. Senders spend
+    tokens from a bucket that refills at rate per second, and the messages of one
+    tick go to the audience as a single spectator_chat_messages frame.
+    """
+    
+    def __init__(self, history_size: int, rate: float, burst: int, tick: float):
+        self.history_size = history_size
+        self.rate = rate
+        self.burst = burst
+        self.tick = tick
+        self.history: Dict[str, deque] = {}  # lobby_id -> recent messages
+        self.pending: Dict[str, deque] = {}  # lobby_id -> messages waiting for the tick
+        self.buckets: Dict[str, list] = {}  # client_id -> [tokens, last refill]
+        self.flush_tasks: Dict[str, asyncio.Task] = {}
+        self.accepted = 0
+        self.rate_limited = 0
+        self.frames = 0
+    
+    def allow(self, client_id: str) -> bool:
+        """Take a token from the sender's bucket"""
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(client_id, [float(self.burst), now])
+        bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            self.rate_limited += 1
+            return False
+        bucket[0] -= 1
+        return True
+    
+    def post(self, lobby_id: str, spectator_name: str, message: str):
+        entry = {"spectatorName": spectator_name, "message": message, "timestamp": time.time()}
+        self.accepted += 1
+        self.history.setdefault(lobby_id, deque(maxlen=self.history_size)).append(entry)
+        self.pending.setdefault(lobby_id, deque(maxlen=self.history_size)).append(entry)
+        if lobby_id not in self.flush_tasks:
+            self.flush_tasks[lobby_id] = asyncio.ensure_future(self.flush_later(lobby_id))
+    
+    async def flush_later(self, lobby_id: str):
+        try:
+            await asyncio.sleep(self.tick)
+        finally:
+            self.flush_tasks.pop(lobby_id, None)
+        await self.flush(lobby_id)
+    
+    async def flush(self, lobby_id: str):
+        messages = self.pending.pop(lobby_id, None)
+        if not messages or lobby_id not in lobbies:
+            return
+        self.frames += 1
+        await broadcast_to_spectators(lobby_id, "spectator_chat_messages", {"messages": list(messages)})
+    
+    def recent(self, lobby_id: str) -> list:
+        """The conversation so far, for catching up a late joiner"""
+        return list(self.history.get(lobby_id, ()))
+    
+    def forget_sender(self, client_id: str):
+        self.buckets.pop(client_id, None)
+    
+    def discard_lobby(self, lobby_id: str):
+        self.history.pop(lobby_id, None)
+        self.pending.pop(lobby_id, None)
+        task = self.flush_tasks.pop(lobby_id, None)
+        if task is not None:
+            task.cancel()
+    
+    def stats(self) -> dict:
+        return {
+            "lobbiesWithHistory": len(self.history),
+            "historySize": self.history_size,
+            "accepted": self.accepted,
+            "rateLimited": self.rate_limited,
+            "framesSent": self.frames
+        }
+
+spectator_chat = SpectatorChat(CHAT_HISTORY_SIZE, CHAT_RATE, CHAT_BURST, CHAT_TICK)
+
+class TimerWheel:
+    """Hashed timer wheel driven by one task
+    
+    Timers land in slot (tick % slots) with their absolute target tick, so scheduling
+    and cancelling are dict operations and each tick only looks at one slot. The
+    driver sleeps to the next tick boundary against the loop clock and catches up on
+    every tick it missed, so a slow tick delays timers instead of dropping them.
+    """
+    
+    def __init__(self, resolution: float, slots: int):
+        self.resolution = resolution
+        self.slots: List[Dict[int, tuple]] = [{} for _ in range(slots)]
+        self.timers: Dict[int, int] = {}  # timer id -> slot index
+        self.next_id = 0
+        self.origin: Optional[float] = None
+        self.tick = 0  # last tick processed
+        self.driver: Optional[asyncio.Task] = None
+        self.fired = 0
+        self.cancelled = 0
+        self.max_lateness = 0.0
+    
+    def now_tick(self) -> int:
+        loop = asyncio.get_event_loop()
+        if self.origin is None:
+            self.origin = loop.time()
+        return int((loop.time() - self.origin) / self.resolution)
+    
+    def schedule(self, delay: float, callback, *args) -> int:
+        """Run the coroutine function callback(*args) after delay seconds"""
+        if self.driver is None:
+            self.tick = self.now_tick()
+        target = max(self.tick + 1, self.now_tick() + math.ceil(delay / self.resolution))
+        self.next_id += 1
+        slot = target % len(self.slots)
+        self.slots[slot][self.next_id] = (target, callback, args)
+        self.timers[self.next_id] = slot
+        if self.driver is None:
+            self.driver = asyncio.ensure_future(self.drive())
+        return self.next_id
+    
+    def cancel(self, timer_id: int) -> bool:
+        slot = self.timers.pop(timer_id, None)
+        if slot is None:
+            return False
+        del self.slots[slot][timer_id]
+        self.cancelled += 1
+        return True
+    
+    async def drive(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self.timers:
+                await asyncio.sleep(max(0.0, self.origin + (self.tick + 1) * self.resolution - loop.time()))
+                now = self.now_tick()
+                while self.tick < now:
+                    self.tick += 1
+                    self.expire(self.tick, loop.time())
+        finally:
+            self.driver = None
+    
+    def expire(self, tick: int, now: float):
+        slot = self.slots[tick % len(self.slots)]
+        due = [timer_id for timer_id, (target, _, _) in slot.items() if target <= tick]
+        for timer_id in due:
+            target, callback, args = slot.pop(timer_id)
+            del self.timers[timer_id]
+            self.fired += 1
+            self.max_lateness = max(self.max_lateness, now - (self.origin + target * self.resolution))
+            asyncio.ensure_future(self.run(callback, args))
+    
+    async def run(self, callback, args: tuple):
+        try:
+            await callback(*args)
+        except Exception as e:
+            print(f"Timer callback {getattr(callback, '__name__', callback)} failed: {e}")
+    
+    def stats(self) -> dict:
+        return {
+            "resolutionMs": self.resolution * 1000,
+            "slots": len(self.slots),
+            "pending": len(self.timers),
+            "fired": self.fired,
+            "cancelled": self.cancelled,
+            "maxLatenessMs": round(self.max_lateness * 1000, 1)
+        }
+
+class GameScheduler:
+    """Named per-lobby game timers (countdown, deadline) on a shared timer wheel
+    
+    Scheduling a name again replaces the previous timer, and discarding a lobby
+    cancels everything it had pending.
+    """
+    
+    def __init__(self, wheel: TimerWheel):
+        self.wheel = wheel
+        self.timers: Dict[str, Dict[str, int]] = {}  # lobby_id -> name -> timer id
+    
+    def schedule(self, lobby_id: str, name: str, delay: float, callback, *args):
+        self.cancel(lobby_id, name)
+        self.timers.setdefault(lobby_id, {})[name] = self.wheel.schedule(delay, self.fire, lobby_id, name, callback, args)
+    
+    async def fire(self, lobby_id: str, name: str, callback, args: tuple):
+        timers = self.timers.get(lobby_id, {})
+        timers.pop(name, None)
+        if not timers:
+            self.timers.pop(lobby_id, None)
+        await callback(*args)
+    
+    def pending(self, lobby_id: str, name: str) -> bool:
+        return name in self.timers.get(lobby_id, {})
+    
+    def cancel(self, lobby_id: str, name: str) -> bool:
+        timers = self.timers.get(lobby_id)
+        if not timers or name not in timers:
+            return False
+        self.wheel.cancel(timers.pop(name))
+        if not timers:
+            del self.timers[lobby_id]
+        return True
+    
+    def cancel_lobby(self, lobby_id: str):
+        for timer_id in self.timers.pop(lobby_id, {}).values():
+            self.wheel.cancel(timer_id)
+    
+    def stats(self) -> dict:
+        return {
+            "lobbiesWithTimers": len(self.timers),
+            **self.wheel.stats()
+        }
+
+game_scheduler = GameScheduler(TimerWheel(GAME_TIMER_RESOLUTION, GAME_TIMER_SLOTS))
+
+def delete_lobby(lobby_id: str):
+    """Remove a lobby and everything the real-time features keep for it"""
+    lobbies.pop(lobby_id, None)
+    lobby_registry.discard(lobby_id)
+    live_code.discard_lobby(lobby_id)
+    emoji_reactions.discard_lobby(lobby_id)
+    spectator_rosters.discard_lobby(lobby_id)
+    spectator_chat.discard_lobby(lobby_id)
+    game_scheduler.cancel_lobby(lobby_id)
+    event_log.discard_lobby(lobby_id)
+    cluster.release_lobby(lobby_id)
+
+class LifecycleReaper:
+    """Background sweep that keeps weeks of uptime from accumulating state
+    
+    Each sweep drops clients that have been silent for heartbeat_timeout (a half-dead
+    socket never delivers a disconnect), reconciles players, connections and lobby
+    membership, expires lobbies finished_ttl after their game ended, and pings
+    everyone so idle but healthy clients answer with a pong.
+    """
+    
+    def __init__(self, interval: float, heartbeat_timeout: float, finished_ttl: float):
+        self.interval = interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.finished_ttl = finished_ttl
+        self.last_seen: Dict[str, float] = {}  # client_id -> monotonic time of its last message
+        self.task: Optional[asyncio.Task] = None
+        self.sweeps = 0
+        self.reaped = {"silentClients": 0, "staleClients": 0, "ghostMembers": 0,
+                       "orphanedPlayers": 0, "finishedLobbies": 0, "abandonedLobbies": 0}
+    
+    def seen(self, client_id: str):
+        self.last_seen[client_id] = time.monotonic()
+    
+    def forget(self, client_id: str):
+        self.last_seen.pop(client_id, None)
+    
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Lifecycle sweep failed: {e}")
+    
+    async def sweep(self):
+        self.sweeps += 1
+        await cluster.sweep()
+        await self.drop_silent_clients()
+        lobby_list_changed = await self.reconcile()
+        lobby_list_changed = await self.expire_lobbies() or lobby_list_changed
+        if lobby_list_changed:
+            await broadcast_lobby_list_update()
+        await fan_out(list(connections), "ping", {"timestamp": time.time()})
+    
+    async def drop_client(self, client_id: str):
+        websocket = connections.get(client_id)
+        outboxes.close(client_id)
+        if websocket is not None:
+            asyncio.ensure_future(outboxes.close_socket(websocket))
+        await handle_disconnect(client_id)
+    
+    async def drop_silent_clients(self):
+        deadline = time.monotonic() - self.heartbeat_timeout
+        for client_id, seen in list(self.last_seen.items()):
+            if seen < deadline:
+                print(f"Dropping {client_id}: no heartbeat for {self.heartbeat_timeout:g}s")
+                self.reaped["silentClients"] += 1
+                await self.drop_client(client_id)
+    
+    async def reconcile(self) -> bool:
+        """Bring connections, players and lobby membership back in line, returning True if a lobby went away"""
+        # Connections whose writer died on a failed send, or that lost their player record
+        for client_id in list(connections):
+            if client_id not in outboxes.queues or client_id not in players:
+                self.reaped["staleClients"] += 1
+                await self.drop_client(client_id)
+        # (proxies for clients connected to another worker have no connection here, and
+        # players waiting out their resume grace have none for now)
+        for client_id in [client_id for client_id, player in players.items()
+                          if client_id not in connections and player.node is None
+                          and client_id not in sessions.held]:
+            self.reaped["staleClients"] += 1
+            await handle_disconnect(client_id)
+        
+        for player in list(players.values()):
+            if player.lobby and player.lobby not in lobbies:
+                self.reaped["orphanedPlayers"] += 1
+                player.unseat()
+                if player.node is not None:
+                    # Tell the client's own worker, so it stops sending its events here
+                    await send_to_client(player.id, "lobby_left", {"message": "Lobby closed"})
+        
+        lobby_deleted = False
+        for lobby_id, lobby in list(lobbies.items()):
+            for spectator_id in [spectator_id for spectator_id, spectator in lobby.spectators.items()
+                                 if not self.seated(lobby_id, spectator)]:
+                self.reaped["ghostMembers"] += 1
+                spectator_rosters.remove(lobby, spectator_id)
+                live_code.forget_spectator(spectator_id)
+            
+            ghosts = [player for player in lobby.players.values() if not self.seated(lobby_id, player)]
+            if not ghosts:
+                continue
+            self.reaped["ghostMembers"] += len(ghosts)
+            for ghost in ghosts:
+                del lobby.players[ghost.id]
+                live_code.discard_player(lobby_id, ghost.id)
+            
+            if not lobby.players:
+                self.reaped["abandonedLobbies"] += 1
+                delete_lobby(lobby_id)
+                lobby_deleted = True
+                print(f"Lobby {lobby_id} deleted - abandoned")
+                continue
+            await cancel_countdown(lobby_id)
+            await broadcast_to_lobby(lobby_id, "player_left", {
+                "playerName": ghosts[0].name,
+                "playerCount": len(lobby.players),
+                "players": public_players(lobby)
+            })
+        return lobby_deleted
+    
+    @staticmethod
+    def seated(lobby_id: str, member: Player) -> bool:
+        """Whether a lobby member is still a connected client that points back at the lobby"""
+        return players.get(member.id) is member and member.lobby == lobby_id
+    
+    async def expire_lobbies(self) -> bool:
+        """Close lobbies whose game ended finished_ttl ago, sending everyone still inside back out"""
+        now = time.time()
+        expired = [lobby_id for lobby_id, lobby in lobbies.items()
+                   if lobby.status == "finished" and now - lobby.ended_at >= self.finished_ttl]
+        for lobby_id in expired:
+            for client_id in lobby_recipients(lobbies[lobby_id]):
+                player = players.get(client_id)
+                if player is not None and player.lobby == lobby_id:
+                    player.unseat()
+                    live_code.forget_spectator(client_id)
+                    await send_to_client(client_id, "lobby_left", {"message": "Lobby closed"})
+            delete_lobby(lobby_id)
+            self.reaped["finishedLobbies"] += 1
+            print(f"Lobby {lobby_id} expired")
+        return bool(expired)
+    
+    def gauges(self) -> dict:
+        """Sizes of the long-lived structures, which should stay flat over time"""
+        statuses = {}
+        for lobby in lobbies.values():
+            statuses[lobby.status] = statuses.get(lobby.status, 0) + 1
+        return {
+            "lobbies": len(lobbies),
+            "lobbiesByStatus": statuses,
+            "connections": len(connections),
+            "players": len(players),
+            "heartbeats": len(self.last_seen),
+            "outboxes": len(outboxes.queues),
+            "lobbyRegistry": len(lobby_registry.keys),
+            "lobbyRegistryNgrams": len(lobby_registry.ngrams),
+            "lobbyListSubscribers": len(lobby_list_feed.subscribers),
+            "liveCodeLobbies": len(live_code.streams),
+            "liveCodeWatchers": len(live_code.watching),
+            "emojiPendingLobbies": len(emoji_reactions.pending),
+            "rosterPendingLobbies": len(spectator_rosters.pending),
+            "chatHistories": len(spectator_chat.history),
+            "chatBuckets": len(spectator_chat.buckets),
+            "gameTimers": len(game_scheduler.wheel.timers),
+            "eventLogs": len(event_log.logs),
+            "resumeTokens": len(sessions.tokens),
+            "heldSessions": len(sessions.held),
+            "verdictCacheEntries": len(verdict_cache.entries),
+            "queuedSubmissions": len(submission_scheduler.queued),
+            "runningSubmissions": len(submission_scheduler.running)
+        }
+    
+    def stats(self) -> dict:
+        return {
+            "sweeps": self.sweeps,
+            "interval": self.interval,
+            "heartbeatTimeout": self.heartbeat_timeout,
+            "finishedLobbyTtl": self.finished_ttl,
+            "reaped": dict(self.reaped),
+            "sizes": self.gauges()
+        }
+
+lifecycle_reaper = LifecycleReaper(REAPER_INTERVAL, HEARTBEAT_TIMEOUT, FINISHED_LOBBY_TTL)
+
+class StateBackend:
+    """Where lobby ownership, client ids and the lobby listing live, and how workers talk
+    
+    This default keeps everything in the one process: ids are unique if they are unique
+    here, every lobby is local and nothing is ever published. Shared backends let several
+    workers split the clients and lobbies between them (see ClusterRouter).
+    """
+    name = "memory"
+    shared = False
+    
+    async def start(self, on_message):
+        """Begin delivering messages published to this worker (or to all) to on_message(message)"""
+        pass
+    
+    async def close(self):
+        pass
+    
+    async def claim_client(self, client_id: str) -> bool:
+        return True
+    
+    async def release_client(self, client_id: str):
+        pass
+    
+    async def claim_lobby(self, lobby_id: str) -> bool:
+        return True
+    
+    async def release_lobby(self, lobby_id: str):
+        pass
+    
+    async def lobby_node(self, lobby_id: str) -> Optional[str]:
+        return NODE_ID if lobby_id in lobbies else None
+    
+    async def publish(self, node: Optional[str], message: dict):
+        """Send message to one worker, or to every worker when node is None"""
+        pass
+    
+    async def save_listing(self, entries: list):
+        pass
+    
+    async def load_listings(self) -> Dict[str, list]:
+        """Every worker's listed lobbies: node -> lobby list entries"""
+        return {}
+    
+    async def drop_listing(self, node: str):
+        pass
+    
+    async def heartbeat(self, client_ids: list, lobby_ids: list):
+        """Refresh this worker's liveness and its claims on client_ids and lobby_ids"""
+        pass
+    
+    async def live_nodes(self) -> Set[str]:
+        return {NODE_ID}
+
+class RedisStateBackend(StateBackend):
+    """State shared through Redis (or anything speaking its protocol)
+    
+    Ownership is a key per client and per lobby set with NX, the listing is a hash
+    of node -> JSON entries, liveness is a key per node, and messages go over one
+    pub/sub channel per node plus one for everybody. Ownership and liveness keys
+    expire after ttl seconds unless the heartbeat refreshes them, so a worker that
+    dies without cleaning up frees its ids once the others stop seeing it.
+    """
+    name = "redis"
+    shared = True
+    PREFIX = "shibacoder:"
+    
+    def __init__(self, url: str, ttl: float):
+        self.url = url
+        self.ttl = max(1, math.ceil(ttl))
+        self.redis = None
+        self.pubsub = None
+        self.listener: Optional[asyncio.Task] = None
+    
+    def key(self, *parts: str) -> str:
+        return self.PREFIX + ":".join(parts)
+    
+    async def start(self, on_message):
+        if aioredis is None:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)")
+        self.redis = aioredis.from_url(self.url, decode_responses=True)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(self.key("node", NODE_ID), self.key("nodes"))
+        self.listener = asyncio.ensure_future(self.listen(on_message))
+    
+    async def listen(self, on_message):
+        # Polled rather than pubsub.listen(), which doesn't always give up on cancel;
+        # close() stops the loop by clearing self.listener
+        while self.listener is not None:
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None or message.get("type") != "message":
+                continue
+            try:
+                await on_message(json.loads(message["data"]))
+            except Exception as e:
+                print(f"Cluster message failed: {e}")
+    
+    async def close(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            await listener
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        if self.redis is not None:
+            await self.redis.delete(self.key("alive", NODE_ID))
+            await self.redis.aclose()
+    
+    async def claim_client(self, client_id: str) -> bool:
+        return bool(await self.redis.set(self.key("client", client_id), NODE_ID, nx=True, ex=self.ttl))
+    
+    async def release_client(self, client_id: str):
+        await self.redis.delete(self.key("client", client_id))
+    
+    async def claim_lobby(self, lobby_id: str) -> bool:
+        return bool(await self.redis.set(self.key("lobby", lobby_id), NODE_ID, nx=True, ex=self.ttl))
+    
+    async def release_lobby(self, lobby_id: str):
+        await self.redis.delete(self.key("lobby", lobby_id))
+    
+    async def lobby_node(self, lobby_id: str) -> Optional[str]:
+        return await self.redis.get(self.key("lobby", lobby_id))
+    
+    async def publish(self, node: Optional[str], message: dict):
+        channel = self.key("node", node) if node else self.key("nodes")
+        await self.redis.publish(channel, json.dumps(message, separators=(",", ":")))
+    
+    async def save_listing(self, entries: list):
+        await self.redis.hset(self.key("listings"), NODE_ID, json.dumps(entries))
+    
+    async def load_listings(self) -> Dict[str, list]:
+        listings = await self.redis.hgetall(self.key("listings"))
+        return {node: json.loads(entries) for node, entries in listings.items()}
+    
+    async def drop_listing(self, node: str):
+        await self.redis.hdel(self.key("listings"), node)
+    
+    async def heartbeat(self, client_ids: list, lobby_ids: list):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(self.key("alive", NODE_ID), "1", ex=self.ttl)
+            for client_id in client_ids:
+                pipe.expire(self.key("client", client_id), self.ttl)
+            for lobby_id in lobby_ids:
+                pipe.expire(self.key("lobby", lobby_id), self.ttl)
+            await pipe.execute()
+    
+    async def live_nodes(self) -> Set[str]:
+        prefix = self.key("alive", "")
+        return {key[len(prefix):] async for key in self.redis.scan_iter(match=prefix + "*")} | {NODE_ID}
+
+state_backends = {
+    "memory": StateBackend,
+    "redis": lambda: RedisStateBackend(REDIS_URL, HEARTBEAT_TIMEOUT),
+}
+
+class ClusterRouter:
+    """Spreads clients and lobbies over the workers sharing a StateBackend
+    
+    A lobby lives on the worker that created it. When a client connected here joins a
+    lobby that lives elsewhere, that worker becomes the client's home: from then on its
+    events are forwarded there, where a proxy Player (node set to this worker) stands in
+    for it, and send_frame relays whatever the home worker sends the proxy back here.
+    A forwarded join only makes that worker the home once its lobby_joined (or
+    spectator_joined) comes back. Whenever a forwarded event leaves the proxy outside any
+    lobby (a failed join, a leave) the home worker drops the proxy and releases the
+    client, and this worker goes back to handling its events; so does the lobby_left
+    that ends the client's stay when its lobby closes.
+    Every worker mirrors the others' listed lobbies into its lobby browser. With the
+    in-memory backend there is a single worker and all of this is skipped.
+    """
+    # Events about the connection itself, always handled where the socket is
+    LOCAL_EVENTS = ("hello", "pong", "resume")
+    JOIN_EVENTS = ("join_lobby", "join_as_spectator")
+    JOINED_EVENTS = ("lobby_joined", "spectator_joined")
+    
+    def __init__(self, backend: StateBackend):
+        self.backend = backend
+        self.enabled = backend.shared
+        self.homes: Dict[str, str] = {}  # local client_id -> worker handling its events
+        self.joining: Dict[str, str] = {}  # local client_id -> worker its join went to, until it answers
+        self.mirror: Dict[str, Dict[str, dict]] = {}  # worker -> lobby_id -> list entry
+        self.listed: Dict[str, dict] = {}  # lobby_id -> list entry, for other workers' lobbies
+        self.live: Set[str] = {NODE_ID}
+        self.queue: deque = deque()  # (coroutine function, args) run in order by the writer
+        self.wakeup: Optional[asyncio.Event] = None
+        self.writer: Optional[asyncio.Task] = None
+        self.listing_task: Optional[asyncio.Task] = None
+        self.forwarded = 0
+        self.received = 0
+        self.relayed = 0
+    
+    async def start(self):
+        await self.backend.start(self.receive)
+        if not self.enabled:
+            return
+        self.wakeup = asyncio.Event()
+        self.writer = asyncio.ensure_future(self.drain())
+        await self.heartbeat()
+        self.live = await self.backend.live_nodes()
+        for node, entries in (await self.backend.load_listings()).items():
+            if node != NODE_ID and node in self.live:
+                self.mirror_listing(node, entries)
+        print(f"Cluster node {NODE_ID} started on {self.backend.name} with {len(self.live)} node(s)")
+    
+    async def close(self):
+        if self.enabled:
+            await self.backend.drop_listing(NODE_ID)
+            await self.backend.publish(None, {"type": "listing", "node": NODE_ID, "lobbies": []})
+            if self.writer is not None:
+                self.writer.cancel()
+        await self.backend.close()
+    
+    def run(self, operation, *args):
+        """Queue a backend call; the writer runs them in order so messages keep their order"""
+        if not self.enabled:
+            return
+        self.queue.append((operation, args))
+        self.wakeup.set()
+    
+    async def drain(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            operation, args = self.queue.popleft()
+            try:
+                await operation(*args)
+            except Exception as e:
+                print(f"Cluster {operation.__name__} failed: {e}")
+    
+    async def claim_client(self, client_id: str) -> bool:
+        return client_id not in players and await self.backend.claim_client(client_id)
+    
+    async def claim_lobby(self, lobby_id: str) -> bool:
+        return lobby_id not in lobbies and await self.backend.claim_lobby(lobby_id)
+    
+    def release_lobby(self, lobby_id: str):
+        self.run(self.backend.release_lobby, lobby_id)
+    
+    def disconnected(self, client_id: str):
+        """A client connected here went away: tell its home worker and free the id"""
+        home = self.homes.pop(client_id, None) or self.joining.pop(client_id, None)
+        if home is not None:
+            self.run(self.backend.publish, home, {"type": "disconnect", "client": client_id, "node": NODE_ID})
+        self.run(self.backend.release_client, client_id)
+    
+    async def forward(self, client_id: str, event: str, data) -> bool:
+        """Send a client's event to its home worker, returning False to handle it here"""
+        if not self.enabled or event in self.LOCAL_EVENTS:
+            return False
+        # (events sent while a join is pending follow it to the same worker)
+        home = self.homes.get(client_id) or self.joining.get(client_id)
+        if home is None and event in self.JOIN_EVENTS and isinstance(data, dict):
+            lobby_id = data.get("lobbyId")
+            if isinstance(lobby_id, str) and lobby_id not in lobbies and not players[client_id].lobby:
+                node = await self.backend.lobby_node(lobby_id)
+                if node is not None and node != NODE_ID and node in self.live:
+                    home = self.joining[client_id] = node
+        if home is None:
+            return False
+        self.forwarded += 1
+        self.run(self.backend.publish, home, {
+            "type": "event", "client": client_id, "node": NODE_ID, "event": event, "data": data
+        })
+        return True
+    
+    def resume(self, node: str, client_id: str, token: str, last_seq: int):
+        """Ask the worker holding a session to hand it to this connection"""
+        self.run(self.backend.publish, node, {
+            "type": "resume", "client": client_id, "node": NODE_ID, "token": token, "lastSeq": last_seq
+        })
+    
+    def node_of(self, client_id: str) -> Optional[str]:
+        player = players.get(client_id)
+        return player.node if player is not None else None
+    
+    def deliver(self, recipients: Dict[str, list], event: str, data: dict):
+        """Relay an event to proxied clients, one message per worker"""
+        for node, client_ids in recipients.items():
+            self.relayed += len(client_ids)
+            self.run(self.backend.publish, node, {
+                "type": "deliver", "clients": client_ids, "node": NODE_ID, "event": event, "data": data
+            })
+            if event == "lobby_left":
+                for client_id in client_ids:
+                    player = players.get(client_id)
+                    if player is not None and player.node == node and not player.lobby:
+                        del players[client_id]
+    
+    async def receive(self, message: dict):
+        self.received += 1
+        kind = message.get("type")
+        if kind == "event":
+            client_id = message["client"]
+            if client_id not in players:
+                players[client_id] = Player(client_id, node=message["node"])
+            try:
+                await dispatcher.handle(client_id, message["event"], message["data"])
+            finally:
+                # A proxy outside any lobby (its join failed, or it left) has no reason to be here
+                player = players.get(client_id)
+                if player is not None and player.node == message["node"] and not player.lobby:
+                    del players[client_id]
+                    self.run(self.backend.publish, message["node"], {
+                        "type": "released", "client": client_id, "node": NODE_ID
+                    })
+        elif kind == "deliver":
+            client_ids = [client_id for client_id in message["clients"] if client_id in connections]
+            for client_id in client_ids:
+                if message["event"] in self.JOINED_EVENTS and self.joining.get(client_id) == message["node"]:
+                    self.homes[client_id] = self.joining.pop(client_id)
+                elif message["event"] == "lobby_left":
+                    self.release(client_id, message["node"])
+            send_frame(client_ids, message["event"], message["data"])
+        elif kind == "released":
+            self.release(message["client"], message["node"])
+        elif kind == "disconnect":
+            player = players.get(message["client"])
+            if player is not None and player.node is not None and player.node == message["node"]:
+                await handle_disconnect(player.id)
+        elif kind == "resume":
+            # The session is ours; the connection is on the sender, which becomes its relay
+            client_id = sessions.take(message["token"])
+            if client_id is not None:
+                players[client_id].node = message["node"]
+                lifecycle_reaper.forget(client_id)
+            self.run(self.backend.publish, message["node"], {
+                "type": "resumed", "client": message["client"], "resumed": client_id, "node": NODE_ID
+            })
+            if client_id is not None:
+                await sessions.welcome_back(client_id, message["lastSeq"])
+        elif kind == "resumed":
+            connection_id, client_id = message["client"], message["resumed"]
+            if connection_id not in connections:
+                if client_id is not None:
+                    # The new socket is already gone too; let the seat be held again
+                    self.run(self.backend.publish, message["node"], {
+                        "type": "disconnect", "client": client_id, "node": NODE_ID
+                    })
+            elif client_id is None:
+                await send_to_client(connection_id, "lobby_left", {"message": "Your session expired"})
+            else:
+                sessions.adopt(connection_id, client_id)
+                self.homes[client_id] = message["node"]
+        elif kind == "listing" and message["node"] != NODE_ID:
+            self.mirror_listing(message["node"], message["lobbies"])
+    
+    def release(self, client_id: str, node: str):
+        """node no longer handles client_id's events (if it did); handle them here again"""
+        if self.joining.get(client_id) == node:
+            del self.joining[client_id]
+        if self.homes.get(client_id) == node:
+            del self.homes[client_id]
+    
+    def listing_changed(self):
+        """This worker's listed lobbies changed; share them after the lobby list debounce"""
+        if self.enabled and self.listing_task is None:
+            self.listing_task = asyncio.ensure_future(self.publish_listing_later())
+    
+    async def publish_listing_later(self):
+        try:
+            await asyncio.sleep(LOBBY_LIST_DEBOUNCE)
+        finally:
+            self.listing_task = None
+        entries = [lobby_list_entry(lobby) for lobby in lobbies.values()
+                   if lobby.type == "public" and lobby.status == "waiting"]
+        self.run(self.backend.save_listing, entries)
+        self.run(self.backend.publish, None, {"type": "listing", "node": NODE_ID, "lobbies": entries})
+    
+    def mirror_listing(self, node: str, entries: list):
+        """Replace what the lobby browser shows of another worker's lobbies"""
+        previous = self.mirror.pop(node, {})
+        current = {entry["id"]: entry for entry in entries}
+        for lobby_id in previous:
+            if lobby_id not in current:
+                self.listed.pop(lobby_id, None)
+                lobby_registry.discard(lobby_id)
+        for lobby_id, entry in current.items():
+            self.listed[lobby_id] = entry
+            lobby_registry.add(lobby_id, entry["createdAt"], entry["name"])
+        if current:
+            self.mirror[node] = current
+        lobby_list_feed.mark_changed()
+    
+    async def heartbeat(self):
+        """Refresh this worker's liveness and its claims on the clients and lobbies it owns"""
+        await self.backend.heartbeat([client_id for client_id, player in players.items() if player.node is None],
+                                     list(lobbies))
+    
+    async def sweep(self):
+        """Refresh this worker's liveness and forget workers that stopped refreshing theirs"""
+        if not self.enabled:
+            return
+        await self.heartbeat()
+        self.live = await self.backend.live_nodes()
+        for node in [node for node in self.mirror if node not in self.live]:
+            print(f"Cluster node {node} is gone")
+            self.mirror_listing(node, [])
+            self.run(self.backend.drop_listing, node)
+        for client_id in [client_id for client_id, player in players.items()
+                          if player.node is not None and player.node not in self.live
+                          and client_id not in sessions.held]:
+            await handle_disconnect(client_id)
+        for client_id in [client_id for client_id, home in self.homes.items() if home not in self.live]:
+            del self.homes[client_id]
+            await send_to_client(client_id, "lobby_left", {"message": "Lobby closed"})
+        for client_id in [client_id for client_id, node in self.joining.items() if node not in self.live]:
+            del self.joining[client_id]
+            await send_to_client(client_id, "error", {"message": "Lobby not found"})
+    
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend.name,
+            "node": NODE_ID,
+            "nodes": len(self.live),
+            "proxiedClients": sum(1 for player in players.values() if player.node is not None),
+            "relayedClients": len(self.homes),
+            "pendingJoins": len(self.joining),
+            "mirroredLobbies": len(self.listed),
+            "eventsForwarded": self.forwarded,
+            "messagesReceived": self.received,
+            "deliveriesRelayed": self.relayed,
+            "queued": len(self.queue)
+        }
+
+cluster = ClusterRouter(state_backends.get(STATE_BACKEND, StateBackend)())
+
+class LobbyEventLog:
+    """Bounded, sequenced log of the events each lobby sent its players
+    
+    Every logged event is stamped with the lobby's next eventSeq, which clients keep
+    track of, and the last size events are kept so a player resuming a dropped
+    session can be sent just what it missed. Events meant for one player (their own
+    results, attacks on them) are logged with that recipient and replayed only to them.
+    """
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.logs: Dict[str, deque] = {}  # lobby_id -> (seq, event, data, recipient or None)
+        self.seqs: Dict[str, int] = {}  # lobby_id -> last seq handed out
+        self.appended = 0
+    
+    def append(self, lobby_id: str, event: str, data: dict, recipient: Optional[str] = None) -> dict:
+        """Log an event, returning its data stamped with the sequence number"""
+        seq = self.seqs.get(lobby_id, 0) + 1
+        self.seqs[lobby_id] = seq
+        data = {**data, "eventSeq": seq}
+        log = self.logs.get(lobby_id)
+        if log is None:
+            log = self.logs[lobby_id] = deque(maxlen=self.size)
+        log.append((seq, event, data, recipient))
+        self.appended += 1
+        return data
+    
+    def current(self, lobby_id: str) -> int:
+        return self.seqs.get(lobby_id, 0)
+    
+    def since(self, lobby_id: str, last_seq: int, client_id: str) -> Optional[list]:
+        """(event, data) for client_id after last_seq, or None if the log no longer reaches back that far"""
+        current = self.seqs.get(lobby_id, 0)
+        if last_seq > current:
+            return None  # a sequence from some other lobby
+        log = self.logs.get(lobby_id)
+        if last_seq == current or not log:
+            return []
+        if log[0][0] > last_seq + 1:
+            return None
+        return [(event, data) for seq, event, data, recipient in log
+                if seq > last_seq and recipient in (None, client_id)]
+    
+    def discard_lobby(self, lobby_id: str):
+        self.logs.pop(lobby_id, None)
+        self.seqs.pop(lobby_id, None)
+    
+    def stats(self) -> dict:
+        return {
+            "lobbies": len(self.logs),
+            "size": self.size,
+            "events": sum(len(log) for log in self.logs.values()),
+            "appended": self.appended
+        }
+
+event_log = LobbyEventLog(LOBBY_EVENT_LOG_SIZE)
+
+class SessionResumption:
+    """Resume tokens, and seats held for players whose connection dropped
+    
+    Every connection gets a resume token in its "session" event. When a seated player's
+    socket drops, their player record and seat are held for grace seconds instead of
+    being removed; a new connection whose first event is "resume" with the token takes
+    the old client id back and is replayed the lobby events logged after the client's
+    last eventSeq, falling back to the full lobby state when the log has moved past it.
+    (The token travels in that event rather than the URL, so it stays out of access logs.)
+    
+    A session lives on the worker holding the seat, and its tokens name that worker. A
+    resume that reaches another worker is forwarded there, and the client carries on as
+    a proxy of the new connection's worker (see ClusterRouter), held again if it drops.
+    """
+    
+    def __init__(self, grace: float):
+        self.grace = grace
+        self.tokens: Dict[str, str] = {}  # resume token -> client_id
+        self.token_of: Dict[str, str] = {}  # client_id -> its current token
+        self.held: Dict[str, int] = {}  # client_id -> grace timer id
+        self.moved: Dict[str, str] = {}  # connection's first client_id -> the client_id it resumed
+        self.resumed = 0
+        self.forwarded = 0
+        self.replayed = 0
+        self.full_resyncs = 0
+        self.expired = 0
+    
+    def issue(self, client_id: str) -> str:
+        """A fresh resume token for client_id, replacing the one it had"""
+        self.tokens.pop(self.token_of.get(client_id), None)
+        token = f"{secrets.token_urlsafe(24)}.{NODE_ID}"
+        self.tokens[token] = client_id
+        self.token_of[client_id] = token
+        return token
+    
+    def forget(self, client_id: str):
+        self.tokens.pop(self.token_of.pop(client_id, None), None)
+    
+    @staticmethod
+    def owner(token: str) -> str:
+        """The worker that issued a resume token"""
+        return token.partition(".")[2]
+    
+    def hold(self, client_id: str) -> bool:
+        """Keep a dropped player's seat for the grace window, returning False if there is nothing to hold"""
+        player = players.get(client_id)
+        if (self.grace <= 0 or player is None or player.role != "player"
+                or (player.node is None and client_id not in connections) or client_id in cluster.homes
+                or client_id not in self.token_of):
+            return False
+        lobby = lobbies.get(player.lobby)
+        if lobby is None or lobby.status == "finished":
+            return False
+        self.held[client_id] = game_scheduler.wheel.schedule(self.grace, self.expire, client_id)
+        return True
+    
+    def take(self, token: str) -> Optional[str]:
+        """The client id a resume token belongs to, detached from its old connection, or None"""
+        client_id = self.tokens.get(token)
+        if client_id is None or client_id not in players:
+            return None
+        timer_id = self.held.pop(client_id, None)
+        if timer_id is not None:
+            game_scheduler.wheel.cancel(timer_id)
+        elif client_id in connections:
+            # The old socket hasn't noticed it is dead yet; its receive loop leaves quietly
+            outboxes.disconnect(client_id)
+            del connections[client_id]
+        elif players[client_id].node is None:
+            return None
+        # (a proxy's old worker may not have noticed either; its disconnect names that
+        # worker and is ignored once the client has moved on)
+        self.resumed += 1
+        return client_id
+    
+    def adopt(self, connection_id: str, client_id: str):
+        """Move a new connection from the client id it was given over to the one it resumed"""
+        websocket = connections.pop(connection_id)
+        protocol = outboxes.protocols.get(connection_id, "json")
+        outboxes.close(connection_id)
+        lobby_list_feed.unsubscribe(connection_id)
+        lifecycle_reaper.forget(connection_id)
+        cluster.disconnected(connection_id)
+        players.pop(connection_id, None)
+        self.forget(connection_id)
+        # (no longer anyone's proxy: the connection is here now)
+        players.setdefault(client_id, Player(client_id)).node = None
+        connections[client_id] = websocket
+        outboxes.open(client_id, websocket, protocol)
+        lifecycle_reaper.seen(client_id)
+        self.moved[connection_id] = client_id
+    
+    def follow(self, client_id: str) -> str:
+        """The client id a connection goes by now, given the one it started with"""
+        return self.moved.pop(client_id, client_id)
+    
+    async def welcome_back(self, client_id: str, last_seq: int):
+        """A fresh token for a resumed client, then whatever it missed"""
+        print(f"Client {client_id} resumed")
+        await send_to_client(client_id, "session", {
+            "clientId": client_id,
+            "resumeToken": self.issue(client_id),
+            "graceSeconds": self.grace
+        })
+        await self.replay(client_id, last_seq)
+    
+    async def expire(self, client_id: str):
+        """Grace ran out: remove the player the way an immediate disconnect would have"""
+        if self.held.pop(client_id, None) is None:
+            return
+        self.expired += 1
+        print(f"Client {client_id} did not resume within {self.grace:g}s")
+        cluster.disconnected(client_id)
+        await handle_disconnect(client_id, resumable=False)
+    
+    async def replay(self, client_id: str, last_seq: int):
+        """Catch a resumed client up on its lobby"""
+        lobby = lobbies.get(players[client_id].lobby)
+        if lobby is None:
+            await send_to_client(client_id, "lobby_left", {"message": "Lobby closed"})
+            return
+        entries = event_log.since(lobby.id, last_seq, client_id)
+        if entries is None or len(entries) > OUTBOX_MAX_MESSAGES // 2:
+            self.full_resyncs += 1
+            await send_to_client(client_id, "resumed", {
+                "lobbyId": lobby.id,
+                "lobbyData": member_lobby(lobby),
+                "eventSeq": event_log.current(lobby.id)
+            })
+            return
+        await send_to_client(client_id, "resumed", {"lobbyId": lobby.id, "replayed": len(entries)})
+        for event, data in entries:
+            send_frame((client_id,), event, data)
+        self.replayed += len(entries)
+    
+    def stats(self) -> dict:
+        return {
+            "grace": self.grace,
+            "tokens": len(self.tokens),
+            "held": len(self.held),
+            "resumed": self.resumed,
+            "forwarded": self.forwarded,
+            "expired": self.expired,
+            "eventsReplayed": self.replayed,
+            "fullResyncs": self.full_resyncs,
+            "eventLog": event_log.stats()
+        }
+
+sessions = SessionResumption(RESUME_GRACE)
+
+class PooledJudgeTransport(httpx.AsyncBaseTransport):
+    """HTTP transport for the judge client that records connection pool usage"""
+    
+    def __init__(self):
+        self.transport = httpx.AsyncHTTPTransport(
+            http2=JUDGE0_HTTP2,
+            limits=httpx.Limits(
+                max_connections=JUDGE0_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=JUDGE0_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=JUDGE0_POOL_KEEPALIVE_EXPIRY
+            )
+        )
+        self.requests_total = 0
+        self.requests_in_flight = 0
+        self.pool_waits = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started_at = time.perf_counter()
+        waiting = True
+        
+        # The first connection event marks the end of the wait for a pool slot
+        async def trace(event_name: str, info: dict):
+            nonlocal waiting
+            if waiting:
+                waiting = False
+                wait = time.perf_counter() - started_at
+                self.pool_waits += 1
+                self.pool_wait_total += wait
+                self.pool_wait_max = max(self.pool_wait_max, wait)
+        
+        request.extensions = {**request.extensions, "trace": trace}
+        self.requests_total += 1
+        self.requests_in_flight += 1
+        try:
+            return await self.transport.handle_async_request(request)
+        finally:
+            self.requests_in_flight -= 1
+    
+    async def aclose(self):
+        await self.transport.aclose()
+    
+    def stats(self) -> dict:
+        pool = getattr(self.transport, "_pool", None)
+        pool_connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for conn in pool_connections if conn.is_idle())
+        
+        return {
+            "http2": JUDGE0_HTTP2,
+            "maxConnections": JUDGE0_POOL_MAX_CONNECTIONS,
+            "maxKeepalive": JUDGE0_POOL_MAX_KEEPALIVE,
+            "connections": len(pool_connections),
+            "inUse": len(pool_connections) - idle,
+            "idle": idle,
+            "requestsInFlight": self.requests_in_flight,
+            "requestsTotal": self.requests_total,
+            "avgPoolWaitMs": round(self.pool_wait_total / self.pool_waits * 1000, 3) if self.pool_waits else 0,
+            "maxPoolWaitMs": round(self.pool_wait_max * 1000, 3)
+        }
+
+judge_http_client: Optional[httpx.AsyncClient] = None
+judge_http_transport: Optional[PooledJudgeTransport] = None
+
+def get_judge_http_client() -> httpx.AsyncClient:
+    """Return the shared judge HTTP client, creating it on first use"""
+    global judge_http_client, judge_http_transport
+    if judge_http_client is None or judge_http_client.is_closed:
+        judge_http_transport = PooledJudgeTransport()
+        judge_http_client = httpx.AsyncClient(
+            transport=judge_http_transport,
+            timeout=JUDGE0_SUBMIT_TIMEOUT
+        )
+    return judge_http_client
+
+async def close_judge_http_client():
+    """Close the shared judge HTTP client and its pooled connections"""
+    global judge_http_client
+    if judge_http_client is not None:
+        await judge_http_client.aclose()
+        judge_http_client = None
+
+def get_judge_http_pool_stats() -> dict:
+    """Connection pool statistics for sizing the judge client"""
+    if judge_http_transport is None:
+        return {}
+    return judge_http_transport.stats()
+
+# Judge0 functions (same as before)
+async def judge0_run_test_case(client: httpx.AsyncClient, headers: dict, code: str,
+                               test_case: dict, index: int, semaphore: asyncio.Semaphore) -> dict:
+    """Submit a single test case to Judge0 and poll until it has a verdict"""
+    async with semaphore:
+        print(f"DEBUG: Processing test case {index+1}")
+        # Prepare the submission
+        submission_data = {
+            "language_id": PYTHON_LANGUAGE_ID,
+            "source_code": code,
+            "stdin": test_case["input"],
+            "expected_output": test_case["expected_output"].strip()
+        }
+        if JUDGE0_CALLBACK_URL:
+            submission_data["callback_url"] = judge0_callback_url()
+        
+        # Submit code
+        submit_response = await client.post(
+            f"{JUDGE0_BASE_URL}/submissions",
+            json=submission_data,
+            headers=headers,
+            timeout=JUDGE0_SUBMIT_TIMEOUT
+        )
+        
+        print(f"DEBUG: Submit response status: {submit_response.status_code}")
+        
+        if submit_response.status_code != 201:
+            submit_error = submit_response.text if submit_response.text else "Submission failed"
+            print(f"DEBUG: Submit failed: {submit_error}")
+            return {"passed": False, "runtime": 0, "error": f"Test {index+1}: {submit_error}", "transient": True}
+        
+        submission_token = submit_response.json()["token"]
+        
+        results = await judge0_wait_for_results(client, headers, [submission_token], batch=False)
+        
+        if submission_token not in results:
+            return {"passed": False, "runtime": 0, "error": f"Test {index+1}: Timeout waiting for result", "transient": True}
+        
+        return judge0_parse_result(results[submission_token], test_case, index)
+
+def judge0_is_finished(result: dict) -> bool:
+    """Whether a Judge0 submission has left the queue"""
+    # Status: 1=In Queue, 2=Processing, 3=Accepted, 4=Wrong Answer, 5=Time Limit Exceeded, 6=Compilation Error, etc.
+    return result.get("status", {}).get("id") not in [None, 1, 2]
+
+def judge0_callback_url() -> str:
+    return f"{JUDGE0_CALLBACK_URL}/judge0/callback/{JUDGE0_CALLBACK_SECRET}"
+
+# Futures of submissions waiting for a Judge0 callback, by token
+judge0_callback_waiters: Dict[str, asyncio.Future] = {}
+# Callbacks that beat their waiter's registration (Judge0 can finish a submission before
+# its submit response reaches us), by token -> (received_at, result)
+judge0_early_callbacks: "OrderedDict[str, tuple]" = OrderedDict()
+JUDGE0_EARLY_CALLBACKS_MAX = 1000
+
+def judge0_resolve_callback(result: dict) -> bool:
+    """Hand a finished submission from a Judge0 callback to whoever waits on its token
+    
+    A callback nobody waits for yet is kept until JUDGE0_RESULT_TIMEOUT for the waiter
+    to pick up. Returns False for results without a token or that haven't finished.
+    """
+    token = result.get("token")
+    if not isinstance(token, str) or not judge0_is_finished(result):
+        return False
+    
+    waiter = judge0_callback_waiters.pop(token, None)
+    if waiter is None:
+        now = time.monotonic()
+        while judge0_early_callbacks:
+            oldest = next(iter(judge0_early_callbacks.values()))
+            if now - oldest[0] < JUDGE0_RESULT_TIMEOUT and len(judge0_early_callbacks) < JUDGE0_EARLY_CALLBACKS_MAX:
+                break
+            judge0_early_callbacks.popitem(last=False)
+        judge0_early_callbacks[token] = (now, result)
+    elif not waiter.done():
+        waiter.set_result(result)
+    return True
+
+async def judge0_fetch_results(client: httpx.AsyncClient, headers: dict, tokens: list, batch: bool) -> list:
+    """Poll Judge0 once for the given tokens"""
+    if batch:
+        result_response = await client.get(
+            f"{JUDGE0_BASE_URL}/submissions/batch",
+            params={
+                "tokens": ",".join(tokens),
+                "base64_encoded": "true",
+                "fields": "token,status,stdout,stderr,compile_output,time"
+            },
+            headers=headers,
+            timeout=JUDGE0_POLL_TIMEOUT
+        )
+        if result_response.status_code != 200:
+            return []
+        return [judge0_decode_result(result) for result in result_response.json().get("submissions", []) if result]
+    
+    results = []
+    for token in tokens:
+        result_response = await client.get(
+            f"{JUDGE0_BASE_URL}/submissions/{token}",
+            headers=headers,
+            timeout=JUDGE0_POLL_TIMEOUT
+        )
+        if result_response.status_code == 200:
+            results.append({"token": token, **result_response.json()})
+    return results
+
+async def judge0_wait_for_results(client: httpx.AsyncClient, headers: dict, tokens: list, batch: bool,
+                                  on_finished=None) -> dict:
+    """Wait for finished results of the given tokens, returning only those that finished in time
+    
+    With callbacks enabled the results normally arrive on /judge0/callback and polling
+    only starts after JUDGE0_CALLBACK_GRACE. Polling backs off exponentially with jitter.
+    on_finished(token, result) is awaited for each result as it arrives; returning True
+    stops waiting for the rest.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + JUDGE0_RESULT_TIMEOUT
+    results = {}
+    waiters = {}
+    stopped = False
+    
+    async def finish(token: str, result: dict):
+        nonlocal stopped
+        results[token] = result
+        if on_finished is not None and await on_finished(token, result):
+            stopped = True
+    
+    try:
+        if JUDGE0_CALLBACK_URL:
+            for token in tokens:
+                waiters[token] = judge0_callback_waiters[token] = loop.create_future()
+                early = judge0_early_callbacks.pop(token, None)
+                if early is not None:
+                    waiters[token].set_result(early[1])
+        
+        delay = JUDGE0_CALLBACK_GRACE if JUDGE0_CALLBACK_URL else JUDGE0_POLL_INITIAL_DELAY
+        while len(results) < len(tokens) and not stopped:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            wait = min(delay * random.uniform(0.5, 1.5), remaining)
+            
+            pending_waiters = [waiter for token, waiter in waiters.items() if token not in results]
+            if pending_waiters:
+                await asyncio.wait(pending_waiters, timeout=wait)
+                for token, waiter in waiters.items():
+                    if waiter.done() and token not in results and not stopped:
+                        await finish(token, waiter.result())
+            else:
+                await asyncio.sleep(wait)
+            
+            pending_tokens = [token for token in tokens if token not in results]
+            if not pending_tokens or stopped:
+                break
+            
+            for result in await judge0_fetch_results(client, headers, pending_tokens, batch):
+                if result.get("token") in pending_tokens and judge0_is_finished(result) and not stopped:
+                    await finish(result["token"], result)
+            
+            delay = min(delay * JUDGE0_POLL_BACKOFF, JUDGE0_POLL_MAX_DELAY)
+    finally:
+        for token in waiters:
+            judge0_callback_waiters.pop(token, None)
+    
+    return results
+
+def judge0_parse_result(result: dict, test_case: dict, index: int) -> dict:
+    """Turn a finished Judge0 submission into a per-test result"""
+    status_id = result.get("status", {}).get("id")
+    
+    if status_id == 3:  # Accepted
+        # Add actual runtime if available
+        runtime = float(result["time"]) * 1000 if result.get("time") else 0  # Convert to ms
+        return {"passed": True, "runtime": runtime, "error": None}
+    
+    # Error
+    status_desc = result.get("status", {}).get("description", "Unknown error")
+    actual_output = (result.get("stdout") or "").strip()
+    expected_output = test_case["expected_output"].strip()
+    
+    # Provide detailed error information
+    error_msg = f"Test {index+1}: {status_desc}"
+    if actual_output and actual_output != expected_output:
+        error_msg += f" - Expected: {expected_output}, Got: {actual_output}"
+    elif result.get("stderr"):
+        error_msg += f" - {result['stderr'].strip()}"
+    elif result.get("compile_output"):
+        error_msg += f" - {result['compile_output'].strip()}"
+    
+    return {"passed": False, "runtime": 0, "error": error_msg}
+
+def judge0_b64encode(text: str) -> str:
+    """Encode a text field for a base64_encoded=true Judge0 request"""
+    return base64.b64encode(text.encode("utf-8")).decode("ascii")
+
+def judge0_b64decode(value) -> str:
+    """Decode a text field from a base64_encoded=true Judge0 response"""
+    if not value:
+        return ""
+    return base64.b64decode(value).decode("utf-8", errors="replace")
+
+def judge0_decode_result(result: dict) -> dict:
+    """Decode the output fields of a base64 encoded Judge0 submission"""
+    for field in ["stdout", "stderr", "compile_output"]:
+        result[field] = judge0_b64decode(result.get(field))
+    return result
+
+async def judge0_submit_batch(client: httpx.AsyncClient, headers: dict, code: str, test_cases: list,
+                              on_result=None, fail_fast: bool = False) -> list:
+    """Submit every test case in one batch call and poll all tokens together"""
+    test_results = [None] * len(test_cases)
+    pending = {}  # token -> test case index
+    
+    for chunk_start in range(0, len(test_cases), JUDGE0_MAX_BATCH_SIZE):
+        chunk = test_cases[chunk_start:chunk_start + JUDGE0_MAX_BATCH_SIZE]
+        batch_data = {
+            "submissions": [{
+                "language_id": PYTHON_LANGUAGE_ID,
+                "source_code": judge0_b64encode(code),
+                "stdin": judge0_b64encode(test_case["input"]),
+                "expected_output": judge0_b64encode(test_case["expected_output"].strip()),
+                **({"callback_url": judge0_callback_url()} if JUDGE0_CALLBACK_URL else {})
+            } for test_case in chunk]
+        }
+        
+        submit_response = await client.post(
+            f"{JUDGE0_BASE_URL}/submissions/batch",
+            params={"base64_encoded": "true"},
+            json=batch_data,
+            headers=headers,
+            timeout=JUDGE0_SUBMIT_TIMEOUT
+        )
+        
+        print(f"DEBUG: Batch submit response status: {submit_response.status_code}")
+        
+        if submit_response.status_code != 201:
+            submit_error = submit_response.text if submit_response.text else "Submission failed"
+            print(f"DEBUG: Batch submit failed: {submit_error}")
+            for i in range(chunk_start, chunk_start + len(chunk)):
+                test_results[i] = {"passed": False, "runtime": 0, "error": f"Test {i+1}: {submit_error}", "transient": True}
+            continue
+        
+        for offset, item in enumerate(submit_response.json()):
+            i = chunk_start + offset
+            if "token" in item:
+                pending[item["token"]] = i
+            else:
+                test_results[i] = {"passed": False, "runtime": 0, "error": f"Test {i+1}: {item}", "transient": True}
+    
+    # Submit failures already count as failed cases
+    for i, test_result in enumerate(test_results):
+        if test_result is not None and on_result is not None:
+            await on_result(i, test_result)
+    if fail_fast and any(test_result is not None for test_result in test_results):
+        pending = {}
+    
+    async def on_finished(token: str, result: dict) -> bool:
+        i = pending[token]
+        test_results[i] = judge0_parse_result(result, test_cases[i], i)
+        if on_result is not None:
+            await on_result(i, test_results[i])
+        return fail_fast and not test_results[i]["passed"]
+    
+    if pending:
+        await judge0_wait_for_results(client, headers, list(pending), batch=True, on_finished=on_finished)
+    
+    for token, i in pending.items():
+        if test_results[i] is None and not (fail_fast and any(r is not None and not r["passed"] for r in test_results)):
+            test_results[i] = {"passed": False, "runtime": 0, "error": f"Test {i+1}: Timeout waiting for result", "transient": True}
+    
+    return [test_result or SKIPPED_TEST_RESULT for test_result in test_results]
+
+# Test cases left unjudged because an earlier one failed in fail-fast mode
+SKIPPED_TEST_RESULT = {"passed": False, "runtime": 0, "error": None, "skipped": True}
+
+async def run_test_cases(coroutines: list, on_result=None, fail_fast: bool = False) -> list:
+    """Run per-test coroutines concurrently and return their results in test case order
+    
+    on_result(index, result) is awaited as each test case finishes. With fail_fast the
+    outstanding test cases are cancelled after the first failure and reported as skipped.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    index_of = {task: i for i, task in enumerate(tasks)}
+    test_results = [None] * len(tasks)
+    pending = set(tasks)
+    
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=index_of.get):
+                i = index_of[task]
+                test_results[i] = task.result()
+                if on_result is not None:
+                    await on_result(i, test_results[i])
+            if fail_fast and any(r is not None and not r["passed"] for r in test_results):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+    
+    return [test_result or SKIPPED_TEST_RESULT for test_result in test_results]
+
+def summarize_test_results(test_results: list) -> dict:
+    """Combine per-test results (in test case order) into the submission result
+    
+    Per-test results marked transient (submit failures, timeouts) make the
+    submission result uncacheable.
+    """
+    passed_tests = sum(1 for result in test_results if result["passed"])
+    total_tests = len(test_results)
+    errors = [result["error"] for result in test_results if result["error"]]
+    total_runtime = sum(result["runtime"] for result in test_results)
+    
+    # Calculate average runtime
+    avg_runtime = int(total_runtime / total_tests) if total_tests > 0 and total_runtime > 0 else random.randint(50, 300)
+    
+    return {
+        "passed": passed_tests,
+        "total": total_tests,
+        "completed": passed_tests == total_tests,
+        "runtime": avg_runtime,
+        "errors": errors,
+        "cacheable": not any(result.get("transient") for result in test_results)
+    }
+
+def judge0_headers() -> dict:
+    """Request headers for the Judge0 API"""
+    return {
+        "X-RapidAPI-Key": JUDGE0_API_KEY,
+        "X-RapidAPI-Host": JUDGE0_API_HOST,
+        "Content-Type": "application/json"
+    }
+
+async def judge0_submit_code(code: str, test_cases: list, on_result=None, fail_fast: bool = False) -> dict:
+    """Submit code to Judge0 API and return test results"""
+    print(f"DEBUG: JUDGE0_API_KEY exists: {JUDGE0_API_KEY is not None}")
+    print(f"DEBUG: JUDGE0_API_HOST: {JUDGE0_API_HOST}")
+    print(f"DEBUG: JUDGE0_BASE_URL: {JUDGE0_BASE_URL}")
+    
+    if not JUDGE0_API_KEY:
+        print(f"Warning: Judge0 API key not configured, using {JUDGE_FALLBACK} results")
+        return await run_fallback_tests(code, test_cases, on_result, fail_fast)
+    
+    headers = judge0_headers()
+    
+    print(f"DEBUG: About to submit to Judge0 with {len(test_cases)} test cases")
+    
+    client = get_judge_http_client()
+    try:
+        if JUDGE0_BATCH_MODE:
+            test_results = await judge0_submit_batch(client, headers, code, test_cases, on_result, fail_fast)
+        else:
+            # Run all test cases at once, capped per submission; results come back in test case order
+            semaphore = asyncio.Semaphore(max(1, JUDGE0_MAX_CONCURRENCY))
+            test_results = await run_test_cases([
+                judge0_run_test_case(client, headers, code, test_case, i, semaphore)
+                for i, test_case in enumerate(test_cases)
+            ], on_result, fail_fast)
+    except Exception as e:
+        print(f"Judge0 API error: {e}")
+        # If Judge0 fails, fall back to fake (or local) tests
+        return await run_fallback_tests(code, test_cases, on_result, fail_fast)
+    
+    return summarize_test_results(test_results)
+
+async def judge0_execute(code: str, stdin: str) -> dict:
+    """Run a program once on Judge0 and return the finished submission"""
+    headers = judge0_headers()
+    client = get_judge_http_client()
+    
+    submission_data = {
+        "language_id": PYTHON_LANGUAGE_ID,
+        "source_code": code,
+        "stdin": stdin
+    }
+    if JUDGE0_CALLBACK_URL:
+        submission_data["callback_url"] = judge0_callback_url()
+    
+    submit_response = await client.post(
+        f"{JUDGE0_BASE_URL}/submissions",
+        json=submission_data,
+        headers=headers,
+        timeout=JUDGE0_SUBMIT_TIMEOUT
+    )
+    if submit_response.status_code != 201:
+        raise RuntimeError(submit_response.text or "Submission failed")
+    
+    token = submit_response.json()["token"]
+    results = await judge0_wait_for_results(client, headers, [token], batch=False)
+    if token not in results:
+        return {"status": {"id": 0, "description": "Timeout waiting for result"}, "transient": True}
+    return results[token]
+
+# Harness runner; build_harness_source prepends the solution, the test inputs and a marker
+# that is random per run. Each case runs in a child forked from the harness, which times it,
+# kills it at the case time limit and prints its marker line of JSON as soon as it ends, so
+# cases finished before the whole run gets killed are still reported. The child has no
+# handle on the real stdout (and the harness is made non-dumpable, so not via /proc either),
+# gets a fresh copy of the harness state and can't touch the limits of other cases.
+# Where fork isn't allowed, cases run in the harness process itself with a re-armed alarm.
+# Kept Python 3.8 compatible for Judge0's interpreter.
+HARNESS_RUNNER = """
+import io as _io, json as _json, os as _os, select as _select, signal as _signal, sys as _sys, time as _time, traceback as _traceback
+
+class _CaseTimeout(BaseException):
+    pass
+
+def _on_alarm(signum, frame):
+    raise _CaseTimeout()
+
+def _report(line):
+    _sys.__stdout__.write("\\n" + _marker + _json.dumps(line) + "\\n")
+    _sys.__stdout__.flush()
+
+def _hide_from_cases():
+    # PR_SET_DUMPABLE 0: same-user processes can no longer open /proc/<harness>/fd
+    try:
+        import ctypes
+        ctypes.CDLL(None).prctl(4, 0, 0, 0, 0)
+    except Exception:
+        pass
+
+def _exec_case(compiled, stdin):
+    # Runs the solution with captured stdin/stdout, returning (status, error, output)
+    stdout = _io.BytesIO()
+    _sys.stdin = _io.TextIOWrapper(_io.BytesIO(stdin.encode("utf-8")), encoding="utf-8")
+    _sys.stdout = _io.TextIOWrapper(stdout, encoding="utf-8", write_through=True)
+    status, error = "ok", ""
+    try:
+        exec(compiled, {"__name__": "__main__", "__builtins__": __builtins__})
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            status, error = "runtime_error", "SystemExit: %s" % (e.code,)
+    except _CaseTimeout:
+        status = "timeout"
+    except MemoryError:
+        status = "memory"
+    except BaseException as e:
+        status = "runtime_error"
+        error = "".join(_traceback.format_exception(type(e), e, e.__traceback__.tb_next))
+    finally:
+        try:
+            _sys.stdout.flush()
+        except BaseException:
+            pass
+        output = stdout.getvalue()[-_output_limit:].decode("utf-8", "replace")
+        _sys.stdin, _sys.stdout = _sys.__stdin__, _sys.__stdout__
+    return status, error, output
+
+def _run_case_forked(index, compiled, stdin):
+    result_r, result_w = _os.pipe()
+    started = _time.perf_counter()
+    try:
+        pid = _os.fork()
+    except OSError:
+        _os.close(result_r)
+        _os.close(result_w)
+        return False
+    if pid == 0:
+        try:
+            _os.close(result_r)
+            devnull = _os.open(_os.devnull, _os.O_WRONLY)
+            _os.dup2(devnull, 1)
+            _os.dup2(devnull, 2)
+            _sys.__stdout__ = _sys.__stderr__ = _sys.stderr = open(devnull, "w")
+            status, error, output = _exec_case(compiled, stdin)
+            _os.write(result_w, _json.dumps({"status": status, "error": error[-2000:], "output": output}).encode("utf-8"))
+        finally:
+            _os._exit(0)
+    _os.close(result_w)
+    data, timed_out = b"", False
+    deadline = started + _case_time_limit
+    while True:
+        remaining = deadline - _time.perf_counter()
+        if remaining <= 0:
+            timed_out = True
+            break
+        if not _select.select([result_r], [], [], remaining)[0]:
+            continue
+        chunk = _os.read(result_r, 65536)
+        if not chunk or len(data) > 4 * _output_limit + 65536:
+            break
+        data += chunk
+    if timed_out:
+        _os.kill(pid, _signal.SIGKILL)
+    _, wait_status = _os.waitpid(pid, 0)
+    elapsed = _time.perf_counter() - started
+    _os.close(result_r)
+    try:
+        line = _json.loads(data.decode("utf-8"))
+        status, error, output = str(line["status"]), str(line["error"]), str(line["output"])
+    except (ValueError, KeyError, TypeError):
+        status, error, output = "runtime_error", "Process exited with status %s" % (wait_status,), ""
+    if timed_out or (_os.WIFSIGNALED(wait_status) and _os.WTERMSIG(wait_status) == _signal.SIGXCPU):
+        status = "timeout"
+    _report({"case": index, "status": status, "output": output, "error": error, "time": elapsed})
+    return True
+
+def _run_case_inline(index, compiled, stdin):
+    # The solution may have replaced the handler or cancelled the timer in an earlier case
+    started = _time.perf_counter()
+    if _has_alarm:
+        _signal.signal(_signal.SIGALRM, _on_alarm)
+        _signal.setitimer(_signal.ITIMER_REAL, _case_time_limit)
+    try:
+        status, error, output = _exec_case(compiled, stdin)
+    finally:
+        if _has_alarm:
+            _signal.setitimer(_signal.ITIMER_REAL, 0)
+    elapsed = _time.perf_counter() - started
+    if elapsed > _case_time_limit:
+        status = "timeout"
+    _report({"case": index, "status": status, "output": output, "error": error[-2000:], "time": elapsed})
+
+_has_alarm = hasattr(_signal, "setitimer")
+_can_fork = hasattr(_os, "fork")
+_hide_from_cases()
+try:
+    _compiled = compile(_source, "solution.py", "exec")
+except (SyntaxError, ValueError) as e:
+    _report({"compile_error": "".join(_traceback.format_exception_only(type(e), e))})
+else:
+    for _index, _stdin in enumerate(_inputs):
+        if not (_can_fork and _run_case_forked(_index, _compiled, _stdin)):
+            _can_fork = False
+            _run_case_inline(_index, _compiled, _stdin)
+"""
+
+def harness_marker() -> str:
+    """Marker for one harness run; random so a solution can't know it in advance"""
+    return f"{HARNESS_MARKER}{secrets.token_hex(16)}:"
+
+def build_harness_source(code: str, test_cases: list, marker: str) -> str:
+    """Wrap a solution in the harness that runs every test case in one execution"""
+    # Only inputs go into the program; outputs are checked here so the solution can't read them
+    return "\n".join([
+        f"_source = {code!r}",
+        f"_inputs = {[test_case['input'] for test_case in test_cases]!r}",
+        f"_case_time_limit = {HARNESS_CASE_TIME_LIMIT!r}",
+        f"_output_limit = {LOCAL_JUDGE_OUTPUT_LIMIT!r}",
+        f"_marker = {marker!r}",
+        HARNESS_RUNNER
+    ])
+
+def parse_harness_output(result: dict, test_cases: list, marker: str) -> list:
+    """Turn a finished harness execution into per-test results (in test case order)
+    
+    A case reported more than once fails: only the harness reports, once per case.
+    """
+    case_reports = {}
+    duplicated = set()
+    compile_error = None
+    for line in (result.get("stdout") or "").splitlines():
+        if not line.startswith(marker):
+            continue
+        try:
+            report = json.loads(line[len(marker):])
+        except ValueError:
+            continue
+        if not isinstance(report, dict):
+            continue
+        if "compile_error" in report:
+            compile_error = report["compile_error"]
+        elif isinstance(report.get("case"), int):
+            if report["case"] in case_reports:
+                duplicated.add(report["case"])
+            case_reports[report["case"]] = report
+    
+    test_results = []
+    for i, test_case in enumerate(test_cases):
+        report = case_reports.get(i)
+        
+        if compile_error is not None:
+            case_result = {"status": {"id": 6, "description": "Compilation Error"}, "compile_output": compile_error}
+        elif report is None:
+            # The run ended before this case finished; blame the whole run's status
+            test_results.append({
+                "passed": False,
+                "runtime": 0,
+                "error": f"Test {i+1}: {result.get('status', {}).get('description', 'Unknown error')}",
+                "transient": bool(result.get("transient"))
+            })
+            continue
+        elif i in duplicated:
+            case_result = {"status": {"id": 11, "description": "Runtime Error (NZEC)"},
+                           "stderr": "Test case reported more than once"}
+        elif report["status"] == "timeout":
+            case_result = {"status": {"id": 5, "description": "Time Limit Exceeded"}}
+        elif report["status"] == "memory":
+            case_result = {"status": {"id": 12, "description": "Memory Limit Exceeded"}}
+        elif report["status"] == "runtime_error":
+            case_result = {"status": {"id": 11, "description": "Runtime Error (NZEC)"}, "stderr": report["error"]}
+        elif report["output"].strip() == test_case["expected_output"].strip():
+            case_result = {"status": {"id": 3, "description": "Accepted"}, "time": report["time"]}
+        else:
+            case_result = {"status": {"id": 4, "description": "Wrong Answer"}, "stdout": report["output"]}
+        
+        test_results.append(judge0_parse_result(case_result, test_case, i))
+    
+    return test_results
+
+# Local judge: each test case runs in a fresh interpreter (python -I -S -B) exec'd from a
+# pre-started pool worker, so nothing of the server (its modules, globals or secrets) is
+# in the solution's memory. The worker only pays for the fork and exec, not for importing
+# the server. The child gets rlimits, an empty environment, no inherited descriptors, its
+# own network namespace with no interfaces up (LOCAL_JUDGE_NETWORK=isolate) and, when the
+# server runs as root, the LOCAL_JUDGE_UID user. It is not a container: solutions can still
+# read world-readable files, and without root they run as the server's own user.
+LOCAL_JUDGE_SETUP_FAILED = 125  # child exit code when the sandbox could not be set up
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+PR_SET_DUMPABLE = 4
+
+# Reads the solution from fd 3 and runs it as __main__; tracebacks start in solution.py
+LOCAL_JUDGE_RUNNER = """
+import os, sys
+with os.fdopen(3, "r", encoding="utf-8") as source_file:
+    source = source_file.read()
+try:
+    exec(compile(source, "solution.py", "exec"), {"__name__": "__main__", "__builtins__": __builtins__})
+except SystemExit:
+    raise
+except BaseException as e:
+    import traceback
+    traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    sys.exit(1)
+"""
+
+def local_judge_harden() -> int:
+    """Make this process non-dumpable, so a solution running as the same user can't read
+    its memory or environment through /proc; returns the pid (also the pool warmup job)"""
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_DUMPABLE, 0, 0, 0, 0)
+    except (OSError, AttributeError):
+        pass
+    return os.getpid()
+
+def local_judge_unshare_network():
+    """Move the calling process into a new network namespace, which has no usable interfaces"""
+    # Without root, a new user namespace grants the right to create the network namespace
+    flags = CLONE_NEWNET if os.geteuid() == 0 else CLONE_NEWUSER | CLONE_NEWNET
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.unshare(flags) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"unshare: {os.strerror(errno)}")
+
+def local_judge_child(source_fd: int, stdin_fd: int, stdout_fd: int, stderr_fd: int,
+                      cpu_limit: int, memory_limit_mb: int, processes: int):
+    """Body of the forked child: isolate, apply limits, wire up stdio and exec the interpreter"""
+    try:
+        os.dup2(stdin_fd, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        os.dup2(source_fd, 3)
+        os.set_inheritable(3, True)  # dup2 onto itself keeps the pipe's close-on-exec flag
+        # Drop every other inherited descriptor, including the worker's pipes to the pool
+        os.closerange(4, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+        os.setsid()
+        os.chdir("/")
+        if LOCAL_JUDGE_NETWORK == "isolate":
+            local_judge_unshare_network()
+        
+        # The fresh interpreter itself needs about 15 MB of address space
+        memory_limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+        if os.geteuid() == 0:
+            os.setgroups([])
+            os.setgid(LOCAL_JUDGE_UID)
+            os.setuid(LOCAL_JUDGE_UID)
+        # After setuid, so it only limits the processes the solution starts itself
+        resource.setrlimit(resource.RLIMIT_NPROC, (processes, processes))
+        
+        os.execve(LOCAL_JUDGE_PYTHON, [LOCAL_JUDGE_PYTHON, "-I", "-S", "-B", "-c", LOCAL_JUDGE_RUNNER], {})
+    except BaseException as e:
+        try:
+            os.write(2, f"sandbox setup failed: {e}".encode("utf-8", "replace"))
+        finally:
+            os._exit(LOCAL_JUDGE_SETUP_FAILED)
+
+def local_judge_run(code: str, stdin: str, expected_output: str, time_limit: float,
+                    cpu_limit: int, memory_limit_mb: int, output_limit: int, processes: int = 0) -> dict:
+    """Run one test case in a fresh sandboxed interpreter and return a Judge0-shaped result
+    
+    processes is the RLIMIT_NPROC the program gets, 0 for a solution that may not fork.
+    """
+    try:
+        compile(code, "solution.py", "exec")
+    except (SyntaxError, ValueError) as e:
+        return {
+            "status": {"id": 6, "description": "Compilation Error"},
+            "stdout": "",
+            "stderr": "",
+            "compile_output": "".join(traceback.format_exception_only(type(e), e)),
+            "time": None
+        }
+    
+    source_r, source_w = os.pipe()
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    started_at = time.perf_counter()
+    
+    pid = os.fork()
+    if pid == 0:
+        local_judge_child(source_r, stdin_r, stdout_w, stderr_w, cpu_limit, memory_limit_mb, processes)
+    
+    os.close(source_r)
+    os.close(stdin_r)
+    os.close(stdout_w)
+    os.close(stderr_w)
+    
+    # Feed the source and stdin and drain stdout/stderr together so nothing blocks on a full pipe
+    inputs = {source_w: code.encode("utf-8"), stdin_w: stdin.encode("utf-8")}
+    outputs = {stdout_r: bytearray(), stderr_r: bytearray()}
+    deadline = started_at + time_limit
+    timed_out = False
+    output_exceeded = False
+    
+    with selectors.DefaultSelector() as selector:
+        for fd, data in inputs.items():
+            if data:
+                os.set_blocking(fd, False)
+                selector.register(fd, selectors.EVENT_WRITE)
+            else:
+                os.close(fd)
+        selector.register(stdout_r, selectors.EVENT_READ)
+        selector.register(stderr_r, selectors.EVENT_READ)
+        
+        while selector.get_map() and not output_exceeded:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                timed_out = True
+                break
+            for key, _ in selector.select(remaining):
+                if key.fd in inputs:
+                    data = inputs[key.fd]
+                    try:
+                        data = inputs[key.fd] = data[os.write(key.fd, data[:65536]):]
+                    except BrokenPipeError:
+                        data = b""
+                    if not data:
+                        selector.unregister(key.fd)
+                        os.close(key.fd)
+                    continue
+                
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                    continue
+                outputs[key.fd] += chunk
+                if len(outputs[key.fd]) > output_limit:
+                    output_exceeded = True
+        
+        for fd in list(selector.get_map()):
+            selector.unregister(fd)
+            os.close(fd)
+    
+    # The child may still be running after closing its output
+    while not timed_out and not output_exceeded:
+        finished_pid, status, usage = os.wait4(pid, os.WNOHANG)
+        if finished_pid:
+            break
+        if time.perf_counter() >= deadline:
+            timed_out = True
+            break
+        time.sleep(0.001)
+    
+    if timed_out or output_exceeded:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            os.kill(pid, signal.SIGKILL)
+        _, status, usage = os.wait4(pid, 0)
+    
+    cpu_time = usage.ru_utime + usage.ru_stime
+    stdout = outputs[stdout_r][:output_limit].decode("utf-8", errors="replace")
+    stderr = outputs[stderr_r][:output_limit].decode("utf-8", errors="replace")
+    
+    if (os.WIFEXITED(status) and os.WEXITSTATUS(status) == LOCAL_JUDGE_SETUP_FAILED
+            and stderr.startswith("sandbox setup failed")):
+        raise RuntimeError(stderr)
+    
+    if timed_out or (os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGXCPU):
+        verdict = {"id": 5, "description": "Time Limit Exceeded"}
+    elif output_exceeded:
+        verdict = {"id": 12, "description": "Output Limit Exceeded"}
+    elif "MemoryError" in stderr:
+        verdict = {"id": 12, "description": "Memory Limit Exceeded"}
+    elif os.WIFSIGNALED(status):
+        verdict = {"id": 12, "description": f"Runtime Error ({signal.Signals(os.WTERMSIG(status)).name})"}
+    elif os.WEXITSTATUS(status) != 0:
+        verdict = {"id": 11, "description": "Runtime Error (NZEC)"}
+    elif stdout.strip() == expected_output.strip():
+        verdict = {"id": 3, "description": "Accepted"}
+    else:
+        verdict = {"id": 4, "description": "Wrong Answer"}
+    
+    return {
+        "status": verdict,
+        "stdout": stdout,
+        "stderr": stderr,
+        "compile_output": "",
+        "time": f"{cpu_time:.3f}"
+    }
+
+class JudgeBackend(ABC):
+    """Runs a submission against a problem's test cases
+    
+    run_tests returns the submission result handle_submit_code expects:
+    passed, total, completed, runtime and errors. Backends that judge cases
+    separately await on_result(index, test_result) as each case finishes and,
+    with fail_fast, stop at the first failed case.
+    """
+    name = "base"
+    
+    async def start(self):
+        pass
+    
+    async def close(self):
+        pass
+    
+    @abstractmethod
+    async def run_tests(self, code: str, test_cases: list, on_result=None, fail_fast: bool = False) -> dict:
+        ...
+    
+    @abstractmethod
+    async def execute(self, code: str, stdin: str, cases: int = 1) -> dict:
+        """Run a program once and return a Judge0-shaped result
+        
+        cases is how many test cases the program runs, for backends that scale limits.
+        """
+    
+    async def run_harness(self, code: str, test_cases: list, on_result=None) -> dict:
+        """Run every test case in a single execution of the harness-wrapped solution"""
+        marker = harness_marker()
+        result = await self.execute(build_harness_source(code, test_cases, marker), "", len(test_cases))
+        test_results = parse_harness_output(result, test_cases, marker)
+        if on_result is not None:
+            for i, test_result in enumerate(test_results):
+                await on_result(i, test_result)
+        return summarize_test_results(test_results)
+
+class Judge0Backend(JudgeBackend):
+    """Judge0 API (RapidAPI or self-hosted)"""
+    name = "judge0"
+    
+    async def start(self):
+        get_judge_http_client()
+    
+    async def close(self):
+        await close_judge_http_client()
+    
+    async def run_tests(self, code: str, test_cases: list, on_result=None, fail_fast: bool = False) -> dict:
+        return await judge0_submit_code(code, test_cases, on_result, fail_fast)
+    
+    async def execute(self, code: str, stdin: str, cases: int = 1) -> dict:
+        return await judge0_execute(code, stdin)
+    
+    async def run_harness(self, code: str, test_cases: list, on_result=None) -> dict:
+        if not JUDGE0_API_KEY:
+            print(f"Warning: Judge0 API key not configured, using {JUDGE_FALLBACK} results")
+            return await run_fallback_tests(code, test_cases, on_result)
+        try:
+            return await super().run_harness(code, test_cases, on_result)
+        except Exception as e:
+            print(f"Judge0 API error: {e}")
+            return await run_fallback_tests(code, test_cases, on_result)
+
+class LocalJudgeBackend(JudgeBackend):
+    """Pool of pre-started worker processes that fork a limited child per test case"""
+    name = "local"
+    
+    def __init__(self):
+        self.pool: Optional[ProcessPoolExecutor] = None
+    
+    async def start(self):
+        if resource is None or not hasattr(os, "fork"):
+            raise RuntimeError("Local judge needs a Unix host")
+        if self.pool is not None:
+            return
+        
+        # forkserver workers start from a clean process rather than a copy of the event loop
+        self.pool = ProcessPoolExecutor(
+            max_workers=LOCAL_JUDGE_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+        local_judge_harden()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self.pool, local_judge_harden)
+            for _ in range(LOCAL_JUDGE_WORKERS)
+        ])
+        
+        # Refuse to judge at all rather than run solutions without the sandbox
+        try:
+            probe = await loop.run_in_executor(
+                self.pool, local_judge_run, "print('ok')", "", "ok",
+                LOCAL_JUDGE_TIME_LIMIT, LOCAL_JUDGE_CPU_LIMIT, LOCAL_JUDGE_MEMORY_LIMIT_MB,
+                LOCAL_JUDGE_OUTPUT_LIMIT
+            )
+        except RuntimeError as e:
+            await self.close()
+            hint = ("; set LOCAL_JUDGE_NETWORK=host only if this host blocks outbound traffic for the judge"
+                    if "unshare" in str(e) else "")
+            raise RuntimeError(f"Local judge sandbox unavailable: {e}{hint}") from e
+        if probe["status"]["id"] != 3:
+            await self.close()
+            raise RuntimeError(f"Local judge sandbox check failed: {probe['status']['description']} {probe['stderr']}")
+        if os.geteuid() != 0:
+            print("Warning: local judge is not running as root, so solutions run as the server's "
+                  "user and can read any file it can")
+        print(f"Local judge started with {LOCAL_JUDGE_WORKERS} workers (network: {LOCAL_JUDGE_NETWORK})")
+    
+    async def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+    
+    async def run_tests(self, code: str, test_cases: list, on_result=None, fail_fast: bool = False) -> dict:
+        await self.start()
+        
+        try:
+            test_results = await run_test_cases([
+                self.run_test_case(code, test_case, i)
+                for i, test_case in enumerate(test_cases)
+            ], on_result, fail_fast)
+        except BrokenProcessPool:
+            # A worker died; replace the pool so the next submission gets fresh workers
+            await self.close()
+            raise
+        
+        return summarize_test_results(test_results)
+    
+    async def run_test_case(self, code: str, test_case: dict, index: int) -> dict:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            self.pool, local_judge_run, code, test_case["input"], test_case["expected_output"],
+            LOCAL_JUDGE_TIME_LIMIT, LOCAL_JUDGE_CPU_LIMIT, LOCAL_JUDGE_MEMORY_LIMIT_MB,
+            LOCAL_JUDGE_OUTPUT_LIMIT
+        )
+        return judge0_parse_result(result, test_case, index)
+    
+    async def execute(self, code: str, stdin: str, cases: int = 1) -> dict:
+        await self.start()
+        loop = asyncio.get_running_loop()
+        # A multi-case harness forks one child per case. As LOCAL_JUDGE_UID, the limit counts
+        # every judge process, so leave room for each worker's run plus one case; as the
+        # server's own user it can't be bounded that way, and the harness runs cases inline.
+        processes = 2 * LOCAL_JUDGE_WORKERS if cases > 1 and os.geteuid() == 0 else 0
+        return await loop.run_in_executor(
+            self.pool, local_judge_run, code, stdin, "",
+            LOCAL_JUDGE_TIME_LIMIT * cases, LOCAL_JUDGE_CPU_LIMIT * cases, LOCAL_JUDGE_MEMORY_LIMIT_MB,
+            LOCAL_JUDGE_OUTPUT_LIMIT * (cases + 1), processes
+        )
+
+judge_backends: Dict[str, JudgeBackend] = {
+    "judge0": Judge0Backend(),
+    "local": LocalJudgeBackend()
+}
+
+def get_judge_backend() -> JudgeBackend:
+    """Return the configured judge backend"""
+    return judge_backends.get(JUDGE_BACKEND, judge_backends["judge0"])
+
+async def run_fallback_tests(code: str, test_cases: list, on_result=None, fail_fast: bool = False) -> dict:
+    """Results to use when Judge0 is unavailable"""
+    if JUDGE_FALLBACK == "local":
+        try:
+            test_results = await judge_backends["local"].run_tests(code, test_cases, on_result, fail_fast)
+            return {**test_results, "backend": "local"}
+        except Exception as e:
+            print(f"Local judge error: {e}")
+    test_results = {**run_fake_tests(code), "backend": "fake"}
+    if on_result is not None:
+        # The fake judge only scores the whole submission: its first cases count as the passed ones
+        for i in range(test_results["total"]):
+            passed = i < test_results["passed"]
+            await on_result(i, {"passed": passed, "runtime": test_results["runtime"] if passed else 0,
+                                "error": None if passed else f"Test {i+1}: Failed"})
+            if fail_fast and not passed:
+                break
+    return test_results
+
+@dataclass(slots=True)
+class JudgeFlight:
+    """One judge call shared by identical submissions, and the test cases it has finished"""
+    task: Optional[asyncio.Future] = None
+    waiters: int = 0
+    cases: list = field(default_factory=list)  # (index, test_result) in the order they finished
+    listeners: list = field(default_factory=list)  # on_result of every caller waiting on it
+    
+    async def record(self, index: int, test_result: dict):
+        self.cases.append((index, test_result))
+        for listener in list(self.listeners):
+            try:
+                await listener(index, dict(test_result))
+            except Exception as e:
+                print(f"Test case listener failed: {e}")
+
+class VerdictCache:
+    """LRU + TTL cache of submission results with in-flight coalescing
+    
+    Keys hash the normalized source, language, judge backend, harness mode and test
+    case set, so a resubmission of the same code reuses the earlier verdict and concurrent
+    identical submissions share one judge call. The per-test results are kept
+    with the verdict, so every caller sees the same per-test progress. A verdict is
+    stored under the backend that produced it, so one from a fallback judge never
+    answers for the configured backend.
+    """
+    
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, size, result, cases)
+        self.in_flight: Dict[str, JudgeFlight] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def normalize_source(code: str) -> str:
+        lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        return "\n".join(line.rstrip() for line in lines).strip("\n")
+    
+    def make_key(self, code: str, language: str, test_cases: list, fail_fast: bool = False,
+                 backend: Optional[str] = None) -> str:
+        """backend defaults to the configured judge backend"""
+        test_set = json.dumps(test_cases, sort_keys=True)
+        digest = hashlib.sha256()
+        for part in [backend or get_judge_backend().name, str(JUDGE_HARNESS), language, str(fail_fast),
+                     test_set, self.normalize_source(code)]:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[tuple]:
+        """(result, per-test cases) of a live entry"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, result, cases = entry
+        if expires_at < time.monotonic():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return result, cases
+    
+    def put(self, key: str, result: dict, cases: list = ()):
+        cases = list(cases)
+        size = len(json.dumps(result)) + len(json.dumps(cases)) + len(key)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, result, cases)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+    
+    def remove(self, key: str):
+        _, size, _, _ = self.entries.pop(key)
+        self.bytes -= size
+    
+    async def run(self, code: str, language: str, test_cases: list, judge, fail_fast: bool = False,
+                  on_result=None) -> dict:
+        """Return the cached result, joining an identical in-flight judge call or starting one
+        
+        judge(on_result) runs the tests. on_result(index, test_result) is awaited for every
+        finished test case, replayed from the cache or from the shared call when this
+        caller didn't start it.
+        """
+        key = self.make_key(code, language, test_cases, fail_fast)
+        
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            result, cases = cached
+            if on_result is not None:
+                for index, test_result in cases:
+                    await on_result(index, dict(test_result))
+            return copy_test_results(result)
+        
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            flight = self.in_flight[key] = JudgeFlight()
+            store_key = lambda backend: self.make_key(code, language, test_cases, fail_fast, backend)
+            flight.task = asyncio.ensure_future(self.judge_and_store(store_key, flight, judge))
+        
+        task = flight.task
+        flight.waiters += 1
+        # Listen before catching up, so cases finishing during the catch-up aren't lost
+        finished = list(flight.cases)
+        if on_result is not None:
+            flight.listeners.append(on_result)
+        try:
+            for index, test_result in finished if on_result is not None else ():
+                await on_result(index, dict(test_result))
+            return copy_test_results(await asyncio.shield(task))
+        finally:
+            flight.waiters -= 1
+            if on_result is not None:
+                flight.listeners.remove(on_result)
+            # Nobody is waiting anymore (e.g. every submitter was superseded): stop judging
+            if flight.waiters == 0 and not task.done():
+                task.cancel()
+    
+    async def judge_and_store(self, store_key, flight: JudgeFlight, judge) -> dict:
+        """Run judge for flight; store_key(backend) is the cache key for a producing backend"""
+        key = store_key(None)
+        try:
+            result = await judge(flight.record)
+            if result.get("cacheable"):
+                self.put(store_key(result.get("backend")), result, flight.cases)
+            return result
+        finally:
+            self.in_flight.pop(key, None)
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "inFlight": len(self.in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hitRate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0
+        }
+
+def copy_test_results(test_results: dict) -> dict:
+    """Copy a submission result so callers can't modify a shared/cached one"""
+    return {**test_results, "errors": list(test_results.get("errors", []))}
+
+verdict_cache = VerdictCache(VERDICT_CACHE_TTL, VERDICT_CACHE_MAX_ENTRIES, VERDICT_CACHE_MAX_BYTES)
+
+async def run_judge(code: str, test_cases: list, on_result=None, fail_fast: bool = False) -> dict:
+    """Run tests on the configured judge backend, in harness mode when enabled
+    
+    The harness runs every case in one execution, so fail_fast has no effect there.
+    """
+    backend = get_judge_backend()
+    if JUDGE_HARNESS:
+        result = await backend.run_harness(code, test_cases, on_result)
+    else:
+        result = await backend.run_tests(code, test_cases, on_result, fail_fast)
+    # Fallbacks have already said which judge produced the result
+    result.setdefault("backend", backend.name)
+    return result
+
+async def run_tests_cached(code: str, language: str, test_cases: list, on_result=None,
+                           fail_fast: bool = False) -> dict:
+    """Run tests on the configured judge backend through the verdict cache"""
+    return await verdict_cache.run(
+        code, language, test_cases,
+        lambda record: run_judge(code, test_cases, record, fail_fast),
+        fail_fast, on_result
+    )
+
+class SubmissionScheduler:
+    """Runs judge jobs with a global concurrency limit and round-robin fairness across lobbies
+    
+    Each lobby has its own FIFO queue and free slots are handed to lobbies in turn, so
+    one busy lobby can't starve the others. A player has at most one submission queued
+    or running: a new one cancels and replaces the previous one.
+    """
+    
+    def __init__(self, max_concurrency: int, max_backlog: int):
+        self.max_concurrency = max_concurrency
+        self.max_backlog = max_backlog
+        self.lobby_queues: "OrderedDict[str, deque]" = OrderedDict()  # rotation order of lobbies with work
+        self.queued: Dict[str, dict] = {}  # client_id -> queued job
+        self.running: Dict[str, asyncio.Task] = {}  # client_id -> running job
+        self.wait_times = deque(maxlen=1000)  # seconds, most recent jobs
+        self.submitted = 0
+        self.completed = 0
+        self.superseded = 0
+        self.rejected = 0
+    
+    def submit(self, client_id: str, lobby_id: str, job) -> bool:
+        """Queue job (a coroutine function) for client_id, returning False when too busy"""
+        if self.cancel(client_id):
+            self.superseded += 1
+        
+        if len(self.queued) >= self.max_backlog:
+            self.rejected += 1
+            return False
+        
+        entry = {"client_id": client_id, "lobby_id": lobby_id, "job": job, "enqueued_at": time.monotonic()}
+        self.lobby_queues.setdefault(lobby_id, deque()).append(entry)
+        self.queued[client_id] = entry
+        self.submitted += 1
+        self.pump()
+        return True
+    
+    def cancel(self, client_id: str) -> bool:
+        """Drop the client's queued submission or cancel its running one"""
+        entry = self.queued.pop(client_id, None)
+        if entry is not None:
+            queue = self.lobby_queues.get(entry["lobby_id"])
+            if queue is not None:
+                queue.remove(entry)
+                if not queue:
+                    del self.lobby_queues[entry["lobby_id"]]
+            return True
+        
+        task = self.running.pop(client_id, None)
+        if task is not None:
+            task.cancel()
+            self.pump()
+            return True
+        return False
+    
+    def pump(self):
+        """Start queued jobs while there are free slots, one lobby at a time"""
+        while self.lobby_queues and len(self.running) < self.max_concurrency:
+            lobby_id, queue = self.lobby_queues.popitem(last=False)
+            entry = queue.popleft()
+            if queue:
+                self.lobby_queues[lobby_id] = queue  # back of the rotation
+            
+            client_id = entry["client_id"]
+            del self.queued[client_id]
+            self.wait_times.append(time.monotonic() - entry["enqueued_at"])
+            
+            task = asyncio.ensure_future(entry["job"]())
+            self.running[client_id] = task
+            task.add_done_callback(lambda done, client_id=client_id: self.finished(client_id, done))
+    
+    def finished(self, client_id: str, task: asyncio.Task):
+        if self.running.get(client_id) is task:
+            del self.running[client_id]
+        if not task.cancelled():
+            self.completed += 1
+        self.pump()
+    
+    def stats(self) -> dict:
+        waits = sorted(self.wait_times)
+        return {
+            "queueDepth": len(self.queued),
+            "lobbiesQueued": len(self.lobby_queues),
+            "running": len(self.running),
+            "maxConcurrency": self.max_concurrency,
+            "maxBacklog": self.max_backlog,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "superseded": self.superseded,
+            "rejected": self.rejected,
+            "avgWaitMs": round(sum(waits) / len(waits) * 1000, 3) if waits else 0,
+            "p95WaitMs": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 3) if waits else 0,
+            "maxWaitMs": round(waits[-1] * 1000, 3) if waits else 0
+        }
+
+submission_scheduler = SubmissionScheduler(SUBMISSION_MAX_CONCURRENCY, SUBMISSION_MAX_BACKLOG)
+
+def precheck_source(code: str, entry_point: Optional[str]) -> Optional[str]:
+    """Compile a solution and check it defines entry_point; returns the error, if any
+    
+    Runs in the precheck process pool so big or pathological sources never block the event loop.
+    """
+    try:
+        tree = ast.parse(code, "solution.py")
+        compile(tree, "solution.py", "exec")
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+        return "Compilation Error - " + "".join(traceback.format_exception_only(type(e), e)).strip()
+    
+    if entry_point is None:
+        return None
     
-    print(f"DEBUG: About to submit to Judge0 with {len(test_cases)} test cases")
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == entry_point:
+            return None
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == entry_point for target in node.targets
+        ):
+            return None
+    return f"Solution must define a function named {entry_point}"
+
+precheck_pool: Optional[ProcessPoolExecutor] = None
+
+def get_precheck_pool() -> ProcessPoolExecutor:
+    """Return the compile check process pool, creating it on first use"""
+    global precheck_pool
+    if precheck_pool is None:
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        precheck_pool = ProcessPoolExecutor(
+            max_workers=PRECHECK_WORKERS,
+            mp_context=multiprocessing.get_context(start_method)
+        )
+    return precheck_pool
+
+def recycle_precheck_pool():
+    """Drop the precheck pool and kill its workers, one of which may be stuck on a pathological source"""
+    global precheck_pool
+    pool, precheck_pool = precheck_pool, None
+    if pool is None:
+        return
+    # ProcessPoolExecutor can't cancel a running job, so the workers have to go
+    processes = list((getattr(pool, "_processes", None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.kill()
+
+async def precheck_submission(code: str, language: str, problem_id: str, total_tests: int) -> Optional[dict]:
+    """Fail a submission that doesn't compile without a judge round trip
     
-    passed_tests = 0
-    total_tests = len(test_cases)
-    errors = []
-    total_runtime = 0
+    Returns a submission result for code that fails the check, or None when the
+    code should go to the judge (including when the check itself can't run or
+    doesn't finish in time, which says nothing about the code).
+    """
+    if language != "python":
+        return None
     
-    async with httpx.AsyncClient() as client:
-        try:
-            for i, test_case in enumerate(test_cases):
-                print(f"DEBUG: Processing test case {i+1}")
-                # Prepare the submission
-                submission_data = {
-                    "language_id": PYTHON_LANGUAGE_ID,
-                    "source_code": code,
-                    "stdin": test_case["input"],
-                    "expected_output": test_case["expected_output"].strip()
-                }
-                
-                # Submit code
-                submit_response = await client.post(
-                    f"{JUDGE0_BASE_URL}/submissions",
-                    json=submission_data,
-                    headers=headers,
-                    timeout=30.0
-                )
-                
-                print(f"DEBUG: Submit response status: {submit_response.status_code}")
-                
-                if submit_response.status_code != 201:
-                    submit_error = submit_response.text if submit_response.text else "Submission failed"
-                    print(f"DEBUG: Submit failed: {submit_error}")
-                    errors.append(f"Test {i+1}: {submit_error}")
-                    continue
-                
-                submission_token = submit_response.json()["token"]
-                
-                # Poll for results
-                max_polls = 15  # Increased polling attempts
-                for poll in range(max_polls):
-                    await asyncio.sleep(1)  # Wait 1 second between polls
-                    
-                    result_response = await client.get(
-                        f"{JUDGE0_BASE_URL}/submissions/{submission_token}",
-                        headers=headers,
-                        timeout=10.0
-                    )
-                    
-                    if result_response.status_code != 200:
-                        continue
-                    
-                    result = result_response.json()
-                    status_id = result.get("status", {}).get("id")
-                    
-                    # Status: 1=In Queue, 2=Processing, 3=Accepted, 4=Wrong Answer, 5=Time Limit Exceeded, 6=Compilation Error, etc.
-                    if status_id in [1, 2]:  # Still processing
-                        continue
-                    elif status_id == 3:  # Accepted
-                        passed_tests += 1
-                        # Add actual runtime if available
-                        if result.get("time"):
-                            total_runtime += float(result["time"]) * 1000  # Convert to ms
-                        break
-                    else:  # Error
-                        status_desc = result.get("status", {}).get("description", "Unknown error")
-                        actual_output = result.get("stdout", "").strip()
-                        expected_output = test_case["expected_output"].strip()
-                        
-                        # Provide detailed error information
-                        error_msg = f"Test {i+1}: {status_desc}"
-                        if actual_output and actual_output != expected_output:
-                            error_msg += f" - Expected: {expected_output}, Got: {actual_output}"
-                        elif result.get("stderr"):
-                            error_msg += f" - {result['stderr'].strip()}"
-                        elif result.get("compile_output"):
-                            error_msg += f" - {result['compile_output'].strip()}"
-                        
-                        errors.append(error_msg)
-                        break
-                else:
-                    errors.append(f"Test {i+1}: Timeout waiting for result")
-                    
-        except Exception as e:
-            print(f"Judge0 API error: {e}")
-            errors.append(f"API Error: {str(e)}")
-            # If Judge0 fails, fall back to fake tests
-            return run_fake_tests(code)
+    loop = asyncio.get_running_loop()
+    try:
+        error = await asyncio.wait_for(
+            loop.run_in_executor(get_precheck_pool(), precheck_source, code, PROBLEM_ENTRY_POINTS.get(problem_id)),
+            timeout=PRECHECK_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        print(f"Compile check timed out after {PRECHECK_TIMEOUT:g}s; recycling the precheck pool")
+        recycle_precheck_pool()
+        return None
+    except BrokenProcessPool:
+        recycle_precheck_pool()
+        return None
     
-    # Calculate average runtime
-    avg_runtime = int(total_runtime / total_tests) if total_tests > 0 and total_runtime > 0 else random.randint(50, 300)
+    if error is None:
+        return None
     
+    # Every case fails the same way, reported like the judge does
     return {
-        "passed": passed_tests,
+        "passed": 0,
         "total": total_tests,
-        "completed": passed_tests == total_tests,
-        "runtime": avg_runtime,
-        "errors": errors
+        "completed": False,
+        "runtime": 0,
+        "errors": [f"Test {i+1}: {error}" for i in range(total_tests)]
     }
 
+async def start_judge_backends():
+    """Start the judge backends that are configured for use"""
+    await get_judge_backend().start()
+    if JUDGE_FALLBACK == "local" and get_judge_backend() is not judge_backends["local"]:
+        await judge_backends["local"].start()
+    
+    # Start the compile check workers now rather than on the first submission
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[
+        loop.run_in_executor(get_precheck_pool(), precheck_source, "", None)
+        for _ in range(PRECHECK_WORKERS)
+    ])
+
+async def close_judge_backends():
+    """Release every judge backend's resources"""
+    global precheck_pool
+    for backend in judge_backends.values():
+        await backend.close()
+    if precheck_pool is not None:
+        precheck_pool.shutdown(wait=False, cancel_futures=True)
+        precheck_pool = None
+
 def get_two_sum_test_cases():
     """Return test cases for the Two Sum problem"""
     return [
@@ -385,179 +3858,434 @@ def run_fake_tests(code: str, problem_id: str = "two-sum") -> dict:
 def read_root():
     return {"message": "ShibaCoder API"}
 
+@app.put("/judge0/callback/{secret}")
+async def judge0_callback(secret: str, request: Request):
+    """Receive a finished submission from Judge0 (callback_url mode)"""
+    if not secrets.compare_digest(secret.encode(), JUDGE0_CALLBACK_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Invalid callback secret")
+    try:
+        # Judge0 always sends callbacks base64 encoded
+        result = judge0_decode_result(await request.json())
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Malformed callback")
+    if not judge0_resolve_callback(result):
+        raise HTTPException(status_code=404, detail="No finished submission")
+    return {"received": True}
+
+@app.get("/stats")
+def read_stats():
+    """Runtime metrics for capacity planning"""
+    return {
+        "judgeHttpPool": get_judge_http_pool_stats(),
+        "verdictCache": verdict_cache.stats(),
+        "submissionScheduler": submission_scheduler.stats(),
+        "lobbyListFeed": lobby_list_feed.stats(),
+        "outboxes": outboxes.stats(),
+        "frames": get_frame_stats(),
+        "events": dispatcher.stats(),
+        "liveCode": live_code.stats(),
+        "emojiReactions": emoji_reactions.stats(),
+        "spectators": spectator_rosters.stats(),
+        "spectatorChat": spectator_chat.stats(),
+        "gameScheduler": game_scheduler.stats(),
+        "lifecycle": lifecycle_reaper.stats(),
+        "cluster": cluster.stats(),
+        "sessions": sessions.stats()
+    }
+
+class Payload(BaseModel):
+    """Base for client event payloads: camelCase on the wire, strings stripped, defaults validated too"""
+    model_config = ConfigDict(populate_by_name=True, str_strip_whitespace=True, validate_default=True)
+
+def required(message: str):
+    """Validator for string fields that must not be empty, failing with message"""
+    def check(value: str) -> str:
+        if not value:
+            raise ValueError(message)
+        return value
+    return check
+
+class EmptyPayload(Payload):
+    pass
+
+class HelloPayload(Payload):
+    protocols: List[str] = ["json"]
+
+class ResumePayload(Payload):
+    resume_token: str = Field("", alias="resumeToken", max_length=200)
+    last_seq: int = Field(0, alias="lastSeq", ge=0)
+    
+    _resume_token_required = field_validator("resume_token")(required("Resume token is required"))
+
+class LobbyListPayload(Payload):
+    page: int = 1
+    search: str = Field("", max_length=100)
+
+class CreateLobbyPayload(Payload):
+    name: str = ""
+    type: str = "public"
+    pin: str = ""
+    elo_range: str = Field("easy", alias="eloRange")
+    player_name: str = Field("", alias="playerName")
+    
+    _name_required = field_validator("name")(required("Lobby name is required"))
+    
+    @field_validator("type")
+    @classmethod
+    def check_type(cls, value: str) -> str:
+        if value not in ("public", "private"):
+            raise ValueError("Lobby type must be 'public' or 'private'")
+        return value
+    
+    @model_validator(mode="after")
+    def check_pin(self):
+        # Validate pin for private lobbies
+        if self.type == "private":
+            if not self.pin:
+                raise ValueError("Pin is required for private lobbies")
+            if not validate_pin(self.pin):
+                raise ValueError("Pin must be exactly 4 digits")
+        return self
+
+class JoinLobbyPayload(Payload):
+    lobby_id: str = Field("", alias="lobbyId")
+    pin: str = ""
+    player_name: str = Field("", alias="playerName")
+    
+    _lobby_id_required = field_validator("lobby_id")(required("Lobby ID is required"))
+
+class SubmitCodePayload(Payload):
+    code: str = ""
+    language: str = "python"
+    fail_fast: Optional[bool] = Field(None, alias="failFast")
+    
+    _code_required = field_validator("code")(required("Code cannot be empty"))
+
+class SendAttackPayload(Payload):
+    attack_type: str = Field("flashbang", alias="attackType")
+
+class JoinAsSpectatorPayload(Payload):
+    lobby_id: str = Field("", alias="lobbyId")
+    spectator_name: str = Field("", alias="spectatorName")
+    
+    _lobby_id_required = field_validator("lobby_id")(required("Lobby ID is required"))
+
+class SpectatorChatPayload(Payload):
+    message: str = ""
+    
+    @field_validator("message")
+    @classmethod
+    def check_length(cls, value: str) -> str:
+        if len(value) > CHAT_MAX_LENGTH:
+            raise ValueError(f"Chat messages are limited to {CHAT_MAX_LENGTH} characters")
+        return value
+
+class SpectatorEmojiPayload(Payload):
+    emoji: str = Field("🔥", min_length=1, max_length=16)
+
+class SpectatorRosterPayload(Payload):
+    page: int = 1
+
+class WatchLiveCodePayload(Payload):
+    player_ids: Optional[List[str]] = Field(None, alias="playerIds")
+
+class ResyncLiveCodePayload(Payload):
+    player_id: Optional[str] = Field(None, alias="playerId")
+
+class CodeUpdatePayload(Payload):
+    model_config = ConfigDict(str_strip_whitespace=False)  # live code is shown as typed
+    
+    code: str = ""
+
+def describe_validation_error(error: ValidationError) -> str:
+    """First problem in a rejected payload, worded for the client"""
+    first = error.errors()[0]
+    if first["type"] == "value_error":
+        return str(first["ctx"]["error"])
+    field = ".".join(str(part) for part in first["loc"])
+    return f"Invalid {field}: {first['msg']}" if field else f"Invalid message: {first['msg']}"
+
+class EventDispatcher:
+    """Routes client events to handlers through a registry
+    
+    Each event is registered with its payload schema. The payload is validated once
+    before the handler runs, so handlers get typed fields and malformed messages never
+    reach them. Handler timing is kept per event.
+    """
+    
+    def __init__(self):
+        self.routes: Dict[str, dict] = {}
+        self.unknown = 0
+        self.malformed = 0
+    
+    def route(self, event: str, schema, quiet: bool = False):
+        """Decorator registering handler(client_id, payload) for event
+        
+        quiet routes drop rejected payloads without replying with an error.
+        """
+        def register(handler):
+            self.routes[event] = {
+                "handler": handler, "schema": schema, "quiet": quiet,
+                "calls": 0, "rejected": 0, "failed": 0, "total_time": 0.0, "max_time": 0.0
+            }
+            return handler
+        return register
+    
+    async def dispatch(self, client_id: str, message: dict):
+        try:
+            event, data = decode_frame(message)
+        except ValueError as e:
+            self.malformed += 1
+            await send_to_client(client_id, "error", {"message": str(e)})
+            return
+        
+        # Clients seated in another worker's lobby are handled there
+        if await cluster.forward(client_id, event, data):
+            return
+        await self.handle(client_id, event, data)
+    
+    async def handle(self, client_id: str, event: str, data):
+        route = self.routes.get(event)
+        if route is None:
+            self.unknown += 1
+            return
+        
+        try:
+            payload = route["schema"].model_validate(data)
+        except ValidationError as e:
+            route["rejected"] += 1
+            if not route["quiet"]:
+                await send_to_client(client_id, "error", {"message": describe_validation_error(e)})
+            return
+        
+        started = time.perf_counter()
+        try:
+            await route["handler"](client_id, payload)
+        except Exception:
+            route["failed"] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            route["calls"] += 1
+            route["total_time"] += elapsed
+            route["max_time"] = max(route["max_time"], elapsed)
+    
+    def stats(self) -> dict:
+        return {
+            "unknownEvents": self.unknown,
+            "malformedMessages": self.malformed,
+            "events": {
+                event: {
+                    "calls": route["calls"],
+                    "rejected": route["rejected"],
+                    "failed": route["failed"],
+                    "avgMs": round(route["total_time"] / route["calls"] * 1000, 3) if route["calls"] else 0,
+                    "maxMs": round(route["max_time"] * 1000, 3)
+                } for event, route in self.routes.items()
+            }
+        }
+
+dispatcher = EventDispatcher()
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """Main WebSocket endpoint for all real-time communication"""
-    await websocket.accept()
+    # Clients that offer the MessagePack subprotocol get binary frames from the start
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+        await websocket.accept(subprotocol=MSGPACK_SUBPROTOCOL)
+        protocol = "msgpack"
+    else:
+        await websocket.accept()
+        protocol = "json"
     client_id = f"client_{random.randint(100000, 999999)}"
+    while not await cluster.claim_client(client_id):
+        client_id = f"client_{random.randint(100000, 999999)}"
+    players[client_id] = Player(client_id)
     connections[client_id] = websocket
-    players[client_id] = {
-        "id": client_id,
-        "name": None,
-        "lobby": None,
-        "connected_at": time.time()
-    }
+    outboxes.open(client_id, websocket, protocol)
+    lifecycle_reaper.seen(client_id)
     
+    await send_to_client(client_id, "session", {
+        "clientId": client_id,
+        "resumeToken": sessions.issue(client_id),
+        "graceSeconds": sessions.grace
+    })
     print(f"Client {client_id} connected")
     
     try:
         while True:
             # Receive message
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            event = message.get("event")
-            payload = message.get("data", {})
-            
-            # Handle different events
-            if event == "get_lobby_list":
-                page = payload.get("page", 1)
-                search = payload.get("search", "")
-                lobby_data = get_public_lobbies(search=search, page=page)
-                await send_to_client(client_id, "lobby_list", lobby_data)
-                
-            elif event == "create_lobby":
-                await handle_create_lobby(client_id, payload)
-                
-            elif event == "join_lobby":
-                await handle_join_lobby(client_id, payload)
-                
-            elif event == "leave_lobby":
-                await handle_leave_lobby(client_id, payload)
-                
-            elif event == "player_ready":
-                await handle_player_ready(client_id, payload)
-                
-            elif event == "submit_code":
-                await handle_submit_code(client_id, payload)
-                
-            elif event == "send_attack":
-                await handle_send_attack(client_id, payload)
-                
-            elif event == "join_as_spectator":
-                await handle_join_as_spectator(client_id, payload)
-                
-            elif event == "spectator_chat":
-                await handle_spectator_chat(client_id, payload)
-                
-            elif event == "spectator_emoji":
-                await handle_spectator_emoji(client_id, payload)
-                
-            elif event == "code_update":
-                await handle_code_update(client_id, payload)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # A "resume" event may have given this connection an earlier client id
+            client_id = sessions.follow(client_id)
+            lifecycle_reaper.seen(client_id)
+            await dispatcher.dispatch(client_id, message)
                 
     except WebSocketDisconnect:
+        client_id = sessions.follow(client_id)
         print(f"Client {client_id} disconnected")
-        await handle_disconnect(client_id)
     except Exception as e:
+        client_id = sessions.follow(client_id)
         print(f"WebSocket error for {client_id}: {e}")
+    # A resumed session may already have moved this client id onto a new socket
+    if connections.get(client_id) is websocket:
         await handle_disconnect(client_id)
 
-async def handle_disconnect(client_id: str):
-    """Handle client disconnection"""
+@dispatcher.route("hello", HelloPayload)
+async def handle_hello(client_id: str, payload: HelloPayload):
+    """Negotiate the wire protocol: the reply goes out in the old protocol, then the new one applies"""
+    protocol = "msgpack" if "msgpack" in payload.protocols and msgpack is not None else "json"
+    # Tables go out as lists so compacting can't rewrite them: events[code], fields [[name, code]]
+    await send_to_client(client_id, "hello", {
+        "protocol": protocol,
+        "events": WIRE_EVENTS,
+        "fields": [[field, code] for field, code in WIRE_FIELD_CODES.items()]
+    })
+    if client_id in outboxes.protocols:
+        outboxes.protocols[client_id] = protocol
+
+@dispatcher.route("pong", EmptyPayload, quiet=True)
+async def handle_pong(client_id: str, payload: EmptyPayload):
+    """Heartbeat reply; receiving it already counted as a sign of life"""
+
+@dispatcher.route("resume", ResumePayload)
+async def handle_resume(client_id: str, payload: ResumePayload):
+    """Take back a dropped session: this connection becomes the client the token belongs to"""
+    if players[client_id].lobby or client_id in cluster.homes or client_id in cluster.joining:
+        await send_to_client(client_id, "error", {"message": "Resume before joining a lobby"})
+        return
+    owner = sessions.owner(payload.resume_token)
+    if cluster.enabled and owner != NODE_ID and owner in cluster.live:
+        sessions.forwarded += 1
+        cluster.resume(owner, client_id, payload.resume_token, payload.last_seq)
+        return
+    resumed_id = sessions.take(payload.resume_token)
+    if resumed_id is None:
+        await send_to_client(client_id, "lobby_left", {"message": "Your session expired"})
+        return
+    sessions.adopt(client_id, resumed_id)
+    await sessions.welcome_back(resumed_id, payload.last_seq)
+
+@dispatcher.route("get_lobby_list", LobbyListPayload)
+async def handle_get_lobby_list(client_id: str, payload: LobbyListPayload):
+    """One-off lobby list request"""
+    lobby_data = get_public_lobbies(search=payload.search, page=payload.page)
+    await send_to_client(client_id, "lobby_list", lobby_data)
+
+@dispatcher.route("subscribe_lobby_list", LobbyListPayload)
+async def handle_subscribe_lobby_list(client_id: str, payload: LobbyListPayload):
+    lobby_data = lobby_list_feed.subscribe(client_id, payload.page, payload.search)
+    await send_to_client(client_id, "lobby_list", lobby_data)
+
+@dispatcher.route("unsubscribe_lobby_list", EmptyPayload)
+async def handle_unsubscribe_lobby_list(client_id: str, payload: EmptyPayload):
+    lobby_list_feed.unsubscribe(client_id)
+
+async def handle_disconnect(client_id: str, resumable: bool = True):
+    """Handle client disconnection
+    
+    A seated player's seat is held for the resume grace window first (unless
+    resumable is False); they are only removed if they don't come back.
+    """
+    if resumable and sessions.hold(client_id):
+        print(f"Holding {client_id}'s seat for {sessions.grace:g}s")
+        lobby_list_feed.unsubscribe(client_id)
+        lifecycle_reaper.forget(client_id)
+        connections.pop(client_id, None)
+        outboxes.close(client_id)
+        return
+    
+    submission_scheduler.cancel(client_id)
+    lobby_list_feed.unsubscribe(client_id)
+    live_code.forget_spectator(client_id)
+    spectator_chat.forget_sender(client_id)
+    lifecycle_reaper.forget(client_id)
+    if client_id in connections:
+        cluster.disconnected(client_id)
+    
     if client_id in players:
         player = players[client_id]
-        if player["lobby"]:
-            lobby_id = player["lobby"]
+        if player.lobby:
+            lobby_id = player.lobby
             if lobby_id in lobbies:
                 lobby = lobbies[lobby_id]
-                player_name = player["name"]
-                player_role = player.get("role", "player")
+                player_name = player.name
                 
-                if player_role == "spectator":
-                    # Remove from spectators list
-                    if "spectators" in lobby:
-                        lobby["spectators"] = [s for s in lobby["spectators"] if s["id"] != client_id]
+                if player.role == "spectator":
+                    # Remove from spectators; the audience hears about it in the next roster delta
+                    if spectator_rosters.remove(lobby, client_id):
                         print(f"Spectator {player_name} disconnected from lobby {lobby_id}")
-                        # Notify other spectators
-                        await broadcast_to_spectators(lobby_id, "spectator_list_update", {
-                            "spectators": lobby["spectators"]
-                        })
                 else:
                     # Remove player from lobby
-                    lobby["players"] = [p for p in lobby["players"] if p["id"] != client_id]
+                    lobby.players.pop(client_id, None)
+                    live_code.discard_player(lobby_id, client_id)
                     
-                    print(f"{player_name} disconnected from lobby '{lobby['name']}' ({lobby_id})")
+                    print(f"{player_name} disconnected from lobby '{lobby.name}' ({lobby_id})")
                     
                     # If lobby is empty, delete it
-                    if len(lobby["players"]) == 0:
-                        del lobbies[lobby_id]
+                    if not lobby.players:
+                        delete_lobby(lobby_id)
                         print(f"Lobby {lobby_id} deleted - no players remaining")
                         await broadcast_lobby_list_update()
                     else:
+                        await cancel_countdown(lobby_id)
+                        
                         # Notify remaining players
                         await broadcast_to_lobby(lobby_id, "player_left", {
                             "playerName": player_name,
-                            "playerCount": len(lobby["players"]),
-                            "players": lobby["players"]
+                            "playerCount": len(lobby.players),
+                            "players": public_players(lobby)
                         })
         
         del players[client_id]
     
     if client_id in connections:
         del connections[client_id]
+    outboxes.close(client_id)
+    sessions.forget(client_id)
 
-async def handle_create_lobby(client_id: str, data: dict):
+@dispatcher.route("create_lobby", CreateLobbyPayload)
+async def handle_create_lobby(client_id: str, payload: CreateLobbyPayload):
     """Handle lobby creation"""
     try:
-        lobby_name = data.get("name", "").strip()
-        lobby_type = data.get("type", "public")
-        pin = data.get("pin", "")
-        elo_range = data.get("eloRange", "easy")
-        
-        if not lobby_name:
-            await send_to_client(client_id, "error", {"message": "Lobby name is required"})
-            return
-        
-        if lobby_type not in ["public", "private"]:
-            await send_to_client(client_id, "error", {"message": "Lobby type must be 'public' or 'private'"})
-            return
-        
-        # Validate pin for private lobbies
-        if lobby_type == "private":
-            if not pin:
-                await send_to_client(client_id, "error", {"message": "Pin is required for private lobbies"})
-                return
-            if not validate_pin(pin):
-                await send_to_client(client_id, "error", {"message": "Pin must be exactly 4 digits"})
-                return
+        lobby_name = payload.name
+        lobby_type = payload.type
+        pin = payload.pin
+        elo_range = payload.elo_range
         
         # Generate unique lobby ID
         lobby_id = generate_lobby_id()
-        while lobby_id in lobbies:
+        while not await cluster.claim_lobby(lobby_id):
             lobby_id = generate_lobby_id()
         
         # Get player name from request, localStorage, or generate one
-        player_name = data.get("playerName", "").strip()
+        player_name = payload.player_name
         if not player_name:
-            player_name = players[client_id].get("name") or f"Player{client_id[-8:]}"
-        
-        # Create lobby
-        lobbies[lobby_id] = {
-            "id": lobby_id,
-            "name": lobby_name,
-            "type": lobby_type,
-            "pin": pin if lobby_type == "private" else None,
-            "status": "waiting",
-            "elo_range": elo_range,
-            "players": [{
-                "id": client_id,
-                "name": player_name,
-                "ready": False
-            }],
-            "spectators": [],  # New: spectator support
-            "maxPlayers": 2,
-            "createdAt": time.time()
-        }
+            player_name = players[client_id].name or f"Player{client_id[-8:]}"
         
-        # Update player info
-        players[client_id]["name"] = player_name
-        players[client_id]["lobby"] = lobby_id
+        # Create lobby, with its creator seated
+        lobby = Lobby(
+            id=lobby_id,
+            name=lobby_name,
+            type=lobby_type,
+            pin=pin if lobby_type == "private" else None,
+            elo_range=elo_range
+        )
+        player = players[client_id]
+        player.seat(lobby_id, "player", player_name)
+        lobby.players[client_id] = player
+        lobbies[lobby_id] = lobby
+        lobby_registry.sync(lobby)
+        lobby_list_feed.unsubscribe(client_id)
         
         print(f"Lobby '{lobby_name}' ({lobby_id}) created by {player_name}")
         
         await send_to_client(client_id, "lobby_created", {
             "lobbyId": lobby_id,
-            "lobbyData": lobbies[lobby_id]
+            "lobbyData": member_lobby(lobby),
+            "eventSeq": event_log.current(lobby_id)
         })
         
         # Broadcast lobby list update to all connected clients
@@ -566,15 +4294,12 @@ async def handle_create_lobby(client_id: str, data: dict):
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to create lobby: {str(e)}"})
 
-async def handle_join_lobby(client_id: str, data: dict):
+@dispatcher.route("join_lobby", JoinLobbyPayload)
+async def handle_join_lobby(client_id: str, payload: JoinLobbyPayload):
     """Handle joining a lobby"""
     try:
-        lobby_id = data.get("lobbyId", "").strip()
-        pin = data.get("pin", "").strip()
-        
-        if not lobby_id:
-            await send_to_client(client_id, "error", {"message": "Lobby ID is required"})
-            return
+        lobby_id = payload.lobby_id
+        pin = payload.pin
         
         # Check if lobby exists
         if lobby_id not in lobbies:
@@ -584,60 +4309,56 @@ async def handle_join_lobby(client_id: str, data: dict):
         lobby = lobbies[lobby_id]
         
         # Check if lobby is full
-        if len(lobby["players"]) >= lobby["maxPlayers"]:
+        if lobby.is_full():
             await send_to_client(client_id, "error", {"message": "Lobby is full"})
             return
         
         # Check if game already started
-        if lobby["status"] != "waiting":
+        if lobby.status != "waiting":
             await send_to_client(client_id, "error", {"message": "Game already in progress"})
             return
         
         # Check if player already in a lobby
-        if players[client_id]["lobby"]:
+        if players[client_id].lobby:
             await send_to_client(client_id, "error", {"message": "You are already in a lobby"})
             return
         
         # Verify pin for private lobbies
-        if lobby["type"] == "private":
+        if lobby.type == "private":
             if not pin:
                 await send_to_client(client_id, "error", {"message": "Pin is required for private lobbies"})
                 return
-            if pin != lobby["pin"]:
+            if pin != lobby.pin:
                 await send_to_client(client_id, "error", {"message": "Incorrect pin"})
                 return
         
         # Get player name from request or generate one
-        player_name = data.get("playerName", "").strip()
+        player_name = payload.player_name
         if not player_name:
-            player_name = players[client_id].get("name") or f"Player{client_id[-8:]}"
-        
-        # Add player to lobby
-        lobby["players"].append({
-            "id": client_id,
-            "name": player_name,
-            "ready": False
-        })
+            player_name = players[client_id].name or f"Player{client_id[-8:]}"
         
-        # Update player info
-        players[client_id]["name"] = player_name
-        players[client_id]["lobby"] = lobby_id
+        # Seat the player in the lobby
+        player = players[client_id]
+        player.seat(lobby_id, "player", player_name)
+        lobby.players[client_id] = player
+        lobby_list_feed.unsubscribe(client_id)
         
-        print(f"{player_name} joined lobby '{lobby['name']}' ({lobby_id})")
+        print(f"{player_name} joined lobby '{lobby.name}' ({lobby_id})")
         
         # Send confirmation to joining player
         await send_to_client(client_id, "lobby_joined", {
             "lobbyId": lobby_id,
-            "lobbyData": lobby,
-            "playerCount": len(lobby["players"])
+            "lobbyData": member_lobby(lobby),
+            "playerCount": len(lobby.players),
+            "eventSeq": event_log.current(lobby_id)
         })
         
         # Notify all players in lobby about the new player
         await broadcast_to_lobby(lobby_id, "player_joined", {
             "playerName": player_name,
-            "playerCount": len(lobby["players"]),
-            "maxPlayers": lobby["maxPlayers"],
-            "players": lobby["players"]
+            "playerCount": len(lobby.players),
+            "maxPlayers": lobby.max_players,
+            "players": public_players(lobby)
         })
         
         # Broadcast lobby list update since player count changed
@@ -646,58 +4367,186 @@ async def handle_join_lobby(client_id: str, data: dict):
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to join lobby: {str(e)}"})
 
-async def handle_leave_lobby(client_id: str, data: dict):
+@dispatcher.route("leave_lobby", EmptyPayload)
+async def handle_leave_lobby(client_id: str, payload: EmptyPayload):
     """Handle leaving a lobby"""
     try:
-        if client_id not in players or not players[client_id]["lobby"]:
+        if client_id not in players or not players[client_id].lobby:
             await send_to_client(client_id, "error", {"message": "You are not in a lobby"})
             return
         
-        lobby_id = players[client_id]["lobby"]
+        lobby_id = players[client_id].lobby
         
         if lobby_id not in lobbies:
             # Cleanup orphaned player reference
-            players[client_id]["lobby"] = None
+            players[client_id].unseat()
             return
         
         lobby = lobbies[lobby_id]
-        player_name = players[client_id]["name"]
+        player_name = players[client_id].name
+        
+        # Spectators just leave the audience
+        if players[client_id].role == "spectator":
+            spectator_rosters.remove(lobby, client_id)
+            live_code.forget_spectator(client_id)
+            players[client_id].unseat()
+            print(f"Spectator {player_name} left lobby {lobby_id}")
+            await send_to_client(client_id, "lobby_left", {"message": "Left lobby successfully"})
+            return
         
         # Remove player from lobby
-        lobby["players"] = [p for p in lobby["players"] if p["id"] != client_id]
+        lobby.players.pop(client_id, None)
+        live_code.discard_player(lobby_id, client_id)
         
         # Update player info
-        players[client_id]["lobby"] = None
+        players[client_id].unseat()
         
-        print(f"{player_name} left lobby '{lobby['name']}' ({lobby_id})")
+        print(f"{player_name} left lobby '{lobby.name}' ({lobby_id})")
         
         # Send confirmation to leaving player
         await send_to_client(client_id, "lobby_left", {"message": "Left lobby successfully"})
         
         # If lobby is empty, delete it
-        if len(lobby["players"]) == 0:
-            del lobbies[lobby_id]
+        if not lobby.players:
+            delete_lobby(lobby_id)
             print(f"Lobby {lobby_id} deleted - no players remaining")
             await broadcast_lobby_list_update()
         else:
+            await cancel_countdown(lobby_id)
+            
             # Notify remaining players
             await broadcast_to_lobby(lobby_id, "player_left", {
                 "playerName": player_name,
-                "playerCount": len(lobby["players"]),
-                "players": lobby["players"]
+                "playerCount": len(lobby.players),
+                "players": public_players(lobby)
             })
         
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to leave lobby: {str(e)}"})
 
-async def handle_player_ready(client_id: str, data: dict):
+async def countdown_step(lobby_id: str, remaining: int):
+    """Send one countdown_update and schedule the next second, or start the game at zero"""
+    if lobby_id not in lobbies or lobbies[lobby_id].status != "waiting":
+        return
+    if remaining <= 0:
+        await start_game(lobby_id)
+        return
+    await broadcast_to_lobby(lobby_id, "countdown_update", {"countdown": remaining})
+    game_scheduler.schedule(lobby_id, "countdown", 1, countdown_step, lobby_id, remaining - 1)
+
+async def cancel_countdown(lobby_id: str):
+    """A player left mid-countdown: stop it and clear the lobby's countdown display"""
+    if game_scheduler.cancel(lobby_id, "countdown"):
+        print(f"Countdown cancelled in lobby {lobby_id}")
+        await broadcast_to_lobby(lobby_id, "countdown_update", {"countdown": None})
+
+async def start_game(lobby_id: str):
+    """Countdown finished: switch the lobby to playing and send the problem"""
+    if lobby_id not in lobbies or lobbies[lobby_id].status != "waiting":
+        return
+    
+    # Start the game!
+    lobby = lobbies[lobby_id]
+    lobby.status = "playing"
+    lobby_registry.sync(lobby)
+    lobby.started_at = time.time()
+    
+    print(f"Game started in lobby {lobby_id}!")
+    
+    # Add the hardcoded Two Sum problem
+    game_problem = {
+        "id": "two-sum",
+        "title": "Two Sum", 
+        "description": "Given an array of integers nums and an integer target, return indices of the two numbers such that they add up to target. Input: First line contains the array as a string (e.g., [2,7,11,15]), second line contains the target integer.",
+        "examples": [
+            {
+                "input": "[2,7,11,15]\n9",
+                "output": "[0, 1]",
+                "explanation": "Because nums[0] + nums[1] == 9, we return [0, 1]."
+            }
+        ],
+        "template": """# Read input
+import sys
+lines = sys.stdin.read().strip().split('\\n')
+nums = eval(lines[0])  # Parse array from string
+target = int(lines[1])
+
+# Your solution here
+def two_sum(nums, target):
+    # Write your solution here
+    pass
+
+# Call function and print result
+result = two_sum(nums, target)
+print(result)""",
+        "timeLimit": GAME_TIME_LIMIT
+    }
+    
+    lobby.problem = game_problem
+    
+    await broadcast_to_lobby(lobby_id, "game_start", {
+        "problem": game_problem,
+        "players": [{
+            "id": player.id,
+            "name": player.name
+        } for player in lobby.players.values()],
+        "timeLimit": game_problem["timeLimit"]
+    })
+    
+    # The game ends when someone solves it or time runs out
+    game_scheduler.schedule(lobby_id, "deadline", game_problem["timeLimit"], finish_game_on_time, lobby_id)
+    
+    # Broadcast lobby list update since game started (lobby no longer visible in waiting list)
+    await broadcast_lobby_list_update()
+
+def final_scores(lobby: Lobby) -> list:
+    """Per-player results for game_finished"""
+    return [{
+        **player_progress(player),
+        "completion_time": player.last_submission - lobby.started_at if player.completed else None
+    } for player in lobby.players.values()]
+
+async def finish_game(lobby_id: str, winner_id: Optional[str], reason: str):
+    """End a game once: record the winner (None for a draw) and tell the lobby"""
+    if lobby_id not in lobbies or lobbies[lobby_id].status != "playing":
+        return
+    lobby = lobbies[lobby_id]
+    winner = lobby.players.get(winner_id)
+    winner_name = winner.name if winner is not None else None
+    
+    lobby.status = "finished"
+    lobby_registry.sync(lobby)
+    lobby.ended_at = time.time()
+    lobby.winner = winner_name
+    game_scheduler.cancel_lobby(lobby_id)
+    
+    await broadcast_to_lobby(lobby_id, "game_finished", {
+        "winner": winner_name,
+        "winner_id": winner_id,
+        "reason": reason,
+        "final_scores": final_scores(lobby),
+        "game_duration": lobby.ended_at - lobby.started_at
+    })
+    
+    print(f"Game finished in lobby {lobby_id} ({reason}). Winner: {winner_name}")
+
+async def finish_game_on_time(lobby_id: str):
+    """Time limit reached: whoever passed the most tests (first) wins; no tests passed is a draw"""
+    if lobby_id not in lobbies:
+        return
+    contenders = [player for player in lobbies[lobby_id].players.values() if player.tests_passed > 0]
+    best = min(contenders, key=lambda player: (-player.tests_passed, player.last_submission), default=None)
+    await finish_game(lobby_id, best.id if best else None, "time_up")
+
+@dispatcher.route("player_ready", EmptyPayload)
+async def handle_player_ready(client_id: str, payload: EmptyPayload):
     """Handle player ready state"""
     try:
-        if client_id not in players or not players[client_id]["lobby"]:
+        if client_id not in players or not players[client_id].lobby:
             await send_to_client(client_id, "error", {"message": "You are not in a lobby"})
             return
         
-        lobby_id = players[client_id]["lobby"]
+        lobby_id = players[client_id].lobby
         
         if lobby_id not in lobbies:
             await send_to_client(client_id, "error", {"message": "Lobby not found"})
@@ -707,110 +4556,53 @@ async def handle_player_ready(client_id: str, data: dict):
         
         # No need to check player count - allow ready even when alone
         
-        # Find and update player ready state
-        player_found = False
-        for player in lobby["players"]:
-            if player["id"] == client_id:
-                player["ready"] = True
-                player_found = True
-                break
-        
-        if not player_found:
+        # Update player ready state
+        player = lobby.players.get(client_id)
+        if player is None:
             await send_to_client(client_id, "error", {"message": "Player not found in lobby"})
             return
+        player.ready = True
         
-        player_name = players[client_id]["name"]
+        player_name = players[client_id].name
         print(f"{player_name} is ready in lobby {lobby_id}")
         
         # Broadcast ready state to all players in lobby
         await broadcast_to_lobby(lobby_id, "player_ready_update", {
             "playerName": player_name,
             "players": [{
-                "id": p["id"],
-                "name": p["name"], 
-                "ready": p["ready"]
-            } for p in lobby["players"]]
+                "id": p.id,
+                "name": p.name, 
+                "ready": p.ready
+            } for p in lobby.players.values()]
         })
         
         # Check if all players are ready
-        all_ready = all(player["ready"] for player in lobby["players"])
+        all_ready = all(player.ready for player in lobby.players.values())
         
-        if all_ready and len(lobby["players"]) == lobby["maxPlayers"]:
+        if all_ready and lobby.is_full() and not game_scheduler.pending(lobby_id, "countdown"):
             # Start countdown
             print(f"All players ready in lobby {lobby_id} - starting countdown!")
             
             # Broadcast countdown start
             await broadcast_to_lobby(lobby_id, "countdown_start", {
-                "countdown": 3
-            })
-            
-            # Wait 3 seconds with countdown updates
-            for i in range(3, 0, -1):
-                await broadcast_to_lobby(lobby_id, "countdown_update", {
-                    "countdown": i
-                })
-                await asyncio.sleep(1)
-            
-            # Start the game!
-            lobby["status"] = "playing"
-            lobby["started_at"] = time.time()
-            
-            print(f"Game started in lobby {lobby_id}!")
-            
-            # Add the hardcoded Two Sum problem
-            game_problem = {
-                "id": "two-sum",
-                "title": "Two Sum", 
-                "description": "Given an array of integers nums and an integer target, return indices of the two numbers such that they add up to target. Input: First line contains the array as a string (e.g., [2,7,11,15]), second line contains the target integer.",
-                "examples": [
-                    {
-                        "input": "[2,7,11,15]\n9",
-                        "output": "[0, 1]",
-                        "explanation": "Because nums[0] + nums[1] == 9, we return [0, 1]."
-                    }
-                ],
-                "template": """# Read input
-import sys
-lines = sys.stdin.read().strip().split('\\n')
-nums = eval(lines[0])  # Parse array from string
-target = int(lines[1])
-
-# Your solution here
-def two_sum(nums, target):
-    # Write your solution here
-    pass
-
-# Call function and print result
-result = two_sum(nums, target)
-print(result)""",
-                "timeLimit": 300  # 5 minutes
-            }
-            
-            lobby["problem"] = game_problem
-            
-            await broadcast_to_lobby(lobby_id, "game_start", {
-                "problem": game_problem,
-                "players": [{
-                    "id": p["id"],
-                    "name": p["name"]
-                } for p in lobby["players"]],
-                "timeLimit": game_problem["timeLimit"]
+                "countdown": GAME_COUNTDOWN
             })
             
-            # Broadcast lobby list update since game started (lobby no longer visible in waiting list)
-            await broadcast_lobby_list_update()
+            # The scheduler ticks the countdown down and starts the game; nothing waits here
+            await countdown_step(lobby_id, GAME_COUNTDOWN)
         
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to update ready state: {str(e)}"})
 
-async def handle_submit_code(client_id: str, data: dict):
+@dispatcher.route("submit_code", SubmitCodePayload)
+async def handle_submit_code(client_id: str, payload: SubmitCodePayload):
     """Handle code submission and execute tests"""
     try:
-        if client_id not in players or not players[client_id]["lobby"]:
+        if client_id not in players or not players[client_id].lobby:
             await send_to_client(client_id, "error", {"message": "You are not in a lobby"})
             return
         
-        lobby_id = players[client_id]["lobby"]
+        lobby_id = players[client_id].lobby
         
         if lobby_id not in lobbies:
             await send_to_client(client_id, "error", {"message": "Lobby not found"})
@@ -819,53 +4611,87 @@ async def handle_submit_code(client_id: str, data: dict):
         lobby = lobbies[lobby_id]
         
         # Check if game is in progress
-        if lobby["status"] != "playing":
+        if lobby.status != "playing":
             await send_to_client(client_id, "error", {"message": "Game is not in progress"})
             return
         
         # Get submitted code
-        submitted_code = data.get("code", "").strip()
-        language = data.get("language", "python")
-        
-        if not submitted_code:
-            await send_to_client(client_id, "error", {"message": "Code cannot be empty"})
-            return
+        submitted_code = payload.code
+        language = payload.language
         
         # Find player in lobby and update their code
-        player_found = False
-        for player in lobby["players"]:
-            if player["id"] == client_id:
-                player["code"] = submitted_code
-                player["last_submission"] = time.time()
-                player_found = True
-                break
-        
-        if not player_found:
+        player = lobby.players.get(client_id)
+        if player is None:
             await send_to_client(client_id, "error", {"message": "Player not found in lobby"})
             return
+        player.code = submitted_code
+        player.last_submission = time.time()
         
-        player_name = players[client_id]["name"]
+        player_name = players[client_id].name
         print(f"{player_name} submitted code in lobby {lobby_id}")
         
+        fail_fast = JUDGE_FAIL_FAST if payload.fail_fast is None else payload.fail_fast
+        
+        # Judge in the background so this client's receive loop stays free;
+        # a newer submission from the same player replaces this one
+        accepted = submission_scheduler.submit(
+            client_id, lobby_id,
+            lambda: judge_submission(client_id, lobby_id, submitted_code, language, fail_fast)
+        )
+        
+        if not accepted:
+            await send_to_client(client_id, "busy", {
+                "message": "The judge is busy, please submit again in a moment",
+                "queueDepth": len(submission_scheduler.queued)
+            })
+        
+    except Exception as e:
+        await send_to_client(client_id, "error", {"message": f"Failed to submit code: {str(e)}"})
+
+async def judge_submission(client_id: str, lobby_id: str, submitted_code: str, language: str, fail_fast: bool):
+    """Run a submission's tests and publish the results (scheduled by handle_submit_code)"""
+    try:
+        if lobby_id not in lobbies or client_id not in players:
+            return
+        
+        lobby = lobbies[lobby_id]
+        player_name = players[client_id].name
+        
         # Get test cases for the problem
-        if lobby["problem"]["id"] == "two-sum":
+        if lobby.problem["id"] == "two-sum":
             test_cases = get_two_sum_test_cases()
         else:
             test_cases = get_two_sum_test_cases()  # Default fallback
         
-        # Submit code to Judge0 API
-        test_results = await judge0_submit_code(submitted_code, test_cases)
+        async def report_test_case(index: int, test_result: dict):
+            """Stream each finished test case to the submitter and spectators"""
+            case_data = {
+                "player_id": client_id,
+                "player_name": player_name,
+                "test": index + 1,
+                "total": len(test_cases),
+                "passed": test_result["passed"],
+                "runtime": int(test_result["runtime"]),
+                "error": test_result["error"]
+            }
+            await send_to_client(client_id, "test_case_result", case_data)
+            await broadcast_to_spectators(lobby_id, "test_case_result", case_data)
+        
+        # Code that doesn't compile fails here in milliseconds; the rest goes to the judge
+        # (identical resubmissions hit the cache)
+        test_results = await precheck_submission(submitted_code, language, lobby.problem["id"], len(test_cases))
+        if test_results is None:
+            test_results = await run_tests_cached(submitted_code, language, test_cases, report_test_case, fail_fast)
         
         # Update player progress
-        for player in lobby["players"]:
-            if player["id"] == client_id:
-                player["tests_passed"] = test_results["passed"]
-                player["total_tests"] = test_results["total"]
-                player["completed"] = test_results["completed"]
-                break
+        player = lobby.players.get(client_id)
+        if player is not None:
+            player.tests_passed = test_results["passed"]
+            player.total_tests = test_results["total"]
+            player.completed = test_results["completed"]
         
         # Send test results to submitting player
-        await send_to_client(client_id, "test_results", {
+        await send_to_player(lobby_id, client_id, "test_results", {
             "passed": test_results["passed"],
             "total": test_results["total"],
             "completed": test_results["completed"],
@@ -875,51 +4701,25 @@ async def handle_submit_code(client_id: str, data: dict):
         
         # Broadcast progress update to all players in lobby
         await broadcast_to_lobby(lobby_id, "progress_update", {
-            "players": [{
-                "name": p["name"],
-                "tests_passed": p.get("tests_passed", 0),
-                "total_tests": p.get("total_tests", 5),
-                "completed": p.get("completed", False)
-            } for p in lobby["players"]]
+            "players": [player_progress(p) for p in lobby.players.values()]
         })
         
-        # Check for winner
+        # Check for winner (the opponent may have won while this submission was judged)
         if test_results["completed"]:
-            lobby["status"] = "finished"
-            lobby["ended_at"] = time.time()
-            lobby["winner"] = player_name
-            
-            # Calculate final scores
-            final_scores = []
-            for p in lobby["players"]:
-                final_scores.append({
-                    "name": p["name"],
-                    "tests_passed": p.get("tests_passed", 0),
-                    "total_tests": p.get("total_tests", 5),
-                    "completed": p.get("completed", False),
-                    "completion_time": p.get("last_submission", 0) - lobby.get("started_at", 0) if p.get("completed") else None
-                })
-            
-            await broadcast_to_lobby(lobby_id, "game_finished", {
-                "winner": player_name,
-                "winner_id": client_id,
-                "final_scores": final_scores,
-                "game_duration": lobby["ended_at"] - lobby["started_at"]
-            })
-            
-            print(f"Game finished in lobby {lobby_id}. Winner: {player_name}")
+            await finish_game(lobby_id, client_id, "solved")
         
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to submit code: {str(e)}"})
 
-async def handle_send_attack(client_id: str, data: dict):
+@dispatcher.route("send_attack", SendAttackPayload)
+async def handle_send_attack(client_id: str, payload: SendAttackPayload):
     """Handle attack sending between players"""
     try:
-        if client_id not in players or not players[client_id]["lobby"]:
+        if client_id not in players or not players[client_id].lobby:
             await send_to_client(client_id, "error", {"message": "You are not in a lobby"})
             return
         
-        lobby_id = players[client_id]["lobby"]
+        lobby_id = players[client_id].lobby
         
         if lobby_id not in lobbies:
             await send_to_client(client_id, "error", {"message": "Lobby not found"})
@@ -928,41 +4728,34 @@ async def handle_send_attack(client_id: str, data: dict):
         lobby = lobbies[lobby_id]
         
         # Check if game is in progress
-        if lobby["status"] != "playing":
+        if lobby.status != "playing":
             await send_to_client(client_id, "error", {"message": "Game is not in progress"})
             return
         
         # Get attack type
-        attack_type = data.get("attackType", "flashbang")
+        attack_type = payload.attack_type
         
         # Find opponent
-        opponent_id = None
-        for player in lobby["players"]:
-            if player["id"] != client_id:
-                opponent_id = player["id"]
-                break
+        opponent_id = next((player_id for player_id in lobby.players if player_id != client_id), None)
         
-        if opponent_id and opponent_id in connections:
+        if opponent_id and opponent_id in players:
             # Send attack to opponent
-            await send_to_client(opponent_id, "attack_received", {
+            await send_to_player(lobby_id, opponent_id, "attack_received", {
                 "attackType": attack_type,
-                "attacker": players[client_id]["name"]
+                "attacker": players[client_id].name
             })
             
-            print(f"Attack '{attack_type}' sent from {players[client_id]['name']} to opponent in lobby {lobby_id}")
+            print(f"Attack '{attack_type}' sent from {players[client_id].name} to opponent in lobby {lobby_id}")
         
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to send attack: {str(e)}"})
 
-async def handle_join_as_spectator(client_id: str, data: dict):
+@dispatcher.route("join_as_spectator", JoinAsSpectatorPayload)
+async def handle_join_as_spectator(client_id: str, payload: JoinAsSpectatorPayload):
     """Handle joining a lobby as spectator"""
     try:
-        lobby_id = data.get("lobbyId", "").strip()
-        spectator_name = data.get("spectatorName", "").strip()
-        
-        if not lobby_id:
-            await send_to_client(client_id, "error", {"message": "Lobby ID is required"})
-            return
+        lobby_id = payload.lobby_id
+        spectator_name = payload.spectator_name
         
         if lobby_id not in lobbies:
             await send_to_client(client_id, "error", {"message": "Lobby not found"})
@@ -971,105 +4764,94 @@ async def handle_join_as_spectator(client_id: str, data: dict):
         lobby = lobbies[lobby_id]
         
         # Check if already in a lobby
-        if players[client_id]["lobby"]:
+        if players[client_id].lobby:
             await send_to_client(client_id, "error", {"message": "You are already in a lobby"})
             return
         
         if not spectator_name:
             spectator_name = f"Spectator{client_id[-8:]}"
         
-        # Add to spectators (ensure spectators array exists for old lobbies)
-        if "spectators" not in lobby:
-            lobby["spectators"] = []
-        lobby["spectators"].append({
-            "id": client_id,
-            "name": spectator_name
-        })
-        
-        # Update player info
-        players[client_id]["name"] = spectator_name
-        players[client_id]["lobby"] = lobby_id
-        players[client_id]["role"] = "spectator"
+        # Add to spectators; the audience hears about it in the next roster delta
+        spectator = players[client_id]
+        spectator.seat(lobby_id, "spectator", spectator_name)
+        spectator_rosters.add(lobby, spectator)
+        lobby_list_feed.unsubscribe(client_id)
         
         print(f"{spectator_name} joined as spectator in lobby {lobby_id}")
         
         # Send lobby data to spectator
         await send_to_client(client_id, "spectator_joined", {
             "lobbyId": lobby_id,
-            "lobbyData": lobby
+            "lobbyData": public_lobby(lobby),
+            "chatHistory": spectator_chat.recent(lobby_id)
         })
         
-        # Notify other spectators
-        await broadcast_to_spectators(lobby_id, "spectator_list_update", {
-            "spectators": lobby["spectators"]
-        })
+        # Late joiners start from the code spectators already have
+        live_code.send_snapshots(client_id, lobby_id)
         
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to join as spectator: {str(e)}"})
 
-async def handle_spectator_chat(client_id: str, data: dict):
+@dispatcher.route("spectator_chat", SpectatorChatPayload)
+async def handle_spectator_chat(client_id: str, payload: SpectatorChatPayload):
     """Handle spectator chat messages"""
     try:
-        if client_id not in players or not players[client_id]["lobby"]:
+        if client_id not in players or not players[client_id].lobby:
             await send_to_client(client_id, "error", {"message": "You are not in a lobby"})
             return
         
-        if players[client_id].get("role") != "spectator":
+        if players[client_id].role != "spectator":
             await send_to_client(client_id, "error", {"message": "Only spectators can chat"})
             return
         
-        lobby_id = players[client_id]["lobby"]
-        message = data.get("message", "").strip()
+        lobby_id = players[client_id].lobby
+        message = payload.message
         
         if not message:
             return
         
-        # Broadcast chat to all spectators
-        await broadcast_to_spectators(lobby_id, "spectator_chat_message", {
-            "spectatorName": players[client_id]["name"],
-            "message": message,
-            "timestamp": time.time()
-        })
+        if not spectator_chat.allow(client_id):
+            await send_to_client(client_id, "error", {"message": "You're sending messages too fast"})
+            return
+        
+        # Goes out to all spectators with the rest of this tick's messages
+        spectator_chat.post(lobby_id, players[client_id].name, message)
         
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to send chat: {str(e)}"})
 
-async def handle_spectator_emoji(client_id: str, data: dict):
+@dispatcher.route("spectator_emoji", SpectatorEmojiPayload)
+async def handle_spectator_emoji(client_id: str, payload: SpectatorEmojiPayload):
     """Handle spectator emoji reactions"""
     try:
-        if client_id not in players or not players[client_id]["lobby"]:
+        if client_id not in players or not players[client_id].lobby:
             await send_to_client(client_id, "error", {"message": "You are not in a lobby"})
             return
         
-        if players[client_id].get("role") != "spectator":
+        if players[client_id].role != "spectator":
             await send_to_client(client_id, "error", {"message": "Only spectators can send emojis"})
             return
         
-        lobby_id = players[client_id]["lobby"]
-        emoji = data.get("emoji", "🔥")
-        
-        # Send emoji to players in the lobby
-        await broadcast_to_lobby(lobby_id, "spectator_emoji_reaction", {
-            "emoji": emoji,
-            "spectatorName": players[client_id]["name"]
-        })
+        lobby_id = players[client_id].lobby
         
-        print(f"Spectator {players[client_id]['name']} sent emoji {emoji} in lobby {lobby_id}")
+        # Counted and sent to the players with the rest of this tick's reactions
+        emoji_reactions.add(lobby_id, payload.emoji, players[client_id].name)
         
     except Exception as e:
         await send_to_client(client_id, "error", {"message": f"Failed to send emoji: {str(e)}"})
 
-async def handle_code_update(client_id: str, data: dict):
+@dispatcher.route("code_update", CodeUpdatePayload, quiet=True)
+async def handle_code_update(client_id: str, payload: CodeUpdatePayload):
     """Handle live code updates from players - broadcast to spectators only"""
     try:
-        if client_id not in players or not players[client_id]["lobby"]:
+        if client_id not in players or not players[client_id].lobby:
             return
         
         # Only players (not spectators) can send code updates
-        if players[client_id].get("role") == "spectator":
+        if players[client_id].role == "spectator":
             return
         
-        lobby_id = players[client_id]["lobby"]
+        lobby_id = players[client_id].lobby
         
         if lobby_id not in lobbies:
             return
@@ -1077,37 +4859,46 @@ async def handle_code_update(client_id: str, data: dict):
         lobby = lobbies[lobby_id]
         
         # Only broadcast during active game
-        if lobby["status"] != "playing":
+        if lobby.status != "playing":
             return
         
-        code = data.get("code", "")
-        player_name = players[client_id]["name"]
-        
-        # Broadcast live code to spectators only
-        await broadcast_to_spectators(lobby_id, "live_code_update", {
-            "player_id": client_id,
-            "player_name": player_name,
-            "code": code
-        })
+        # Streamed to watching spectators as throttled diffs
+        live_code.update(lobby_id, client_id, players[client_id].name, payload.code)
         
     except Exception as e:
         pass  # Silently ignore errors to not disrupt gameplay
 
+@dispatcher.route("get_spectator_roster", SpectatorRosterPayload)
+async def handle_get_spectator_roster(client_id: str, payload: SpectatorRosterPayload):
+    """One page of a lobby's spectators, for anyone in the lobby"""
+    lobby_id = players[client_id].lobby if client_id in players else None
+    if lobby_id not in lobbies:
+        await send_to_client(client_id, "error", {"message": "You are not in a lobby"})
+        return
+    await send_to_client(client_id, "spectator_roster", spectator_rosters.page(lobbies[lobby_id], payload.page))
+
+@dispatcher.route("watch_live_code", WatchLiveCodePayload)
+async def handle_watch_live_code(client_id: str, payload: WatchLiveCodePayload):
+    """Choose which players' code a spectator receives (playerIds null means all)"""
+    if client_id not in players or players[client_id].role != "spectator":
+        await send_to_client(client_id, "error", {"message": "Only spectators can watch live code"})
+        return
+    live_code.watch(client_id, players[client_id].lobby, payload.player_ids)
+
+@dispatcher.route("resync_live_code", ResyncLiveCodePayload)
+async def handle_resync_live_code(client_id: str, payload: ResyncLiveCodePayload):
+    """Resend snapshots to a spectator that missed a diff"""
+    if client_id not in players or players[client_id].role != "spectator":
+        return
+    player_ids = None if payload.player_id is None else [payload.player_id]
+    live_code.send_snapshots(client_id, players[client_id].lobby, player_ids)
+
 async def broadcast_to_spectators(lobby_id: str, event: str, data: dict):
     """Broadcast event to all spectators in a specific lobby"""
     if lobby_id not in lobbies:
         return
     
-    lobby = lobbies[lobby_id]
-    message = json.dumps({"event": event, "data": data})
-    
-    for spectator in lobby["spectators"]:
-        spectator_id = spectator["id"]
-        if spectator_id in connections:
-            try:
-                await connections[spectator_id].send_text(message)
-            except:
-                pass
+    await fan_out(list(lobbies[lobby_id].spectators), event, data)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,219 @@
+"""Two workers sharing a (fake) Redis: a client of one joins, plays in and leaves a
+lobby that lives on the other"""
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+def load_node(node_id: str, server):
+    """A separate copy of the server module, as if it ran in its own process"""
+    os.environ.update(STATE_BACKEND="redis", NODE_ID=node_id)
+    try:
+        spec = importlib.util.spec_from_file_location(f"main_{node_id}", MAIN)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    finally:
+        del os.environ["STATE_BACKEND"], os.environ["NODE_ID"]
+    module.aioredis = FakeRedisModule(server)
+    return module
+
+
+class FakeRedisModule:
+    def __init__(self, server):
+        self.server = server
+
+    def from_url(self, url, **kwargs):
+        return fakeredis.aioredis.FakeRedis(server=self.server, **kwargs)
+
+
+class FakeSocket:
+    def __init__(self):
+        self.received = []
+
+    async def send_text(self, message):
+        self.received.append(json.loads(message))
+
+    async def close(self, code=1000):
+        pass
+
+
+async def connect(node):
+    """Register a client the way the websocket endpoint does"""
+    client_id = f"client_{len(node.players) + 1}_{node.NODE_ID}"
+    assert await node.cluster.claim_client(client_id)
+    node.players[client_id] = node.Player(client_id)
+    socket = node.connections[client_id] = FakeSocket()
+    node.outboxes.open(client_id, socket)
+    await node.send_to_client(client_id, "session", {"clientId": client_id,
+                                                     "resumeToken": node.sessions.issue(client_id)})
+    return client_id, socket
+
+
+async def send(node, client_id, event, data=None):
+    await node.dispatcher.dispatch(client_id, {"type": "websocket.receive",
+                                               "text": json.dumps({"event": event, "data": data or {}})})
+
+
+async def until(socket, event, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for message in socket.received:
+            if message["event"] == event:
+                socket.received.remove(message)
+                return message["data"]
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"no {event} within {timeout}s")
+
+
+def test_join_relay_and_leave_across_workers():
+    server = fakeredis.FakeServer()
+    n1, n2 = load_node("n1", server), load_node("n2", server)
+
+    async def scenario():
+        await n1.cluster.start()
+        await n2.cluster.start()
+        try:
+            alice, alice_socket = await connect(n1)
+            bob, bob_socket = await connect(n2)
+
+            await send(n1, alice, "create_lobby", {"name": "Cross", "playerName": "alice"})
+            lobby_id = (await until(alice_socket, "lobby_created"))["lobbyId"]
+            assert await n2.cluster.backend.lobby_node(lobby_id) == "n1"
+
+            # Join: bob's worker finds the lobby's owner and forwards to it
+            await send(n2, bob, "join_lobby", {"lobbyId": lobby_id, "playerName": "bob"})
+            assert (await until(bob_socket, "lobby_joined"))["playerCount"] == 2
+            assert (await until(alice_socket, "player_joined"))["playerName"] == "bob"
+            assert n2.cluster.homes[bob] == "n1"
+            assert n1.players[bob].node == "n2"
+
+            # Relay: bob's events run on n1 and the lobby's replies come back through n2
+            await send(n2, bob, "player_ready")
+            assert (await until(alice_socket, "player_ready_update"))["playerName"] == "bob"
+            await until(bob_socket, "player_ready_update")
+
+            # Ownership keys expire unless the owner's heartbeat refreshes them
+            redis = n1.cluster.backend.redis
+            assert 0 < await redis.ttl(f"shibacoder:lobby:{lobby_id}") <= n1.HEARTBEAT_TIMEOUT
+            assert 0 < await redis.ttl(f"shibacoder:client:{bob}") <= n1.HEARTBEAT_TIMEOUT
+
+            # Leave: the lobby_left ends bob's stay on n1 in both workers
+            await send(n2, bob, "leave_lobby")
+            await until(bob_socket, "lobby_left")
+            assert bob not in n2.cluster.homes
+            assert bob not in n1.players
+            assert (await until(alice_socket, "player_left"))["playerName"] == "bob"
+
+            # Back home, bob's events are handled by n2 again
+            await send(n2, bob, "create_lobby", {"name": "Local", "playerName": "bob"})
+            local_id = (await until(bob_socket, "lobby_created"))["lobbyId"]
+            assert local_id in n2.lobbies
+        finally:
+            await n2.cluster.close()
+            await n1.cluster.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_remote_join_leaves_the_client_at_home():
+    server = fakeredis.FakeServer()
+    n1, n2 = load_node("n1", server), load_node("n2", server)
+
+    async def scenario():
+        await n1.cluster.start()
+        await n2.cluster.start()
+        try:
+            alice, alice_socket = await connect(n1)
+            bob, bob_socket = await connect(n1)
+            carol, carol_socket = await connect(n2)
+            dave, dave_socket = await connect(n2)
+            await send(n1, alice, "create_lobby", {"name": "Full", "playerName": "alice"})
+            full_id = (await until(alice_socket, "lobby_created"))["lobbyId"]
+            await send(n1, bob, "join_lobby", {"lobbyId": full_id, "playerName": "bob"})
+            await until(bob_socket, "lobby_joined")
+
+            # Carol's join is forwarded to n1 and refused there
+            await send(n2, carol, "join_lobby", {"lobbyId": full_id, "playerName": "carol"})
+            assert (await until(carol_socket, "error"))["message"] == "Lobby is full"
+            deadline = time.monotonic() + 5
+            while carol in n2.cluster.joining and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            assert carol not in n2.cluster.joining and carol not in n2.cluster.homes
+            assert carol not in n1.players
+
+            # She is still n2's client, free to join a lobby there
+            await send(n2, dave, "create_lobby", {"name": "Local", "playerName": "dave"})
+            local_id = (await until(dave_socket, "lobby_created"))["lobbyId"]
+            await send(n2, carol, "join_lobby", {"lobbyId": local_id, "playerName": "carol"})
+            assert (await until(carol_socket, "lobby_joined"))["lobbyId"] == local_id
+            assert n2.players[carol].lobby == local_id
+        finally:
+            await n2.cluster.close()
+            await n1.cluster.close()
+
+    asyncio.run(scenario())
+
+
+def test_resume_on_another_worker():
+    server = fakeredis.FakeServer()
+    n1, n2 = load_node("n1", server), load_node("n2", server)
+
+    async def scenario():
+        await n1.cluster.start()
+        await n2.cluster.start()
+        try:
+            alice, alice_socket = await connect(n1)
+            token = (await until(alice_socket, "session"))["resumeToken"]
+            bob, bob_socket = await connect(n1)
+            await send(n1, alice, "create_lobby", {"name": "Cross", "playerName": "alice"})
+            lobby_id = (await until(alice_socket, "lobby_created"))["lobbyId"]
+            await send(n1, bob, "join_lobby", {"lobbyId": lobby_id, "playerName": "bob"})
+            await until(bob_socket, "lobby_joined")
+
+            # Alice's connection drops and n1 holds her seat
+            await n1.handle_disconnect(alice)
+            assert alice in n1.sessions.held
+
+            # She reconnects through n2, which forwards the resume to n1
+            connection, socket = await connect(n2)
+            await until(socket, "session")
+            await send(n2, connection, "resume", {"resumeToken": token, "lastSeq": 0})
+            session = await until(socket, "session")
+            assert session["clientId"] == alice
+            assert (await until(socket, "resumed"))["lobbyId"] == lobby_id
+            assert n2.cluster.homes[alice] == "n1" and alice in n2.connections
+            assert connection not in n2.players
+            assert n1.players[alice].node == "n2" and alice not in n1.sessions.held
+
+            # From n2 she plays on in her lobby on n1
+            await send(n2, alice, "player_ready")
+            assert (await until(bob_socket, "player_ready_update"))["playerName"] == "alice"
+
+            # Dropping again holds the seat on n1 once more
+            await n2.handle_disconnect(alice)
+            deadline = time.monotonic() + 5
+            while alice not in n1.sessions.held and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            assert alice in n1.sessions.held
+            assert alice in n1.lobbies[lobby_id].players
+
+            # An unknown token gets a fresh session instead
+            stranger, stranger_socket = await connect(n2)
+            await send(n2, stranger, "resume", {"resumeToken": "nope.n1", "lastSeq": 0})
+            await until(stranger_socket, "lobby_left")
+            assert stranger in n2.players
+        finally:
+            await n2.cluster.close()
+            await n1.cluster.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,28 @@
+"""The sequenced per-lobby event log that resumed sessions are replayed from"""
+import main
+
+
+def test_event_log_replays_what_a_client_missed():
+    log = main.LobbyEventLog(size=4)
+    assert log.append("L", "player_joined", {"playerName": "bob"})["eventSeq"] == 1
+    log.append("L", "attack_received", {"attacker": "bob"}, recipient="alice")
+    log.append("L", "test_results", {"passed": 1}, recipient="bob")
+    log.append("L", "player_ready_update", {"ready": True})
+
+    assert log.current("L") == 4
+    assert [event for event, _ in log.since("L", 1, "alice")] == ["attack_received", "player_ready_update"]
+    assert [event for event, _ in log.since("L", 1, "bob")] == ["test_results", "player_ready_update"]
+    assert [data["eventSeq"] for _, data in log.since("L", 0, "alice")] == [1, 2, 4]
+    assert log.since("L", 4, "alice") == []
+
+
+def test_event_log_gives_up_past_its_window():
+    log = main.LobbyEventLog(size=2)
+    for _ in range(5):
+        log.append("L", "progress_update", {})
+    assert log.since("L", 3, "alice") == [("progress_update", {"eventSeq": 4}), ("progress_update", {"eventSeq": 5})]
+    assert log.since("L", 2, "alice") is None  # seq 3 fell out of the log
+    assert log.since("L", 9, "alice") is None  # a sequence from another lobby
+    assert log.since("other", 0, "alice") == []
+    log.discard_lobby("L")
+    assert log.current("L") == 0 and log.stats()["lobbies"] == 0
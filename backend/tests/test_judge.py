@@ -0,0 +1,114 @@
+"""The test harness that runs every case of a submission in one execution"""
+import asyncio
+import json
+import subprocess
+import sys
+
+import main
+
+CASES = [
+    {"input": "1 2", "expected_output": "3"},
+    {"input": "2 2", "expected_output": "4"},
+    {"input": "5 5", "expected_output": "10"},
+]
+
+
+def report(marker, **fields):
+    return marker + json.dumps(fields)
+
+
+def test_parse_reports_per_case_verdicts():
+    marker = main.harness_marker()
+    stdout = "\n".join([
+        report(marker, case=0, status="ok", output="3\n", time=0.01),
+        "noise the solution printed",
+        report(marker, case=1, status="ok", output="5\n", time=0.01),
+        report(marker, case=2, status="runtime_error", error="ZeroDivisionError: division by zero"),
+    ])
+    results = main.parse_harness_output({"stdout": stdout, "status": {"id": 3}}, CASES, marker)
+    assert [result["passed"] for result in results] == [True, False, False]
+    assert results[0]["runtime"] == 10
+    assert "Expected: 4, Got: 5" in results[1]["error"]
+    assert "ZeroDivisionError" in results[2]["error"]
+
+
+def test_parse_ignores_reports_without_this_runs_marker():
+    marker = main.harness_marker()
+    forged = report(main.HARNESS_MARKER + "0" * 32 + ":", case=0, status="ok", output="3", time=0)
+    result = {"stdout": forged, "status": {"id": 5, "description": "Time Limit Exceeded"}}
+    results = main.parse_harness_output(result, CASES[:1], marker)
+    assert results == [{"passed": False, "runtime": 0, "error": "Test 1: Time Limit Exceeded", "transient": False}]
+
+
+def test_parse_fails_cases_reported_twice():
+    marker = main.harness_marker()
+    stdout = "\n".join([
+        report(marker, case=0, status="ok", output="wrong", time=0),
+        report(marker, case=0, status="ok", output="3", time=0),
+    ])
+    results = main.parse_harness_output({"stdout": stdout}, CASES[:1], marker)
+    assert not results[0]["passed"]
+    assert "reported more than once" in results[0]["error"]
+
+
+def test_parse_compile_error_fails_every_case():
+    marker = main.harness_marker()
+    stdout = report(marker, compile_error="SyntaxError: invalid syntax")
+    results = main.parse_harness_output({"stdout": stdout}, CASES, marker)
+    assert all(not result["passed"] and "SyntaxError" in result["error"] for result in results)
+
+
+def run_harness_source(code):
+    marker = main.harness_marker()
+    source = main.build_harness_source(code, CASES, marker)
+    completed = subprocess.run([sys.executable, "-I", "-c", source], capture_output=True, text=True, timeout=60)
+    return main.parse_harness_output({"stdout": completed.stdout, "status": {"id": 3}}, CASES, marker)
+
+
+def test_harness_runs_each_case_on_its_own_input():
+    results = run_harness_source("a, b = map(int, input().split())\nprint(a + b)")
+    assert [result["passed"] for result in results] == [True, True, True]
+
+
+def test_harness_cases_cannot_pass_for_each_other():
+    # Case state doesn't leak into the next case, and printing a guessed marker does nothing
+    code = "\n".join([
+        "import builtins",
+        "a, b = map(int, input().split())",
+        "if hasattr(builtins, 'seen'):",
+        "    print(a + b)",
+        "builtins.seen = True",
+        "print('__SHIBACODER_CASE__' + '{\"case\": 2, \"status\": \"ok\", \"output\": \"10\", \"time\": 0}')",
+    ])
+    results = run_harness_source(code)
+    assert [result["passed"] for result in results] == [False, False, False]
+
+
+def test_fake_fallback_reports_each_case(monkeypatch):
+    monkeypatch.setattr(main, "JUDGE_FALLBACK", "fake")
+    reported = []
+
+    async def on_result(index, test_result):
+        reported.append((index, test_result["passed"]))
+
+    code = "def two_sum(nums, target):\n    return []\n"
+    summary = asyncio.run(main.run_fallback_tests(code, main.get_two_sum_test_cases(), on_result))
+    assert [index for index, _ in reported] == list(range(summary["total"]))
+    assert sum(passed for _, passed in reported) == summary["passed"]
+
+
+def test_precheck_failures_use_the_judges_error_format():
+    async def precheck(code):
+        return await main.precheck_submission(code, "python", "two-sum", len(CASES))
+
+    try:
+        syntax_error = asyncio.run(precheck("def two_sum(nums, target)\n    return []\n"))
+        no_entry_point = asyncio.run(precheck("def solve(nums, target):\n    return []\n"))
+        valid = asyncio.run(precheck("def two_sum(nums, target):\n    return []\n"))
+    finally:
+        main.recycle_precheck_pool()
+    assert syntax_error["passed"] == 0 and syntax_error["total"] == len(CASES)
+    assert [error.split(": ", 1)[0] for error in syntax_error["errors"]] == ["Test 1", "Test 2", "Test 3"]
+    assert all("Compilation Error - " in error and "SyntaxError" in error for error in syntax_error["errors"])
+    assert no_entry_point["errors"] == [f"Test {i}: Solution must define a function named two_sum" for i in (1, 2, 3)]
+    assert valid is None
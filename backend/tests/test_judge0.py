@@ -0,0 +1,104 @@
+"""Judge0 result delivery against an in-process stand-in for the Judge0 API: callbacks,
+including ones that arrive before anyone waits for them, and the polling fallback"""
+import asyncio
+import json
+import secrets
+
+import httpx
+import pytest
+
+import main
+
+CASES = [
+    {"input": "1 2", "expected_output": "3"},
+    {"input": "2 2", "expected_output": "4"},
+]
+
+
+class FakeJudge0:
+    """Accepts every submission with its expected output, optionally calling back"""
+
+    def __init__(self, callbacks: bool):
+        self.callbacks = callbacks
+        self.submissions = {}
+        self.polls = 0
+        self.callback_statuses = []
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "POST" and request.url.path == "/submissions":
+            return await self.submit(json.loads(request.content))
+        if request.method == "GET" and request.url.path.startswith("/submissions/"):
+            self.polls += 1
+            return httpx.Response(200, json=self.submissions[request.url.path.rsplit("/", 1)[1]])
+        return httpx.Response(404)
+
+    async def submit(self, submission: dict) -> httpx.Response:
+        token = secrets.token_hex(8)
+        result = {"token": token, "status": {"id": 3, "description": "Accepted"},
+                  "stdout": submission["expected_output"] + "\n", "time": "0.01"}
+        self.submissions[token] = result
+        if self.callbacks and "callback_url" in submission:
+            # Judge0 is done before its submit response is: the callback beats the wait
+            encoded = {**result, "stdout": main.judge0_b64encode(result["stdout"])}
+            response = await put_callback(submission["callback_url"], json=encoded)
+            self.callback_statuses.append(response.status_code)
+        return httpx.Response(201, json={"token": token})
+
+
+async def put_callback(url: str, **kwargs) -> httpx.Response:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api") as client:
+        return await client.put(url.replace("http://api", ""), **kwargs)
+
+
+@pytest.fixture
+def judge0(monkeypatch):
+    def start(callbacks: bool, grace: float) -> FakeJudge0:
+        fake = FakeJudge0(callbacks)
+        monkeypatch.setattr(main, "JUDGE0_API_KEY", "test")
+        monkeypatch.setattr(main, "JUDGE0_BASE_URL", "http://judge0")
+        monkeypatch.setattr(main, "JUDGE0_BATCH_MODE", False)
+        monkeypatch.setattr(main, "JUDGE0_CALLBACK_URL", "http://api")
+        monkeypatch.setattr(main, "JUDGE0_CALLBACK_GRACE", grace)
+        monkeypatch.setattr(main, "JUDGE0_POLL_MAX_DELAY", 0.05)
+        monkeypatch.setattr(main, "JUDGE0_RESULT_TIMEOUT", 5.0)
+        monkeypatch.setattr(main, "judge_http_client", httpx.AsyncClient(transport=httpx.MockTransport(fake.handle)))
+        return fake
+    yield start
+    main.judge0_early_callbacks.clear()
+
+
+def test_callback_before_wait_is_delivered_without_polling(judge0):
+    fake = judge0(callbacks=True, grace=30.0)
+    summary = asyncio.run(main.judge0_submit_code("print(sum(map(int, input().split())))", CASES))
+    assert fake.callback_statuses == [200, 200]
+    assert summary["passed"] == 2 and summary["completed"]
+    assert fake.polls == 0
+    assert not main.judge0_early_callbacks and not main.judge0_callback_waiters
+
+
+def test_missing_callbacks_fall_back_to_polling_after_the_grace(judge0):
+    fake = judge0(callbacks=False, grace=0.05)
+    summary = asyncio.run(main.judge0_submit_code("print(sum(map(int, input().split())))", CASES))
+    assert summary["passed"] == 2 and summary["completed"]
+    assert fake.polls >= 2
+    assert not main.judge0_callback_waiters
+
+
+def test_callback_with_wrong_secret_is_refused():
+    result = {"token": "abc", "status": {"id": 3}}
+    response = asyncio.run(put_callback("/judge0/callback/not-the-secret", json=result))
+    assert response.status_code == 403
+    assert "abc" not in main.judge0_early_callbacks
+
+
+def test_malformed_callback_is_rejected():
+    url = f"/judge0/callback/{main.JUDGE0_CALLBACK_SECRET}"
+    assert asyncio.run(put_callback(url, content=b"{not json")).status_code == 400
+    assert asyncio.run(put_callback(url, json=[{"token": "abc", "status": {"id": 3}}])).status_code == 400
+    assert "abc" not in main.judge0_early_callbacks
+
+
+def test_unfinished_callback_is_not_accepted():
+    url = f"/judge0/callback/{main.JUDGE0_CALLBACK_SECRET}"
+    response = asyncio.run(put_callback(url, json={"token": "abc", "status": {"id": 2}}))
+    assert response.status_code == 404
@@ -0,0 +1,52 @@
+"""The index behind the public lobby browser"""
+import main
+
+
+def make_registry(*names):
+    registry = main.LobbyRegistry()
+    for created_at, name in enumerate(names):
+        registry.add(f"lobby_{created_at}", float(created_at), name)
+    return registry
+
+
+def test_registry_lists_newest_first_and_searches_names():
+    registry = make_registry("Alpha Room", "beta", "ALPHABET soup", "gamma")
+    assert [lobby_id for _, lobby_id in registry.listing()] == ["lobby_3", "lobby_2", "lobby_1", "lobby_0"]
+    assert [lobby_id for _, lobby_id in registry.search("alpha")] == ["lobby_2", "lobby_0"]
+    assert [lobby_id for _, lobby_id in registry.search("A")] == ["lobby_3", "lobby_2", "lobby_1", "lobby_0"]
+    assert [lobby_id for _, lobby_id in registry.search("et s")] == ["lobby_2"]
+    assert registry.search("alphabets") == []
+
+    registry.discard("lobby_2")
+    registry.discard("lobby_2")
+    assert [lobby_id for _, lobby_id in registry.search("alpha")] == ["lobby_0"]
+    assert registry.ngrams["bet"] == {"lobby_1"} and "sou" not in registry.ngrams
+
+
+def test_registry_only_lists_public_waiting_lobbies():
+    registry = main.LobbyRegistry()
+    lobby = main.Lobby(id="L", name="Room", type="public", pin=None, elo_range="easy")
+    registry.sync(lobby)
+    assert registry.listing() == [(-lobby.created_at, "L")]
+    lobby.status = "playing"
+    registry.sync(lobby)
+    assert registry.listing() == [] and registry.ngrams == {}
+
+
+def test_public_lobbies_are_paged(monkeypatch):
+    lobbies = {f"lobby_{i}": main.Lobby(id=f"lobby_{i}", name=f"Room {i}", type="public", pin=None,
+                                        elo_range="easy", created_at=float(i)) for i in range(10)}
+    registry = main.LobbyRegistry()
+    for lobby in lobbies.values():
+        registry.sync(lobby)
+    monkeypatch.setattr(main, "lobbies", lobbies)
+    monkeypatch.setattr(main, "lobby_registry", registry)
+
+    first = main.get_public_lobbies(page=1, per_page=4)
+    assert [lobby["name"] for lobby in first["lobbies"]] == ["Room 9", "Room 8", "Room 7", "Room 6"]
+    assert first["pagination"] == {"currentPage": 1, "totalPages": 3, "totalLobbies": 10, "perPage": 4}
+    last = main.get_public_lobbies(page=99, per_page=4)
+    assert last["pagination"]["currentPage"] == 3
+    assert [lobby["name"] for lobby in last["lobbies"]] == ["Room 1", "Room 0"]
+    found = main.get_public_lobbies(search="room 1", page=1, per_page=4)
+    assert [lobby["name"] for lobby in found["lobbies"]] == ["Room 1"]
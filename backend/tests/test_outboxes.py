@@ -0,0 +1,86 @@
+"""Per-connection outboxes and their overflow policies"""
+import asyncio
+
+import main
+
+
+class StalledSocket:
+    """A socket whose first send never completes, so everything after it stays queued"""
+
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+
+    async def send_text(self, message):
+        self.sent.append(message)
+        await asyncio.Event().wait()
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+def run_outbox(test):
+    async def scenario():
+        outboxes = main.ConnectionOutboxes(max_messages=3, send_timeout=60)
+        socket = StalledSocket()
+        outboxes.open("c", socket)
+        outboxes.send("c", "lobby_joined", "stuck")
+        await asyncio.sleep(0)
+        try:
+            await test(outboxes, socket)
+        finally:
+            outboxes.close("c")
+
+    asyncio.run(scenario())
+
+
+def queued(outboxes):
+    return [message for _, _, message in outboxes.queues["c"]]
+
+
+def test_outbox_drop_oldest_evicts_droppable_messages():
+    async def test(outboxes, socket):
+        outboxes.send("c", "player_joined", "must keep")
+        outboxes.send("c", "spectator_chat_messages", "chat 1")
+        outboxes.send("c", "spectator_chat_messages", "chat 2")
+        outboxes.send("c", "spectator_chat_messages", "chat 3")
+        assert queued(outboxes) == ["must keep", "chat 2", "chat 3"]
+        assert outboxes.dropped == {"spectator_chat_messages": 1}
+        assert socket.sent == ["stuck"]
+
+    run_outbox(test)
+
+
+def test_outbox_drop_oldest_drops_the_new_message_when_nothing_else_can_go():
+    async def test(outboxes, socket):
+        for i in range(3):
+            outboxes.send("c", "player_joined", f"joined {i}")
+        outboxes.send("c", "countdown_update", "tick")
+        assert queued(outboxes) == ["joined 0", "joined 1", "joined 2"]
+        assert outboxes.dropped == {"countdown_update": 1}
+
+    run_outbox(test)
+
+
+def test_outbox_coalesces_per_entity():
+    async def test(outboxes, socket):
+        outboxes.send("c", "live_code_update", "p1 v1", "p1")
+        outboxes.send("c", "live_code_update", "p2 v1", "p2")
+        outboxes.send("c", "live_code_update", "p1 v2", "p1")
+        assert queued(outboxes) == ["p1 v2", "p2 v1"]
+        assert outboxes.coalesced == 1
+
+    run_outbox(test)
+
+
+def test_outbox_disconnects_when_a_must_deliver_event_does_not_fit():
+    async def test(outboxes, socket):
+        for i in range(3):
+            outboxes.send("c", "player_joined", f"joined {i}")
+        outboxes.send("c", "game_start", "start")
+        await asyncio.sleep(0.01)
+        assert "c" not in outboxes.queues
+        assert outboxes.disconnected == 1
+        assert socket.closed == 1013
+
+    run_outbox(test)
@@ -0,0 +1,53 @@
+"""What the verdict cache may answer from a stored verdict"""
+import asyncio
+
+import main
+
+CASES = [{"input": "1 2", "expected_output": "3"}]
+CODE = "print(3)"
+
+
+def judged_by(backend, calls):
+    async def judge(on_result):
+        calls.append(backend)
+        await on_result(0, {"passed": True, "runtime": 1, "error": None})
+        return {"passed": 1, "total": 1, "completed": True, "runtime": 1, "errors": [],
+                "cacheable": True, "backend": backend}
+    return judge
+
+
+def test_verdicts_are_reused_for_the_backend_that_produced_them(monkeypatch):
+    monkeypatch.setattr(main, "JUDGE_BACKEND", "judge0")
+    cache = main.VerdictCache(60, 100, 1 << 20)
+    calls = []
+
+    async def scenario():
+        await cache.run(CODE, "python", CASES, judged_by("judge0", calls))
+        await cache.run(CODE, "python", CASES, judged_by("judge0", calls))
+    asyncio.run(scenario())
+    assert calls == ["judge0"] and cache.hits == 1
+
+
+def test_fallback_verdicts_do_not_answer_for_the_configured_backend(monkeypatch):
+    monkeypatch.setattr(main, "JUDGE_BACKEND", "judge0")
+    cache = main.VerdictCache(60, 100, 1 << 20)
+    calls = []
+
+    async def scenario():
+        await cache.run(CODE, "python", CASES, judged_by("local", calls))
+        await cache.run(CODE, "python", CASES, judged_by("judge0", calls))
+    asyncio.run(scenario())
+    assert calls == ["local", "judge0"] and cache.hits == 0
+
+    # With the local judge configured, the verdict it produced as a fallback is good
+    monkeypatch.setattr(main, "JUDGE_BACKEND", "local")
+    asyncio.run(cache.run(CODE, "python", CASES, judged_by("local", calls)))
+    assert calls == ["local", "judge0"] and cache.hits == 1
+
+
+def test_harness_mode_is_part_of_the_key(monkeypatch):
+    cache = main.VerdictCache(60, 100, 1 << 20)
+    monkeypatch.setattr(main, "JUDGE_HARNESS", False)
+    per_case = cache.make_key(CODE, "python", CASES)
+    monkeypatch.setattr(main, "JUDGE_HARNESS", True)
+    assert cache.make_key(CODE, "python", CASES) != per_case
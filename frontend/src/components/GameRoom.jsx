@@ -57,6 +57,8 @@ function GameRoom({ lobby, players, playerName }) {
   useEffect(() => {
     if (gameFinished && playerName) {
       const isWinner = gameFinished.winner?.trim().toLowerCase() === playerName?.trim().toLowerCase();
+      // Nobody passed a test before time ran out: a draw leaves ELO alone
+      if (!gameFinished.winner) return;
       const eloAdjustment = isWinner ? 10 : -10;
       
       // Get current ELO from localStorage
@@ -124,31 +126,35 @@ function GameRoom({ lobby, players, playerName }) {
       }, duration);
     };
 
-    const handleSpectatorEmojiReaction = (data) => {
-      console.log('🎉 Spectator emoji reaction:', data.emoji, 'from', data.spectatorName);
-      
-      // Add emoji to display
-      const emojiId = Date.now() + Math.random();
-      setSpectatorEmojis(prev => [...prev, {
-        id: emojiId,
-        emoji: data.emoji,
-        spectatorName: data.spectatorName,
-        x: Math.random() * 80 + 10, // Random position 10-90%
-        y: Math.random() * 80 + 10
-      }]);
+    // Reactions arrive as per-emoji counts once per tick; show a few bubbles for each
+    const handleSpectatorEmojiReactions = (data) => {
+      const bubbles = data.reactions.flatMap(reaction => {
+        const from = reaction.count > 1
+          ? `${reaction.spectatorName} and ${reaction.count - 1} more`
+          : reaction.spectatorName;
+        return Array.from({ length: Math.min(reaction.count, 5) }, () => ({
+          id: Date.now() + Math.random(),
+          emoji: reaction.emoji,
+          spectatorName: from,
+          x: Math.random() * 80 + 10, // Random position 10-90%
+          y: Math.random() * 80 + 10
+        }));
+      });
+      setSpectatorEmojis(prev => [...prev, ...bubbles]);
       
       // Remove emoji after 4 seconds
+      const ids = new Set(bubbles.map(bubble => bubble.id));
       setTimeout(() => {
-        setSpectatorEmojis(prev => prev.filter(e => e.id !== emojiId));
+        setSpectatorEmojis(prev => prev.filter(e => !ids.has(e.id)));
       }, 4000);
     };
 
     on('attack_received', handleAttackReceived);
-    on('spectator_emoji_reaction', handleSpectatorEmojiReaction);
+    on('spectator_emoji_reactions', handleSpectatorEmojiReactions);
     
     return () => {
       off('attack_received', handleAttackReceived);
-      off('spectator_emoji_reaction', handleSpectatorEmojiReaction);
+      off('spectator_emoji_reactions', handleSpectatorEmojiReactions);
     };
   }, [on, off]);
 
@@ -290,13 +296,19 @@ function GameRoom({ lobby, players, playerName }) {
 
       {gameFinished && (
         <div className={`nes-container is-centered ${gameFinished.winner?.trim().toLowerCase() === playerName?.trim().toLowerCase() ? 'winner-banner' : 'loser-banner'}`}>
-          {gameFinished.winner?.trim().toLowerCase() === playerName?.trim().toLowerCase() ? (
+          {!gameFinished.winner ? (
+            <h2>⏰ Time's up! It's a draw! ⏰</h2>
+          ) : gameFinished.winner?.trim().toLowerCase() === playerName?.trim().toLowerCase() ? (
             <h2>🎉 You Won! 🎉</h2>
           ) : (
             <h2>😢 You Lost! Better luck next time! 😢</h2>
           )}
           <p className="text-sm mt-2">
-            {gameFinished.winner?.trim().toLowerCase() === playerName?.trim().toLowerCase()
+            {!gameFinished.winner
+              ? "Nobody passed a test before the time limit."
+              : gameFinished.reason === 'time_up'
+              ? `Time's up! ${gameFinished.winner} passed the most tests.`
+              : gameFinished.winner?.trim().toLowerCase() === playerName?.trim().toLowerCase()
               ? "Congratulations on solving the challenge!" 
               : `${gameFinished.winner} solved it first!`
             }
@@ -18,6 +18,7 @@ function LobbyList({ onCreateLobby, onJoinLobby }) {
     error,
     connected,
     getLobbyList,
+    unsubscribeLobbyList,
     joinLobby,
     clearError
   } = useLobby()
@@ -29,16 +30,10 @@ function LobbyList({ onCreateLobby, onJoinLobby }) {
     }
   }, [connected, currentPage, searchTerm, getLobbyList])
 
-  // Refresh lobby list every 10 seconds
+  // Stop receiving lobby list updates when leaving the lobby browser
   useEffect(() => {
-    if (!connected) return
-
-    const interval = setInterval(() => {
-      getLobbyList(currentPage, searchTerm)
-    }, 10000)
-
-    return () => clearInterval(interval)
-  }, [connected, currentPage, searchTerm, getLobbyList])
+    return () => unsubscribeLobbyList()
+  }, [unsubscribeLobbyList])
 
   const handleJoinClick = (lobby) => {
     sounds.buttonClick()
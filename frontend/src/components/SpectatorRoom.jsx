@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import Editor from '@monaco-editor/react';
 import { useWebSocket } from '../hooks/useWebSocket';
 import { sounds } from '../utils/sounds';
@@ -6,7 +6,11 @@ import './GameRoom.css';
 
 function SpectatorRoom({ lobby, players, spectatorName, onLeaveLobby }) {
   const { emit, on, off } = useWebSocket();
-  const [chatMessages, setChatMessages] = useState([]);
+  // Start from the recent chat the server sent when we joined
+  const [chatMessages, setChatMessages] = useState(() => (lobby?.chatHistory || []).map(message => ({
+    id: Date.now() + Math.random(),
+    ...message
+  })));
   const [newMessage, setNewMessage] = useState('');
   const [gameStartTime, setGameStartTime] = useState(null);
   const [currentTime, setCurrentTime] = useState(Date.now());
@@ -21,6 +25,13 @@ function SpectatorRoom({ lobby, players, spectatorName, onLeaveLobby }) {
   const [player2Typing, setPlayer2Typing] = useState(false);
   const [typingTimeouts, setTypingTimeouts] = useState({ player1: null, player2: null });
 
+  // Last code and sequence number received per player, for applying diffs
+  const liveCode = useRef({});
+
+  // Seq of the last roster delta applied; null until the first page arrives
+  const rosterSeq = useRef(null);
+  const rosterRequested = useRef(false);
+
   // Set game start time when lobby status becomes 'playing'
   useEffect(() => {
     if (lobby?.status === 'playing' && !gameStartTime) {
@@ -38,29 +49,56 @@ function SpectatorRoom({ lobby, players, spectatorName, onLeaveLobby }) {
     }
   }, [gameStartTime, lobby?.status]);
 
+  // Ask for the players' current code once our handlers are listening
+  useEffect(() => {
+    emit('resync_live_code', {});
+    rosterRequested.current = true;
+    emit('get_spectator_roster', { page: 1 });
+  }, [emit]);
+
   // Listen for spectator events
   useEffect(() => {
-    const handleChatMessage = (data) => {
-      setChatMessages(prev => [...prev, {
+    // Chat arrives in batches, one per server tick; keep the last 200 messages
+    const handleChatMessages = (data) => {
+      setChatMessages(prev => [...prev, ...data.messages.map(message => ({
         id: Date.now() + Math.random(),
-        spectatorName: data.spectatorName,
-        message: data.message,
-        timestamp: data.timestamp
-      }]);
+        spectatorName: message.spectatorName,
+        message: message.message,
+        timestamp: message.timestamp
+      }))].slice(-200));
     };
 
-    const handleSpectatorListUpdate = (data) => {
-      console.log('Spectator list updated:', data.spectators);
+    // A roster page says which delta it is current as of
+    const handleSpectatorRoster = (data) => {
+      rosterRequested.current = false;
+      rosterSeq.current = data.seq;
+      console.log('Spectators:', data.viewerCount);
     };
 
-    const handleLiveCodeUpdate = (data) => {
+    // Joins and leaves since the last update, plus the audience size. Slow
+    // connections may have deltas dropped; a gap or a truncated delta means
+    // our roster is stale, so fetch it again
+    const handleSpectatorRosterDelta = (data) => {
+      if (rosterSeq.current !== null && data.seq <= rosterSeq.current) return;
+      if (rosterSeq.current === null || data.seq !== rosterSeq.current + 1 || data.truncated) {
+        if (!rosterRequested.current) {
+          rosterRequested.current = true;
+          emit('get_spectator_roster', { page: 1 });
+        }
+        return;
+      }
+      rosterSeq.current = data.seq;
+      console.log('Spectators:', data.viewerCount, 'joined:', data.joined.length, 'left:', data.left.length);
+    };
+
+    const showLiveCode = (playerId, code) => {
       // ✅ SAFE ARRAY ACCESS: Null checks prevent crashes
       const player1 = players[0];
       const player2 = players[1];
       
       // ✅ CORRECT IDENTIFICATION: Matches by player ID
-      if (player1 && data.player_id === player1.id) {
-        setPlayer1Code(data.code);
+      if (player1 && playerId === player1.id) {
+        setPlayer1Code(code);
         // ✅ TYPING INDICATORS: Proper timeout management
         setPlayer1Typing(true);
         if (typingTimeouts.player1) {
@@ -69,8 +107,8 @@ function SpectatorRoom({ lobby, players, spectatorName, onLeaveLobby }) {
         const timeout = setTimeout(() => setPlayer1Typing(false), 2000);
         setTypingTimeouts(prev => ({ ...prev, player1: timeout }));
         
-      } else if (player2 && data.player_id === player2.id) {
-        setPlayer2Code(data.code);
+      } else if (player2 && playerId === player2.id) {
+        setPlayer2Code(code);
         
         // ✅ RESTORED: Player 2 typing indicator logic
         setPlayer2Typing(true);
@@ -82,16 +120,39 @@ function SpectatorRoom({ lobby, players, spectatorName, onLeaveLobby }) {
       }
     };
 
-    on('spectator_chat_message', handleChatMessage);
-    on('spectator_list_update', handleSpectatorListUpdate);
+    // Full snapshot: replaces whatever we had
+    const handleLiveCodeUpdate = (data) => {
+      liveCode.current[data.player_id] = { code: data.code, seq: data.seq };
+      showLiveCode(data.player_id, data.code);
+    };
+
+    // Diff against the previous version; a gap in seq means we missed one
+    const handleLiveCodeDelta = (data) => {
+      const current = liveCode.current[data.player_id];
+      if (current && data.seq <= current.seq) return;
+      if (!current || data.seq !== current.seq + 1) {
+        emit('resync_live_code', { playerId: data.player_id });
+        return;
+      }
+      const code = current.code.slice(0, data.start) + data.insert + current.code.slice(data.start + data.deleteCount);
+      liveCode.current[data.player_id] = { code, seq: data.seq };
+      showLiveCode(data.player_id, code);
+    };
+
+    on('spectator_chat_messages', handleChatMessages);
+    on('spectator_roster', handleSpectatorRoster);
+    on('spectator_roster_delta', handleSpectatorRosterDelta);
     on('live_code_update', handleLiveCodeUpdate);
+    on('live_code_delta', handleLiveCodeDelta);
 
     return () => {
-      off('spectator_chat_message', handleChatMessage);
-      off('spectator_list_update', handleSpectatorListUpdate);
+      off('spectator_chat_messages', handleChatMessages);
+      off('spectator_roster', handleSpectatorRoster);
+      off('spectator_roster_delta', handleSpectatorRosterDelta);
       off('live_code_update', handleLiveCodeUpdate);
+      off('live_code_delta', handleLiveCodeDelta);
     };
-  }, [on, off, players]);
+  }, [on, off, emit, players]);
 
   // Cleanup typing timeouts on unmount
   useEffect(() => {
@@ -20,10 +20,8 @@ export const useLobby = () => {
   const [isSpectator, setIsSpectator] = useState(false)
   const [spectatorName, setSpectatorName] = useState(null)
 
-  // Socket event handlers
+  // Socket event handlers (kept registered across reconnects, so replayed events aren't missed)
   useEffect(() => {
-    if (!connected) return
-
     // Lobby list response
     const handleLobbyList = (data) => {
       console.log('Received lobby list:', data)
@@ -83,6 +81,16 @@ export const useLobby = () => {
       }
     }
 
+    // Session resumed after a reconnect: missed events are replayed next, or the
+    // server sends the whole lobby when it no longer has them
+    const handleResumed = (data) => {
+      console.log('Session resumed:', data)
+      if (data.lobbyData) {
+        setCurrentLobby(data.lobbyData)
+        setPlayers(data.lobbyData.players)
+      }
+    }
+
     // Lobby left response
     const handleLobbyLeft = (data) => {
       console.log('Left lobby:', data)
@@ -151,16 +159,22 @@ export const useLobby = () => {
     }
 
     // Real-time lobby list updates
-    const handleLobbyListUpdate = (data) => {
+    const handleLobbyListDiff = (data) => {
       console.log('Received real-time lobby list update:', data)
-      setLobbies(data.lobbies)
+      setLobbies(prev => {
+        const byId = new Map(prev.map(lobby => [lobby.id, lobby]))
+        data.removed.forEach(id => byId.delete(id))
+        data.added.forEach(lobby => byId.set(lobby.id, lobby))
+        data.changed.forEach(lobby => byId.set(lobby.id, lobby))
+        return data.order.filter(id => byId.has(id)).map(id => byId.get(id))
+      })
       setPagination(data.pagination)
     }
 
     // Spectator events
     const handleSpectatorJoined = (data) => {
       console.log('Joined as spectator:', data)
-      setCurrentLobby(data.lobbyData)
+      setCurrentLobby({ ...data.lobbyData, chatHistory: data.chatHistory || [] })
       setPlayers(data.lobbyData.players)
       setIsSpectator(true)
       setError(null)
@@ -185,8 +199,9 @@ export const useLobby = () => {
     on('test_results', handleTestResults)
     on('progress_update', handleProgressUpdate)
     on('game_finished', handleGameFinished)
-    on('lobby_list_update', handleLobbyListUpdate)
+    on('lobby_list_diff', handleLobbyListDiff)
     on('spectator_joined', handleSpectatorJoined)
+    on('resumed', handleResumed)
     on('error', handleError)
 
     // Cleanup listeners
@@ -202,11 +217,12 @@ export const useLobby = () => {
       off('test_results', handleTestResults)
       off('progress_update', handleProgressUpdate)
       off('game_finished', handleGameFinished)
-      off('lobby_list_update', handleLobbyListUpdate)
+      off('lobby_list_diff', handleLobbyListDiff)
       off('spectator_joined', handleSpectatorJoined)
+      off('resumed', handleResumed)
       off('error', handleError)
     }
-  }, [connected, currentLobby, on, off])
+  }, [currentLobby, on, off])
 
   // Actions
   const getLobbyList = useCallback((page = 1, search = '') => {
@@ -218,8 +234,15 @@ export const useLobby = () => {
     setLoading(true)
     setError(null)
     
+    // Subscribing returns the page now and pushes changes to it until unsubscribed
     console.log('Requesting lobby list:', { page, search })
-    emit('get_lobby_list', { page, search })
+    emit('subscribe_lobby_list', { page, search })
+  }, [connected, emit])
+
+  const unsubscribeLobbyList = useCallback(() => {
+    if (!connected) return
+
+    emit('unsubscribe_lobby_list', {})
   }, [connected, emit])
 
   const createLobby = useCallback((lobbyData) => {
@@ -326,6 +349,7 @@ export const useLobby = () => {
 
     // Actions
     getLobbyList,
+    unsubscribeLobbyList,
     createLobby,
     joinLobby,
     leaveLobby,
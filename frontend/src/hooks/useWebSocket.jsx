@@ -18,49 +18,92 @@ export const WebSocketProvider = ({ children }) => {
   const [error, setError] = useState(null)
   const eventHandlers = useRef({})
 
-  useEffect(() => {
-    // Create WebSocket connection using config
-    console.log('Connecting to WebSocket:', config.wsUrl)
-    const ws = new WebSocket(config.wsUrl)
-
+  // Resume token and the last lobby eventSeq seen, so a dropped connection can pick up where it left off
+  const session = useRef({ token: null, lastSeq: 0 })
 
-    // Connection event handlers
-    ws.onopen = () => {
-      console.log('Connected to WebSocket server')
-      setConnected(true)
-      setError(null)
-      setSocket(ws)
-    }
+  useEffect(() => {
+    let ws
+    let retryTimer = null
+    let retries = 0
+    let closing = false
+
+    const connect = () => {
+      // Create WebSocket connection using config
+      console.log('Connecting to WebSocket:', config.wsUrl)
+      ws = new WebSocket(config.wsUrl)
+
+      // Connection event handlers
+      ws.onopen = () => {
+        console.log('Connected to WebSocket server')
+        retries = 0
+        // Resume the previous session, if there was one, before anything else is sent.
+        // The token goes in a message rather than the URL so it stays out of server logs
+        const { token, lastSeq } = session.current
+        if (token) {
+          ws.send(JSON.stringify({ event: 'resume', data: { resumeToken: token, lastSeq } }))
+        }
+        setConnected(true)
+        setError(null)
+        setSocket(ws)
+      }
 
-    ws.onclose = (event) => {
-      console.log('Disconnected from WebSocket server:', event.reason)
-      setConnected(false)
-      setSocket(null)
-    }
+      ws.onclose = (event) => {
+        console.log('Disconnected from WebSocket server:', event.reason)
+        setConnected(false)
+        setSocket(null)
+        // Reconnect, backing off exponentially (1s, 2s, 4s... up to 30s) with jitter so
+        // a restarted server isn't hit by every client at once
+        if (!closing) {
+          const delay = Math.min(30000, 1000 * 2 ** retries) * (0.5 + Math.random() / 2)
+          retries += 1
+          retryTimer = setTimeout(connect, delay)
+        }
+      }
 
-    ws.onerror = (err) => {
-      console.error('WebSocket error:', err)
-      setError('Connection error')
-      setConnected(false)
-    }
+      ws.onerror = (err) => {
+        console.error('WebSocket error:', err)
+        setError('Connection error')
+        setConnected(false)
+      }
 
-    ws.onmessage = (event) => {
-      try {
-        const message = JSON.parse(event.data)
-        const { event: eventName, data } = message
-        
-        // Call registered event handlers
-        if (eventHandlers.current[eventName]) {
-          eventHandlers.current[eventName].forEach(handler => handler(data))
+      ws.onmessage = (event) => {
+        try {
+          const message = JSON.parse(event.data)
+          const { event: eventName, data } = message
+          
+          // Answer server heartbeats so an idle tab isn't mistaken for a dead socket
+          if (eventName === 'ping') {
+            ws.send(JSON.stringify({ event: 'pong', data: {} }))
+            return
+          }
+          if (eventName === 'session') {
+            session.current.token = data.resumeToken
+            return
+          }
+          if (eventName === 'lobby_left') {
+            session.current.lastSeq = 0
+          }
+          if (data && typeof data.eventSeq === 'number') {
+            session.current.lastSeq = data.eventSeq
+          }
+          
+          // Call registered event handlers
+          if (eventHandlers.current[eventName]) {
+            eventHandlers.current[eventName].forEach(handler => handler(data))
+          }
+        } catch (err) {
+          console.error('Failed to parse WebSocket message:', err)
         }
-      } catch (err) {
-        console.error('Failed to parse WebSocket message:', err)
       }
     }
 
+    connect()
+
     // Cleanup on unmount
     return () => {
       console.log('Cleaning up WebSocket connection')
+      closing = true
+      clearTimeout(retryTimer)
       ws.close()
     }
   }, [])